@@ -11,7 +11,7 @@ from .models import (
     ProductVariantAttribute, Review, ReviewImage, Wishlist, 
     WishlistItem, Cart, CartItem, Coupon, Order, OrderItem, 
     Newsletter, ProductView, RecentlyViewedProduct, SiteSetting, 
-    Banner
+    Banner, SearchQueryDaily, StockReservation, StkPushJob
 )
 
 
@@ -186,13 +186,21 @@ class ProductAdmin(admin.ModelAdmin):
             'fields': ('view_count', 'sales_count'),
             'classes': ('collapse',)
         }),
+        ('Ratings', {
+            'fields': ('rating_average', 'rating_count', 'rating_5_count', 'rating_4_count',
+                       'rating_3_count', 'rating_2_count', 'rating_1_count'),
+            'classes': ('collapse',)
+        }),
     )
+    readonly_fields = ['rating_average', 'rating_count', 'rating_5_count', 'rating_4_count',
+                       'rating_3_count', 'rating_2_count', 'rating_1_count']
     
     inlines = [ProductImageInline, ProductVariantInline]
     
     def average_rating(self, obj):
         return f"{obj.average_rating:.1f}" if obj.average_rating else "No ratings"
     average_rating.short_description = 'Avg Rating'
+    average_rating.admin_order_field = 'rating_average'
     
     actions = ['mark_as_featured', 'mark_as_hot_deal', 'mark_as_big_sale', 'mark_as_best_seller']
     
@@ -275,13 +283,19 @@ class ReviewAdmin(admin.ModelAdmin):
     actions = ['approve_reviews', 'disapprove_reviews']
     
     def approve_reviews(self, request, queryset):
-        queryset.update(is_approved=True)
+        self._set_approval(queryset, True)
     approve_reviews.short_description = "Approve selected reviews"
     
     def disapprove_reviews(self, request, queryset):
-        queryset.update(is_approved=False)
+        self._set_approval(queryset, False)
     disapprove_reviews.short_description = "Disapprove selected reviews"
 
+    def _set_approval(self, queryset, is_approved):
+        # Bulk updates skip the review signals, so refresh the product aggregates here
+        product_ids = list(queryset.values_list('product_id', flat=True).distinct())
+        queryset.update(is_approved=is_approved)
+        Product.refresh_ratings(Product.objects.filter(id__in=product_ids))
+
 
 # Wishlist Item Inline
 class WishlistItemInline(admin.TabularInline):
@@ -313,9 +327,10 @@ class CartItemInline(admin.TabularInline):
 # Cart Admin
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'total_items', 'total_price', 'created_at']
+    list_display = ['id', 'user', 'item_count', 'subtotal', 'created_at']
     list_filter = ['created_at']
     search_fields = ['user__email', 'session_key']
+    readonly_fields = ['item_count', 'subtotal']
     
     inlines = [CartItemInline]
 
@@ -437,6 +452,50 @@ class RecentlyViewedProductAdmin(admin.ModelAdmin):
         return False
 
 
+# Stock Reservation Admin
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ['order', 'product', 'variant', 'quantity', 'status', 'expires_at']
+    list_filter = ['status', 'expires_at']
+    search_fields = ['order__order_number', 'product__name']
+    readonly_fields = ['order', 'product', 'variant', 'quantity', 'status', 'expires_at', 'created_at', 'updated_at']
+    
+    def has_add_permission(self, request):
+        return False
+
+
+# STK Push Job Admin
+@admin.register(StkPushJob)
+class StkPushJobAdmin(admin.ModelAdmin):
+    list_display = ['order', 'phone_number', 'amount', 'status', 'checkout_request_id', 'created_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['order__order_number', 'reference', 'checkout_request_id', 'phone_number']
+    exclude = ['cart']
+    readonly_fields = [
+        'order', 'reference', 'phone_number', 'amount', 'status', 'available_at',
+        'started_at', 'checkout_request_id', 'error', 'created_at', 'updated_at',
+    ]
+    
+    def has_add_permission(self, request):
+        return False
+
+
+# Search Query Daily Admin
+@admin.register(SearchQueryDaily)
+class SearchQueryDailyAdmin(admin.ModelAdmin):
+    list_display = ['query', 'day', 'count']
+    list_filter = ['day']
+    search_fields = ['query']
+    ordering = ['-day', '-count']
+    readonly_fields = ['query', 'day', 'count']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 # Site Setting Admin
 @admin.register(SiteSetting)
 class SiteSettingAdmin(admin.ModelAdmin):
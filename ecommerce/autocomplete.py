@@ -0,0 +1,218 @@
+# autocomplete.py
+"""
+Memory resident autocomplete over product, category and brand names.
+
+Every name is stored under each of its word suffixes ("samsung galaxy s21",
+"galaxy s21", "s21") in sorted arrays, so a typed prefix is a binary search
+plus a short scan. Suggestions carry everything the dropdown shows (price,
+thumbnail, stock state, active product counts) and are ranked by popularity,
+so a keystroke never reaches the database. The index follows the search
+index change log and is refreshed incrementally like ``search_index``.
+"""
+import bisect
+import heapq
+import re
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from .models import Brand, Category, Product
+from .search_index import CATALOG_CHANGED, LocalIndex, popularity_boost
+
+
+PRODUCT_LIMIT = 8
+CATEGORY_LIMIT = 4
+BRAND_LIMIT = 3
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    return ' '.join(WORD_RE.findall(text.lower()))
+
+
+def name_keys(name):
+    """The normalized name starting at every word"""
+    words = normalize(name).split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+def indexed_products():
+    return Product.objects.filter(status='active').select_related(
+        'category', 'brand'
+    ).prefetch_related('images')
+
+
+def product_suggestion(product):
+    images = list(product.images.all())
+    return {
+        'type': 'product',
+        'title': product.name,
+        'category': product.category.name,
+        'price': str(product.price),
+        'url': product.get_absolute_url(),
+        'image': images[0].image.url if images and images[0].image else '',
+        'in_stock': product.is_in_stock,
+    }
+
+
+class PrefixIndex:
+    """Sorted ``(key, id)`` pairs searchable by key prefix"""
+
+    def __init__(self):
+        self.entries = []
+        self.keys = {}  # id -> keys
+
+    def add(self, item_id, name):
+        self.remove(item_id)
+        self.keys[item_id] = name_keys(name)
+        for key in self.keys[item_id]:
+            bisect.insort(self.entries, (key, item_id))
+
+    def load(self, items):
+        """Replace the contents with ``(id, name)`` pairs, sorting once"""
+        self.keys = {item_id: name_keys(name) for item_id, name in items}
+        self.entries = sorted(
+            (key, item_id) for item_id, keys in self.keys.items() for key in keys
+        )
+
+    def remove(self, item_id):
+        for key in self.keys.pop(item_id, ()):
+            position = bisect.bisect_left(self.entries, (key, item_id))
+            if position < len(self.entries) and self.entries[position] == (key, item_id):
+                del self.entries[position]
+
+    def lookup(self, prefix):
+        """IDs with a name key starting with ``prefix``"""
+        matches = set()
+        position = bisect.bisect_left(self.entries, (prefix,))
+        for key, item_id in self.entries[position:]:
+            if not key.startswith(prefix):
+                break
+            matches.add(item_id)
+        return matches
+
+
+class AutocompleteIndex:
+    """Suggestions for every active product, category and brand. Thread safe."""
+
+    def __init__(self, version=0):
+        self.version = version
+        self.built_at = time.monotonic()
+        self.products = {}          # product_id -> suggestion
+        self.weights = {}           # product_id -> popularity
+        self.groups = {}            # product_id -> (category_id, brand_id)
+        self.categories = {}        # category_id -> name
+        self.brands = {}            # brand_id -> name
+        self.category_counts = Counter()
+        self.brand_counts = Counter()
+        self.product_names = PrefixIndex()
+        self.category_names = PrefixIndex()
+        self.brand_names = PrefixIndex()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def build(cls, version):
+        index = cls(version)
+        index.load_catalog()
+        products = list(indexed_products())
+        for product in products:
+            index._store(product)
+        # One sort instead of an insort per name key
+        index.product_names.load((product.id, product.name) for product in products)
+        return index
+
+    def is_expired(self):
+        max_age = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 60 * 15)
+        return time.monotonic() - self.built_at > max_age
+
+    def load_catalog(self):
+        categories = dict(Category.objects.filter(is_active=True).values_list('id', 'name'))
+        brands = dict(Brand.objects.filter(is_active=True).values_list('id', 'name'))
+        with self._lock:
+            self.categories, self.brands = categories, brands
+            self.category_names.load(categories.items())
+            self.brand_names.load(brands.items())
+
+    def add(self, product):
+        with self._lock:
+            self._store(product)
+            self.product_names.add(product.id, product.name)
+
+    def _store(self, product):
+        """Everything about ``product`` except its name keys"""
+        suggestion = product_suggestion(product)
+        with self._lock:
+            self.remove(product.id)
+            self.products[product.id] = suggestion
+            self.weights[product.id] = popularity_boost(product.sales_count, product.view_count)
+            self.groups[product.id] = (product.category_id, product.brand_id)
+            self.category_counts[product.category_id] += 1
+            if product.brand_id:
+                self.brand_counts[product.brand_id] += 1
+
+    def remove(self, product_id):
+        with self._lock:
+            if self.products.pop(product_id, None) is None:
+                return
+            self.weights.pop(product_id)
+            category_id, brand_id = self.groups.pop(product_id)
+            self.category_counts[category_id] -= 1
+            if brand_id:
+                self.brand_counts[brand_id] -= 1
+            self.product_names.remove(product_id)
+
+    def refresh(self, keys, version):
+        product_ids = [key for key in keys if key != CATALOG_CHANGED]
+        products = {p.id: p for p in indexed_products().filter(id__in=product_ids)}
+        with self._lock:
+            if CATALOG_CHANGED in keys:
+                self.load_catalog()
+            for product_id in product_ids:
+                if product_id in products:
+                    self.add(products[product_id])
+                else:
+                    self.remove(product_id)
+            self.version = version
+
+    def suggest(self, query):
+        """Autocomplete entries for ``query``: products, then categories and brands"""
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        with self._lock:
+            product_ids = heapq.nsmallest(
+                PRODUCT_LIMIT, self.product_names.lookup(prefix),
+                key=lambda product_id: (-self.weights[product_id], product_id)
+            )
+            suggestions = [self.products[product_id] for product_id in product_ids]
+            suggestions += self._groups('category', prefix, self.category_names, self.categories,
+                                        self.category_counts, CATEGORY_LIMIT)
+            suggestions += self._groups('brand', prefix, self.brand_names, self.brands,
+                                        self.brand_counts, BRAND_LIMIT)
+        return suggestions
+
+    def _groups(self, kind, prefix, names, titles, counts, limit):
+        ids = heapq.nsmallest(
+            limit, names.lookup(prefix),
+            key=lambda item_id: (-counts[item_id], titles[item_id])
+        )
+        return [{
+            'type': kind,
+            'title': titles[item_id],
+            'count': counts[item_id],
+            'url': f'/search/?{kind}={item_id}',
+        } for item_id in ids]
+
+
+_local_index = LocalIndex(AutocompleteIndex)
+
+
+def get_index():
+    return _local_index.get()
+
+
+def suggest(query):
+    return get_index().suggest(query)
@@ -0,0 +1,24 @@
+# cache_versions.py
+"""
+Version stamps in the shared cache.
+
+A stamp names the current generation of something every process caches
+(the catalog tree, the listing counters); bumping it retires all of it at
+once, in every process sharing the cache, without deleting any keys.
+"""
+import uuid
+
+from django.core.cache import cache
+
+
+def get_version(key):
+    """The stamp under ``key``, starting one if there is none yet"""
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    cache.set(key, uuid.uuid4().hex, None)
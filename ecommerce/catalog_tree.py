@@ -0,0 +1,75 @@
+# catalog_tree.py
+"""
+Process-local cache of the category hierarchy and the brand list.
+
+The tree is loaded once per process and reused until the shared version
+stamp in the cache changes. ``signals.py`` bumps the stamp whenever a
+Category or Brand is written (or a product moves between categories), so
+every process reloads on its next request. Categories and brands carry
+a ``product_count`` annotation for the navigation menus.
+"""
+import threading
+from types import MappingProxyType
+
+from django.db.models import Count
+
+from . import cache_versions
+from .models import Category, Brand
+
+
+VERSION_CACHE_KEY = 'catalog_tree_version'
+
+_lock = threading.Lock()
+_tree = None
+
+
+class CatalogTree:
+    """Immutable snapshot of active categories and brands"""
+
+    def __init__(self, version, categories, brands):
+        self.version = version
+        self.categories = tuple(categories)
+        self.brands = tuple(brands)
+        self.parents = tuple(c for c in self.categories if c.parent_id is None)
+
+        children = {}
+        for category in self.categories:
+            if category.parent_id is not None:
+                children.setdefault(category.parent_id, []).append(category)
+
+        # Only parents that actually have children, like the template expects
+        self.children = MappingProxyType({
+            parent: tuple(children[parent.id])
+            for parent in self.parents if parent.id in children
+        })
+
+    @classmethod
+    def load(cls, version):
+        categories = Category.objects.filter(is_active=True).select_related(
+            'parent'
+        ).annotate(product_count=Count('products'))
+        brands = Brand.objects.filter(is_active=True).annotate(product_count=Count('product'))
+        return cls(version, list(categories), list(brands))
+
+
+def get_version():
+    return cache_versions.get_version(VERSION_CACHE_KEY)
+
+
+def bump_version():
+    """Invalidate the tree in every process sharing the cache"""
+    cache_versions.bump_version(VERSION_CACHE_KEY)
+
+
+def get_catalog_tree():
+    """Return the current tree, reloading it only if the version moved"""
+    global _tree
+    version = get_version()
+    tree = _tree
+    if tree is not None and tree.version == version:
+        return tree
+
+    with _lock:
+        if _tree is None or _tree.version != version:
+            _tree = CatalogTree.load(version)
+        return _tree
@@ -0,0 +1,299 @@
+# facets.py
+"""
+Bitmap facet index for search filters.
+
+Every product ID is a bit. The index keeps one bitmap (a Python int) per
+category, brand, status and price bucket, plus one for products in stock.
+A search result is turned into a bitmap once, and each facet count is then
+an AND plus a popcount in memory, however many filters the sidebar shows.
+The index follows the search index change log, like ``autocomplete``.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Brand, Category, Product
+from .search_index import CATALOG_CHANGED, LocalIndex
+
+
+# Lower edges of the price buckets (KES)
+PRICE_BUCKETS = (0, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+
+# Bit positions set in each byte value
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+
+def bitmap_of(ids):
+    # Set the bits in a byte array and convert once; OR-ing into a big int
+    # copies it for every ID
+    ids = list(ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) // 8 + 1)
+    for item_id in ids:
+        data[item_id >> 3] |= 1 << (item_id & 7)
+    return int.from_bytes(data, 'little')
+
+
+def ids_of(bitmap):
+    """IDs set in ``bitmap``, ascending"""
+    ids = []
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for offset, value in enumerate(data):
+        if value:
+            base = offset * 8
+            ids.extend(base + bit for bit in _BYTE_BITS[value])
+    return ids
+
+
+def price_bucket(price):
+    return max(bisect.bisect_right(PRICE_BUCKETS, price) - 1, 0)
+
+
+def parse_decimal(value):
+    try:
+        return Decimal(str(value)) if value not in (None, '') else None
+    except InvalidOperation:
+        return None
+
+
+def parse_id(value):
+    try:
+        return int(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+class FacetIndex:
+    """Per category, brand, status, stock and price bucket bitmaps. Thread safe."""
+
+    def __init__(self, version=0):
+        self.version = version
+        self.built_at = time.monotonic()
+        self.products = {}       # product_id -> (category_id, brand_id, status, price, in_stock)
+        self.by_category = {}
+        self.by_brand = {}
+        self.by_status = {}
+        self.by_price_bucket = {}
+        self.in_stock = 0
+        self.categories = {}     # category_id -> (name, path), active only
+        self.brands = {}         # brand_id -> name, active only
+        self._lock = threading.RLock()
+
+    @classmethod
+    def build(cls, version):
+        index = cls(version)
+        index.load_catalog()
+        # Group the IDs first and convert each group once, see bitmap_of
+        groups = {name: defaultdict(list) for name in ('by_category', 'by_brand', 'by_status', 'by_price_bucket')}
+        in_stock = []
+        for product_id, category_id, brand_id, status, price, stocked in cls.product_rows(Product.objects.all()):
+            index.products[product_id] = (category_id, brand_id, status, price, stocked)
+            groups['by_category'][category_id].append(product_id)
+            groups['by_brand'][brand_id].append(product_id)
+            groups['by_status'][status].append(product_id)
+            groups['by_price_bucket'][price_bucket(price)].append(product_id)
+            if stocked:
+                in_stock.append(product_id)
+        for name, ids_by_key in groups.items():
+            setattr(index, name, {key: bitmap_of(ids) for key, ids in ids_by_key.items()})
+        index.in_stock = bitmap_of(in_stock)
+        return index
+
+    @staticmethod
+    def product_rows(queryset):
+        return queryset.annotate(
+            in_stock=Q(track_inventory=False) | Q(stock_quantity__gt=0)
+        ).values_list('id', 'category_id', 'brand_id', 'status', 'price', 'in_stock')
+
+    def is_expired(self):
+        max_age = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 60 * 15)
+        return time.monotonic() - self.built_at > max_age
+
+    def load_catalog(self):
+        categories = {
+            category_id: (name, path) for category_id, name, path
+            in Category.objects.filter(is_active=True).values_list('id', 'name', 'path')
+        }
+        brands = dict(Brand.objects.filter(is_active=True).values_list('id', 'name'))
+        with self._lock:
+            self.categories, self.brands = categories, brands
+
+    def _set(self, bitmaps, key, bit):
+        bitmaps[key] = bitmaps.get(key, 0) | bit
+
+    def _unset(self, bitmaps, key, bit):
+        bitmap = bitmaps.get(key, 0) & ~bit
+        if bitmap:
+            bitmaps[key] = bitmap
+        else:
+            bitmaps.pop(key, None)
+
+    def add(self, product_id, category_id, brand_id, status, price, in_stock):
+        bit = 1 << product_id
+        bucket = price_bucket(price)
+        with self._lock:
+            self.remove(product_id)
+            self.products[product_id] = (category_id, brand_id, status, price, in_stock)
+            self._set(self.by_category, category_id, bit)
+            self._set(self.by_brand, brand_id, bit)
+            self._set(self.by_status, status, bit)
+            self._set(self.by_price_bucket, bucket, bit)
+            if in_stock:
+                self.in_stock |= bit
+
+    def remove(self, product_id):
+        with self._lock:
+            row = self.products.pop(product_id, None)
+            if row is None:
+                return
+            category_id, brand_id, status, price, in_stock = row
+            bit = 1 << product_id
+            self._unset(self.by_category, category_id, bit)
+            self._unset(self.by_brand, brand_id, bit)
+            self._unset(self.by_status, status, bit)
+            self._unset(self.by_price_bucket, price_bucket(price), bit)
+            self.in_stock &= ~bit
+
+    def refresh(self, keys, version):
+        product_ids = [key for key in keys if key != CATALOG_CHANGED]
+        rows = {row[0]: row for row in self.product_rows(Product.objects.filter(id__in=product_ids))}
+        with self._lock:
+            if CATALOG_CHANGED in keys:
+                self.load_catalog()
+            for product_id in product_ids:
+                if product_id in rows:
+                    self.add(*rows[product_id])
+                else:
+                    self.remove(product_id)
+            self.version = version
+
+    def category_bitmap(self, category_id, include_descendants=True):
+        """Products filed under ``category_id`` (and its subcategories)"""
+        if not include_descendants or category_id not in self.categories:
+            return self.by_category.get(category_id, 0)
+        path = self.categories[category_id][1]
+        if not path:
+            # Paths not built yet (see rebuild_category_paths)
+            return self.by_category.get(category_id, 0)
+        bitmap = 0
+        for other_id, (name, other_path) in self.categories.items():
+            if other_path.startswith(path):
+                bitmap |= self.by_category.get(other_id, 0)
+        return bitmap
+
+    def _price_bitmap(self, bitmap, min_price, max_price):
+        """Narrow ``bitmap`` to a price range: whole buckets by bitmap, edges by price"""
+        if min_price is None and max_price is None:
+            return bitmap
+        selected = 0
+        for bucket, bucket_bitmap in self.by_price_bucket.items():
+            low = PRICE_BUCKETS[bucket]
+            high = PRICE_BUCKETS[bucket + 1] if bucket + 1 < len(PRICE_BUCKETS) else None
+            if (max_price is not None and low > max_price) or (min_price is not None and high is not None and high <= min_price):
+                continue
+            candidates = bitmap & bucket_bitmap
+            inside = (min_price is None or low >= min_price) and (
+                max_price is None or (high is not None and high <= max_price)
+            )
+            if not inside:
+                outside = [
+                    product_id for product_id in ids_of(candidates)
+                    if (min_price is not None and self.products[product_id][3] < min_price)
+                    or (max_price is not None and self.products[product_id][3] > max_price)
+                ]
+                candidates &= ~bitmap_of(outside)
+            selected |= candidates
+        return selected
+
+    def filter(self, product_ids=None, category_id=None, include_descendants=True, brand_id=None,
+               min_price=None, max_price=None, in_stock=False):
+        """Bitmap of the active products passing all given filters"""
+        with self._lock:
+            bitmap = self.by_status.get('active', 0)
+            if product_ids is not None:
+                bitmap &= bitmap_of(product_ids)
+            if category_id is not None:
+                bitmap &= self.category_bitmap(category_id, include_descendants)
+            if brand_id is not None:
+                bitmap &= self.by_brand.get(brand_id, 0)
+            if in_stock:
+                bitmap &= self.in_stock
+            return self._price_bitmap(bitmap, min_price, max_price)
+
+    def facets(self, bitmap):
+        """Category, brand and price facets of the products in ``bitmap``"""
+        with self._lock:
+            categories = [
+                {'id': category_id, 'name': self.categories[category_id][0], 'product_count': count}
+                for category_id, count in self._counts(self.by_category, bitmap)
+                if category_id in self.categories
+            ]
+            brands = [
+                {'id': brand_id, 'name': self.brands[brand_id], 'product_count': count}
+                for brand_id, count in self._counts(self.by_brand, bitmap)
+                if brand_id in self.brands
+            ]
+            buckets = []
+            for bucket, count in sorted(self._counts(self.by_price_bucket, bitmap)):
+                high = PRICE_BUCKETS[bucket + 1] if bucket + 1 < len(PRICE_BUCKETS) else None
+                buckets.append({'min_price': PRICE_BUCKETS[bucket], 'max_price': high, 'product_count': count})
+            return {
+                'categories': sorted(categories, key=lambda facet: facet['name']),
+                'brands': sorted(brands, key=lambda facet: facet['name']),
+                'price_range': self._price_range(bitmap),
+                'price_buckets': buckets,
+                'total_products': bitmap.bit_count(),
+            }
+
+    def _counts(self, bitmaps, bitmap):
+        for key, facet_bitmap in bitmaps.items():
+            count = (facet_bitmap & bitmap).bit_count()
+            if count:
+                yield key, count
+
+    def _price_range(self, bitmap):
+        """Cheapest and dearest price, only scanning the first and last buckets hit"""
+        hit = sorted(bucket for bucket, bucket_bitmap in self.by_price_bucket.items() if bucket_bitmap & bitmap)
+        if not hit:
+            return {'min_price': 0, 'max_price': 0}
+        low_prices = [self.products[i][3] for i in ids_of(self.by_price_bucket[hit[0]] & bitmap)]
+        high_prices = [self.products[i][3] for i in ids_of(self.by_price_bucket[hit[-1]] & bitmap)]
+        return {'min_price': min(low_prices), 'max_price': max(high_prices)}
+
+
+_local_index = LocalIndex(FacetIndex)
+
+
+def get_index():
+    return _local_index.get()
+
+
+def search_facets(params, product_ids=None, include_descendants=True):
+    """
+    Facets for the search filters in ``params`` (a QueryDict), restricted to
+    ``product_ids`` when a text query matched
+    """
+    index = get_index()
+    bitmap = index.filter(
+        product_ids=product_ids,
+        category_id=parse_id(params.get('category')),
+        include_descendants=include_descendants,
+        brand_id=parse_id(params.get('brand')),
+        min_price=parse_decimal(params.get('min_price')),
+        max_price=parse_decimal(params.get('max_price')),
+        in_stock=bool(params.get('in_stock')),
+    )
+    return index.facets(bitmap)
+
+
+def result_facets(product_ids):
+    """Facets of an already filtered result set"""
+    index = get_index()
+    return index.facets(index.filter(product_ids=product_ids))
@@ -0,0 +1,249 @@
+# homepage.py
+"""
+Materialized homepage rails.
+
+Every section of the homepage (hot deals, featured, best sellers, ...) is a
+"rail": an ordered list of product or brand cards that is computed once and
+stored in the cache. ``views.index`` only reads the cache; the signal
+handlers in ``signals.py`` rebuild the rails a write actually touches.
+"""
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .models import Product, Brand, Banner, Category
+
+
+RAIL_SIZE = 8
+RAIL_CACHE_PREFIX = 'homepage_rail'
+# Rails are rebuilt by signals, the timeout only bounds time based drift
+# (new arrivals ageing out of their 30 day window, banner validity, ...)
+RAIL_CACHE_TIMEOUT = 60 * 60
+NEW_ARRIVAL_DAYS = 30
+
+
+def _image_url(product):
+    # images are prefetched, so index instead of calling .first()
+    images = list(product.images.all())
+    if images and images[0].image:
+        return images[0].image.url
+    return ''
+
+
+def product_card(product):
+    """Template data for a single product card"""
+    return {
+        'id': product.id,
+        'name': product.name,
+        'slug': product.slug,
+        'price': product.price,
+        'compare_price': product.compare_price,
+        'image_url': _image_url(product),
+        'review_count': product.review_count,
+        'view_count': product.view_count,
+    }
+
+
+def brand_card(brand):
+    """Template data for a single brand logo"""
+    return {
+        'id': brand.id,
+        'name': brand.name,
+        'slug': brand.slug,
+        'logo_url': brand.logo.url if brand.logo else '',
+    }
+
+
+class ProductRail:
+    """A homepage section listing products that match ``filters``"""
+
+    def __init__(self, name, filters=None, order_by=None):
+        self.name = name
+        self.filters = filters or {}
+        self.order_by = order_by
+
+    @property
+    def cache_key(self):
+        return f'{RAIL_CACHE_PREFIX}:{self.name}'
+
+    def get_filters(self):
+        return dict(self.filters, status='active', stock_quantity__gt=0)
+
+    def queryset(self):
+        queryset = Product.objects.filter(**self.get_filters()).select_related(
+            'brand', 'category'
+        ).prefetch_related('images')
+        if self.order_by:
+            queryset = queryset.order_by(*self.order_by)
+        return queryset[:RAIL_SIZE]
+
+    def build(self):
+        return [product_card(product) for product in self.queryset()]
+
+    def matches(self, product):
+        """Whether ``product`` currently qualifies for this rail"""
+        if product.status != 'active' or product.stock_quantity <= 0:
+            return False
+        return all(getattr(product, field) == value for field, value in self.filters.items())
+
+    def is_affected_by(self, product, cached_ids):
+        return product.pk in cached_ids or self.matches(product)
+
+
+class NewArrivalsRail(ProductRail):
+    """Products created within the last ``NEW_ARRIVAL_DAYS`` days"""
+
+    def get_filters(self):
+        filters = super().get_filters()
+        filters['created_at__gte'] = timezone.now() - timedelta(days=NEW_ARRIVAL_DAYS)
+        return filters
+
+    def matches(self, product):
+        if not super().matches(product) or product.created_at is None:
+            return False
+        return product.created_at >= timezone.now() - timedelta(days=NEW_ARRIVAL_DAYS)
+
+
+class PopularBrandsRail:
+    """Active brands ranked by the views of their active products"""
+    name = 'popular_brands'
+
+    @property
+    def cache_key(self):
+        return f'{RAIL_CACHE_PREFIX}:{self.name}'
+
+    def build(self):
+        brands = Brand.objects.filter(
+            is_active=True,
+            product__status='active'
+        ).annotate(
+            product_count=Count('product'),
+            total_views=Sum('product__view_count')
+        ).order_by('-total_views', '-product_count')[:RAIL_SIZE]
+        return [brand_card(brand) for brand in brands]
+
+    def is_affected_by(self, product, cached_ids):
+        return product.brand_id is not None
+
+
+class BannerRail:
+    """
+    Active banners. Validity windows are checked when the homepage is
+    rendered, so a banner going live or expiring needs no rebuild.
+    """
+    name = 'banners'
+
+    @property
+    def cache_key(self):
+        return f'{RAIL_CACHE_PREFIX}:{self.name}'
+
+    def build(self):
+        banners = Banner.objects.filter(
+            is_active=True,
+            valid_from__isnull=False,
+            valid_to__isnull=False,
+        ).order_by('sort_order')
+        return [{
+            'id': banner.id,
+            'title': banner.title,
+            'subtitle': banner.subtitle,
+            'image_url': banner.image.url if banner.image else '',
+            'mobile_image_url': banner.mobile_image.url if banner.mobile_image else '',
+            'link_url': banner.link_url,
+            'link_text': banner.link_text,
+            'valid_from': banner.valid_from,
+            'valid_to': banner.valid_to,
+        } for banner in banners]
+
+
+class TopCategoriesRail:
+    """Top level categories for the homepage navigation"""
+    name = 'top_categories'
+
+    @property
+    def cache_key(self):
+        return f'{RAIL_CACHE_PREFIX}:{self.name}'
+
+    def build(self):
+        categories = Category.objects.filter(
+            is_active=True,
+            parent=None
+        ).order_by('sort_order', 'name')[:6]
+        return [{
+            'id': category.id,
+            'name': category.name,
+            'slug': category.slug,
+            'image_url': category.image.url if category.image else '',
+        } for category in categories]
+
+
+PRODUCT_RAILS = {
+    rail.name: rail for rail in [
+        ProductRail('hot_deal_products', {'is_hot_deal': True}),
+        ProductRail('featured_products', {'is_featured': True}),
+        ProductRail('best_seller_products', {'is_best_seller': True}),
+        NewArrivalsRail('new_arrivals', order_by=['-created_at']),
+        ProductRail('hot_sale_products', {'is_big_sale': True}),
+        ProductRail('most_viewed_products', order_by=['-view_count']),
+    ]
+}
+POPULAR_BRANDS = PopularBrandsRail()
+BANNERS = BannerRail()
+TOP_CATEGORIES = TopCategoriesRail()
+
+RAILS = dict(PRODUCT_RAILS, **{
+    rail.name: rail for rail in [POPULAR_BRANDS, BANNERS, TOP_CATEGORIES]
+})
+
+
+def rebuild_rails(names=None):
+    """Recompute the given rails (all of them by default) and cache them"""
+    names = list(RAILS) if names is None else names
+    data = {RAILS[name].cache_key: RAILS[name].build() for name in names}
+    cache.set_many(data, RAIL_CACHE_TIMEOUT)
+    return data
+
+
+def rails_for_product(product):
+    """Names of the rails a change to ``product`` can alter"""
+    cached = cache.get_many([rail.cache_key for rail in PRODUCT_RAILS.values()])
+    affected = []
+    for rail in PRODUCT_RAILS.values():
+        cached_ids = {card['id'] for card in cached.get(rail.cache_key, [])}
+        if rail.is_affected_by(product, cached_ids):
+            affected.append(rail.name)
+    if POPULAR_BRANDS.is_affected_by(product, ()):
+        affected.append(POPULAR_BRANDS.name)
+    return affected
+
+
+def rails_containing_product(product_id):
+    """Names of the product rails currently showing ``product_id``"""
+    cached = cache.get_many([rail.cache_key for rail in PRODUCT_RAILS.values()])
+    return [
+        rail.name for rail in PRODUCT_RAILS.values()
+        if any(card['id'] == product_id for card in cached.get(rail.cache_key, []))
+    ]
+
+
+def get_homepage_context():
+    """
+    Homepage context read from the materialized rails. A warm cache costs no
+    database query; cold rails are rebuilt and stored on the way.
+    """
+    keys = {rail.cache_key: name for name, rail in RAILS.items()}
+    cached = cache.get_many(list(keys))
+    missing = [name for key, name in keys.items() if key not in cached]
+    if missing:
+        cached.update(rebuild_rails(missing))
+
+    context = {name: cached[key] for key, name in keys.items()}
+
+    now = timezone.now()
+    context['banners'] = [
+        banner for banner in context['banners']
+        if banner['valid_from'] <= now <= banner['valid_to']
+    ][:5]
+    return context
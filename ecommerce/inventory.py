@@ -0,0 +1,205 @@
+# inventory.py
+"""
+Stock movements for orders.
+
+Stock is only ever changed in the database, never read-modify-written in
+Python: a checkout issues one conditional UPDATE per table,
+
+    UPDATE ... SET stock_quantity = stock_quantity - CASE id WHEN ... END
+    WHERE (id = 1 AND stock_quantity >= 2) OR (id = 7 AND stock_quantity >= 1)
+
+and succeeds only when every line was updated. The database re-checks the
+condition on the locked row, so concurrent checkouts can't oversell or lose
+each other's decrements. Lines of products with ``track_inventory`` off are
+skipped, and lines with a variant move the variant's stock.
+
+These bulk UPDATEs send no ``post_save``, so ``signals.stock_changed``
+refreshes what shows stock state (homepage rails, search indexes).
+
+Orders paid by M-Pesa keep their stock as ``StockReservation`` holds until
+the payment callback arrives: a successful payment converts the holds, a
+failed one releases them, and ``release_expired_reservations`` releases the
+holds of payments that never completed. Held stock is already off
+``stock_quantity``, so that stays the available-to-sell figure and checkout
+needs no extra work.
+"""
+import logging
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils import timezone
+
+from .models import Order, Payment, Product, ProductVariant, StockReservation
+from .signals import stock_changed
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientStock(Exception):
+    """Raised with the lines that could not be fulfilled; nothing was decremented"""
+
+    def __init__(self, shortfalls):
+        self.shortfalls = shortfalls
+        super().__init__(', '.join(
+            f"{line['name']} ({line['available']} left, {line['requested']} requested)"
+            for line in shortfalls
+        ))
+
+
+def stock_lines(items):
+    """
+    Quantities to move for ``items`` (cart or order items with ``product``,
+    ``variant`` and ``quantity``): ``(product quantities, variant quantities,
+    names)``, each keyed by ID
+    """
+    products, variants, names = Counter(), Counter(), {}
+    for item in items:
+        if not item.product.track_inventory:
+            continue
+        if item.variant_id:
+            variants[item.variant_id] += item.quantity
+            names[ProductVariant, item.variant_id] = str(item.variant)
+        else:
+            products[item.product_id] += item.quantity
+            names[Product, item.product_id] = item.product.name
+    return products, variants, names
+
+
+def _change(quantities):
+    return Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        default=Value(0), output_field=IntegerField()
+    )
+
+
+def _take(model, quantities):
+    """Decrement every row that has enough stock; True when all of them had"""
+    if not quantities:
+        return True
+    enough = Q()
+    for pk, quantity in quantities.items():
+        enough |= Q(pk=pk, stock_quantity__gte=quantity)
+    updated = model.objects.filter(enough).update(
+        stock_quantity=F('stock_quantity') - _change(quantities)
+    )
+    return updated == len(quantities)
+
+
+def _shortfalls(model, quantities, names):
+    available = dict(model.objects.filter(pk__in=list(quantities)).values_list('pk', 'stock_quantity'))
+    return [
+        {
+            'name': names[model, pk],
+            'product_id': pk if model is Product else None,
+            'variant_id': pk if model is ProductVariant else None,
+            'requested': quantity,
+            'available': max(available.get(pk, 0), 0),
+        }
+        for pk, quantity in quantities.items() if available.get(pk, 0) < quantity
+    ]
+
+
+def decrement_stock(items):
+    """
+    Take the stock for ``items`` all or nothing. Call inside the order
+    transaction; raises ``InsufficientStock`` listing the short lines.
+    """
+    products, variants, names = stock_lines(items)
+    with transaction.atomic():
+        savepoint = transaction.savepoint()
+        if _take(Product, products) and _take(ProductVariant, variants):
+            transaction.savepoint_commit(savepoint)
+        else:
+            transaction.savepoint_rollback(savepoint)
+            raise InsufficientStock(
+                _shortfalls(Product, products, names) + _shortfalls(ProductVariant, variants, names)
+            )
+    stock_changed(products)
+
+
+def restore_stock(items):
+    """Put the stock of ``items`` back, e.g. for a cancelled order"""
+    products, variants, names = stock_lines(items)
+    for model, quantities in ((Product, products), (ProductVariant, variants)):
+        if quantities:
+            model.objects.filter(pk__in=list(quantities)).update(
+                stock_quantity=F('stock_quantity') + _change(quantities)
+            )
+    stock_changed(products)
+
+
+def reserve(order, items):
+    """Record the stock taken for ``order`` as holds that expire unless paid"""
+    timeout = getattr(settings, 'STOCK_RESERVATION_TIMEOUT', 60 * 15)
+    expires_at = timezone.now() + timedelta(seconds=timeout)
+    return StockReservation.objects.bulk_create([
+        StockReservation(
+            order=order, product_id=item.product_id, variant_id=item.variant_id,
+            quantity=item.quantity, expires_at=expires_at,
+        )
+        for item in items
+    ])
+
+
+def convert_reservations(order):
+    """
+    The order is paid: its holds become sales. If the holds had already
+    been released (a late callback), the stock is taken again.
+    """
+    with transaction.atomic():
+        if StockReservation.objects.filter(order=order, status='held').update(status='converted'):
+            return
+        released = list(StockReservation.objects.filter(
+            order=order, status='released'
+        ).select_related('product', 'variant__product'))
+        if not released:
+            return
+        try:
+            decrement_stock(released)
+        except InsufficientStock as e:
+            logger.error(f"Order {order.order_number} was paid after its stock was released and is short: {e}")
+            return
+        StockReservation.objects.filter(id__in=[r.id for r in released]).update(status='converted')
+
+
+def release_reservations(reservations):
+    """Put back the stock of the open holds in ``reservations``; returns them"""
+    with transaction.atomic():
+        held = list(reservations.filter(status='held').select_for_update().select_related(
+            'product', 'variant__product'
+        ))
+        if held:
+            StockReservation.objects.filter(id__in=[r.id for r in held]).update(status='released')
+            restore_stock(held)
+    return held
+
+
+def release_order(order):
+    """Put back the stock of a cancelled order, held by reservations or not"""
+    if order.reservations.exists():
+        release_reservations(order.reservations.all())
+    else:
+        restore_stock(order.items.select_related('product', 'variant__product'))
+
+
+def release_expired_reservations(now=None):
+    """
+    Release the holds past their expiry and cancel their unpaid orders.
+    Returns the number of holds released.
+    """
+    held = release_reservations(StockReservation.objects.filter(
+        status='held', expires_at__lte=now or timezone.now()
+    ))
+    order_ids = {reservation.order_id for reservation in held}
+    if order_ids:
+        Order.objects.filter(id__in=order_ids, status='pending').update(
+            status='cancelled', payment_status='failed', updated_at=timezone.now()
+        )
+        Payment.objects.filter(order_id__in=order_ids, status='PENDING').update(
+            status='FAILED', updated_at=timezone.now()
+        )
+    return len(held)
+
@@ -0,0 +1,65 @@
+# listing_counts.py
+"""
+Sidebar counters for product listings.
+
+The featured / hot deal / best seller / on sale counters and the listing
+total come out of a single conditional aggregate instead of one COUNT
+each. Results are cached per distinct listing query (sorting is ignored,
+it doesn't change any count). ``signals.py`` bumps a shared version stamp
+on every product write, which retires all cached counters at once.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Count, Q
+
+from . import cache_versions
+
+
+VERSION_CACHE_KEY = 'listing_counts_version'
+
+COUNTERS = {
+    'featured_count': Q(is_featured=True),
+    'hot_deal_count': Q(is_hot_deal=True),
+    'best_seller_count': Q(is_best_seller=True),
+    'sale_count': Q(compare_price__gt=0),
+}
+
+
+def get_version():
+    return cache_versions.get_version(VERSION_CACHE_KEY)
+
+
+def bump_version():
+    """Invalidate the cached counters of every listing"""
+    cache_versions.bump_version(VERSION_CACHE_KEY)
+
+
+def count_listing(queryset):
+    """All counters plus ``total_products`` for ``queryset`` in one query"""
+    distinct = queryset.query.distinct
+    aggregates = {
+        name: Count('id', filter=condition, distinct=distinct)
+        for name, condition in COUNTERS.items()
+    }
+    aggregates['total_products'] = Count('id', distinct=distinct)
+    return queryset.order_by().aggregate(**aggregates)
+
+
+def get_listing_counts(queryset, timeout=None):
+    """Cached ``count_listing``, keyed by the unordered SQL of ``queryset``"""
+    if timeout is None:
+        timeout = getattr(settings, 'LISTING_COUNTS_CACHE_TIMEOUT', 60 * 15)
+    try:
+        sql = str(queryset.order_by().query)
+    except EmptyResultSet:
+        # e.g. ``id__in=[]``, nothing to count
+        return dict.fromkeys([*COUNTERS, 'total_products'], 0)
+    key = f'listing_counts:{get_version()}:' + hashlib.md5(sql.encode()).hexdigest()
+    counts = cache.get(key)
+    if counts is None:
+        counts = count_listing(queryset)
+        cache.set(key, counts, timeout)
+    return counts
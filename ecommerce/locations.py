@@ -0,0 +1,66 @@
+# locations.py
+"""
+Counties and delivery areas for the checkout, as one versioned JSON document.
+
+The document is built once and kept in the shared cache until ``signals.py``
+drops it on a County or DeliveryArea write, or ``LOCATIONS_CACHE_TIMEOUT``
+seconds pass for writes that bypass the signals. Its version is a hash of the
+content, so the checkout page references ``/locations/<version>.json``,
+which browsers and proxies may cache for good, and rendering the page costs
+a cache read instead of a query per county.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+from .models import County, DeliveryArea
+
+
+CACHE_KEY = 'delivery_locations'
+
+
+def area_data(area):
+    days = 's' if area.delivery_days > 1 else ''
+    return {
+        'id': str(area.id),
+        'name': area.name,
+        'shipping_fee': float(area.shipping_fee),
+        'delivery_days': area.delivery_days,
+        'display_name': f"{area.name} (KSh {area.shipping_fee} - {area.delivery_days} day{days})",
+    }
+
+
+def build():
+    """Active counties with their active delivery areas, in two queries"""
+    counties = County.objects.filter(is_active=True).prefetch_related(Prefetch(
+        'delivery_areas',
+        queryset=DeliveryArea.objects.filter(is_active=True).order_by('name'),
+    )).order_by('name')
+    counties_data = [{
+        'id': str(county.id),
+        'name': county.name,
+        'areas': [area_data(area) for area in county.delivery_areas.all()],
+    } for county in counties]
+
+    body = json.dumps(counties_data, separators=(',', ':'))
+    return {
+        'version': hashlib.md5(body.encode()).hexdigest()[:12],
+        'counties': counties_data,
+        'body': body,
+    }
+
+
+def get_document():
+    """``{'version', 'counties', 'body'}``, built on the first request after a change"""
+    document = cache.get(CACHE_KEY)
+    if document is None:
+        document = build()
+        cache.set(CACHE_KEY, document, getattr(settings, 'LOCATIONS_CACHE_TIMEOUT', 60 * 60))
+    return document
+
+
+def invalidate():
+    cache.delete(CACHE_KEY)
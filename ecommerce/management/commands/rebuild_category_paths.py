@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from ecommerce.models import Category
+
+
+class Command(BaseCommand):
+    help = 'Recompute the materialized path and depth of every category'
+
+    def handle(self, *args, **options):
+        changed = Category.rebuild_paths()
+        self.stdout.write(self.style.SUCCESS(f"Updated {changed} category path(s)"))
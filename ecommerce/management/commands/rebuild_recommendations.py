@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Recompute the bought together and viewed together neighbours of every product'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=None,
+                            help='Neighbours kept per product (default: RECOMMENDATION_TOP_K)')
+
+    def handle(self, *args, **options):
+        stored = recommendations.rebuild(options['top_k'])
+        self.stdout.write(self.style.SUCCESS(f"Stored {stored} recommendation(s)"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ecommerce.search_backends import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Create (if needed) and rebuild the index of the configured search backend'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        with transaction.atomic():
+            backend.setup()
+            backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the {type(backend).__name__} search index"))
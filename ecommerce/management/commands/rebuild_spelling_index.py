@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce import search_index
+
+
+class Command(BaseCommand):
+    help = ('Make every web process rebuild its spelling dictionary from the catalog '
+            'and recent search popularity on its next search')
+
+    def handle(self, *args, **options):
+        # The dictionary lives in each process; this only marks it stale in the shared change log
+        search_index.record_change([search_index.CATALOG_CHANGED])
+        self.stdout.write(self.style.SUCCESS(
+            "Recorded a catalog change; spelling dictionaries rebuild on their next search"
+        ))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce import inventory
+
+
+class Command(BaseCommand):
+    help = 'Release the stock held for unpaid M-Pesa orders past their expiry and cancel the orders'
+
+    def handle(self, *args, **options):
+        released = inventory.release_expired_reservations()
+        self.stdout.write(self.style.SUCCESS(f"Released {released} expired reservation(s)"))
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ecommerce import search_analytics
+
+
+class Command(BaseCommand):
+    help = 'Roll search events up into hourly and daily counts and refresh trending searches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=search_analytics.ROLLUP_LOOKBACK_HOURS,
+                            help='Re-aggregate the events of the last N hours')
+        parser.add_argument('--prune', action='store_true',
+                            help='Also delete events and hourly counts past their retention')
+
+    def handle(self, *args, **options):
+        flushed = search_analytics.event_buffer.flush()
+        trending = search_analytics.rollup(timezone.now() - timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(
+            f"Flushed {flushed} search(es); trending: {', '.join(trending) or 'none'}"
+        ))
+        if options['prune']:
+            events, hours = search_analytics.prune()
+            self.stdout.write(self.style.SUCCESS(f"Pruned {events} event(s) and {hours} hourly row(s)"))
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ecommerce import payment_jobs
+
+
+class Command(BaseCommand):
+    help = 'Send queued M-Pesa STK pushes, polling for new jobs until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when there is nothing to send')
+        parser.add_argument('--batch', type=int, default=20,
+                            help='Jobs to take per poll')
+        parser.add_argument('--once', action='store_true',
+                            help='Send the jobs that are due and exit')
+
+    def handle(self, *args, **options):
+        # Jobs this command defers come back through due_jobs, not the web pool
+        payment_jobs.disable_pool()
+        while True:
+            close_old_connections()
+            stale = payment_jobs.fail_stale_jobs()
+            if stale:
+                self.stderr.write(f"Failed {stale} job(s) abandoned mid-push")
+
+            sent = 0
+            for job_id in payment_jobs.due_jobs(options['batch']):
+                try:
+                    sent += payment_jobs.run_job(job_id)
+                except Exception as e:
+                    self.stderr.write(f"STK push job {job_id} crashed: {e}")
+            if sent:
+                self.stdout.write(self.style.SUCCESS(f"Processed {sent} STK push job(s)"))
+
+            if options['once']:
+                return
+            if not sent:
+                time.sleep(options['interval'])
@@ -3,8 +3,11 @@ from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
 from django.urls import reverse
+from django.db.models.functions import Cast, Coalesce, Concat, Substr
+from decimal import Decimal
 from PIL import Image
 import os
+import uuid
 
 
 class User(AbstractUser):
@@ -112,6 +115,11 @@ class Category(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Materialized path of primary keys from the root, e.g. "/3/17/42/".
+    # Maintained on save; descendants share this value as a prefix.
+    path = models.CharField(max_length=255, blank=True, editable=False, db_index=True)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+
     class Meta:
         verbose_name_plural = 'Categories'
         ordering = ['sort_order', 'name']
@@ -122,15 +130,102 @@ class Category(models.Model):
     def get_absolute_url(self):
         return reverse('category_detail', kwargs={'slug': self.slug})
 
+    def save(self, *args, **kwargs):
+        old_path = self.path
+        parent_path = '/'
+        if self.parent_id:
+            if not self.parent.path:
+                # Parent predates path tracking, give it one first
+                self.parent.save(update_fields=['path', 'depth'])
+            parent_path = self.parent.path
+            if old_path and parent_path.startswith(old_path):
+                raise ValueError("A category cannot be moved below itself or one of its descendants")
+
+        super().save(*args, **kwargs)
+
+        new_path = f"{parent_path}{self.pk}/"
+        if new_path == old_path:
+            return
+
+        new_depth = new_path.count('/') - 2
+        Category.objects.filter(pk=self.pk).update(path=new_path, depth=new_depth)
+        if old_path:
+            # Re-root the whole subtree in one statement
+            Category.objects.filter(
+                **self.path_range_lookup(old_path)
+            ).exclude(pk=self.pk).update(
+                path=Concat(models.Value(new_path), Substr('path', len(old_path) + 1)),
+                depth=models.F('depth') + (new_depth - self.depth),
+            )
+        self.path, self.depth = new_path, new_depth
+
+    @staticmethod
+    def path_range_lookup(path, field='path'):
+        """
+        Filter kwargs matching ``path`` and everything below it. Written as
+        a range rather than ``startswith`` so it can use the index on every
+        backend ('~' sorts after digits and '/').
+        """
+        if not path:
+            # An empty prefix would match every category
+            raise ValueError("Category path is not set, run rebuild_category_paths")
+        return {f'{field}__gte': path, f'{field}__lt': f'{path}~'}
+
+    @property
+    def ancestor_ids(self):
+        """Primary keys from the root down to the parent"""
+        return [int(pk) for pk in self.path.strip('/').split('/')[:-1]] if self.path else []
+
+    def get_ancestors(self, include_self=False):
+        """Ancestors ordered from the root, fetched in a single query"""
+        ancestors = sorted(Category.objects.filter(pk__in=self.ancestor_ids), key=lambda c: c.depth)
+        if include_self:
+            ancestors.append(self)
+        return ancestors
+
+    def get_descendants(self, include_self=False):
+        """All categories below this one, at any depth"""
+        if not self.path:
+            # Not backfilled yet: follow the parent links, a query per level
+            ids, level = {self.pk}, [self.pk]
+            while level:
+                level = list(Category.objects.filter(parent_id__in=level).exclude(
+                    pk__in=ids
+                ).values_list('pk', flat=True))
+                ids.update(level)
+            descendants = Category.objects.filter(pk__in=ids)
+        else:
+            descendants = Category.objects.filter(**self.path_range_lookup(self.path))
+        if not include_self:
+            descendants = descendants.exclude(pk=self.pk)
+        return descendants
+
+    @classmethod
+    def rebuild_paths(cls):
+        """Recompute every path and depth from the parent links"""
+        categories = {c.pk: c for c in cls.objects.only('id', 'parent_id', 'path', 'depth')}
+
+        def build(category, seen=()):
+            if category.pk in seen:
+                raise ValueError(f"Category {category.pk} is part of a parent cycle")
+            if category.parent_id is None:
+                return f"/{category.pk}/"
+            return f"{build(categories[category.parent_id], seen + (category.pk,))}{category.pk}/"
+
+        changed = []
+        for category in categories.values():
+            path = build(category)
+            depth = path.count('/') - 2
+            if (category.path, category.depth) != (path, depth):
+                category.path, category.depth = path, depth
+                changed.append(category)
+        cls.objects.bulk_update(changed, ['path', 'depth'])
+        return len(changed)
+
     @property
     def get_category_path(self):
         """Returns the full category path"""
-        path = [self.name]
-        parent = self.parent
-        while parent:
-            path.append(parent.name)
-            parent = parent.parent
-        return ' > '.join(reversed(path))
+        return ' > '.join(category.name for category in self.get_ancestors(include_self=True))
 
 
 class Brand(models.Model):
@@ -201,6 +296,15 @@ class Product(models.Model):
     view_count = models.IntegerField(default=0)
     sales_count = models.IntegerField(default=0)
 
+    # Approved review aggregates, maintained incrementally by signals
+    rating_average = models.DecimalField(max_digits=3, decimal_places=2, default=0, db_index=True)
+    rating_count = models.IntegerField(default=0)
+    rating_1_count = models.IntegerField(default=0)
+    rating_2_count = models.IntegerField(default=0)
+    rating_3_count = models.IntegerField(default=0)
+    rating_4_count = models.IntegerField(default=0)
+    rating_5_count = models.IntegerField(default=0)
+
     class Meta:
         ordering = ['-created_at']
 
@@ -210,6 +314,19 @@ class Product(models.Model):
     def get_absolute_url(self):
         return reverse('product_detail', kwargs={'slug': self.slug})
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember where the product was filed and its price so signal handlers
+        # can tell which denormalized data a save actually changes
+        instance._loaded_grouping = instance.grouping
+        instance._loaded_price = instance.__dict__.get('price')
+        return instance
+
+    @property
+    def grouping(self):
+        return (self.__dict__.get('category_id'), self.__dict__.get('brand_id'))
+
     @property
     def discount_percentage(self):
         if self.compare_price and self.price < self.compare_price:
@@ -230,14 +347,71 @@ class Product(models.Model):
 
     @property
     def average_rating(self):
-        reviews = self.reviews.filter(is_approved=True)
-        if reviews.exists():
-            return reviews.aggregate(avg_rating=models.Avg('rating'))['avg_rating']
-        return 0
+        return self.rating_average
 
     @property
     def review_count(self):
-        return self.reviews.filter(is_approved=True).count()
+        return self.rating_count
+
+    @property
+    def rating_histogram(self):
+        """Approved review counts keyed by star, highest first"""
+        return {star: getattr(self, f'rating_{star}_count') for star in range(5, 0, -1)}
+
+    @staticmethod
+    def _rating_average_expression():
+        weighted = sum(
+            (models.F(f'rating_{star}_count') * star for star in range(2, 6)),
+            models.F('rating_1_count')
+        )
+        return models.Case(
+            models.When(rating_count=0, then=models.Value(Decimal('0'))),
+            default=models.ExpressionWrapper(
+                Cast(weighted, models.FloatField()) / models.F('rating_count'),
+                output_field=models.DecimalField(max_digits=3, decimal_places=2)
+            ),
+            output_field=models.DecimalField(max_digits=3, decimal_places=2)
+        )
+
+    @classmethod
+    def apply_rating_delta(cls, product_id, removed=None, added=None):
+        """
+        Move one review's contribution between stars. ``removed`` and
+        ``added`` are star ratings (or None) of the review before and after
+        the change, counting only approved reviews.
+        """
+        if removed == added:
+            return
+        deltas = {}
+        if removed:
+            deltas[f'rating_{removed}_count'] = deltas.get(f'rating_{removed}_count', 0) - 1
+            deltas['rating_count'] = deltas.get('rating_count', 0) - 1
+        if added:
+            deltas[f'rating_{added}_count'] = deltas.get(f'rating_{added}_count', 0) + 1
+            deltas['rating_count'] = deltas.get('rating_count', 0) + 1
+
+        products = cls.objects.filter(pk=product_id)
+        products.update(**{field: models.F(field) + delta for field, delta in deltas.items() if delta})
+        # Separate statement so the average sees the new counts on every backend
+        products.update(rating_average=cls._rating_average_expression())
+
+    @classmethod
+    def refresh_ratings(cls, queryset):
+        """Recompute the rating aggregates of every product in ``queryset`` from its reviews"""
+        approved = Review.objects.filter(
+            product=models.OuterRef('pk'), is_approved=True
+        ).order_by().values('product')
+
+        def count(**filters):
+            return Coalesce(models.Subquery(
+                approved.filter(**filters).annotate(n=models.Count('pk')).values('n')
+            ), 0)
+
+        queryset.update(
+            rating_count=count(),
+            **{f'rating_{star}_count': count(rating=star) for star in range(1, 6)}
+        )
+        queryset.update(rating_average=cls._rating_average_expression())
 
 
 class ProductImage(models.Model):
@@ -339,6 +513,19 @@ class Review(models.Model):
     def __str__(self):
         return f"{self.product.name} - {self.rating} stars by {self.user.email}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_contribution = instance.contribution
+        return instance
+
+    @property
+    def contribution(self):
+        """(product_id, rating) this review adds to the product aggregates, if any"""
+        if self.__dict__.get('is_approved'):
+            return (self.__dict__.get('product_id'), self.__dict__.get('rating'))
+        return None
+
 
 class ReviewImage(models.Model):
     """Images attached to reviews"""
@@ -382,9 +569,35 @@ class Cart(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Denormalized summary, kept in sync with the cart lines by signals
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
     def __str__(self):
         return f"Cart {self.id} - {self.user.email if self.user else 'Anonymous'}"
 
+    @classmethod
+    def refresh_summaries(cls, queryset):
+        """Recompute item_count and subtotal for every cart in ``queryset`` in one UPDATE"""
+        lines = CartItem.objects.filter(cart=models.OuterRef('pk')).order_by().values('cart')
+        line_total = models.ExpressionWrapper(
+            models.F('quantity') * Coalesce('variant__price', 'product__price'),
+            output_field=models.DecimalField(max_digits=10, decimal_places=2)
+        )
+        return queryset.update(
+            item_count=Coalesce(
+                models.Subquery(lines.annotate(count=models.Count('pk')).values('count')), 0
+            ),
+            subtotal=Coalesce(
+                models.Subquery(lines.annotate(total=models.Sum(line_total)).values('total')),
+                Decimal('0.00'),
+                output_field=models.DecimalField(max_digits=10, decimal_places=2)
+            ),
+        )
+
+    def refresh_summary(self):
+        Cart.refresh_summaries(Cart.objects.filter(pk=self.pk))
+
     @property
     def total_items(self):
         return self.items.aggregate(total=models.Sum('quantity'))['total'] or 0
@@ -544,6 +757,76 @@ class Payment(models.Model):
         return f"Payment {self.checkout_request_id} - {self.status}"
 
 
+class StockReservation(models.Model):
+    """
+    Stock taken for an order awaiting payment. The stock is already off
+    ``stock_quantity``; an expired or failed hold puts it back.
+    """
+    STATUS = (
+        ('held', 'Held'),
+        ('converted', 'Converted'),
+        ('released', 'Released'),
+    )
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True)
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS, default='held')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for order {self.order_id} ({self.status})"
+
+
+def new_job_reference():
+    return uuid.uuid4().hex
+
+
+class StkPushJob(models.Model):
+    """
+    An M-Pesa STK push queued at checkout and sent by a background worker.
+    ``reference`` stands in for the CheckoutRequestID until the push is sent.
+    """
+    STATUS = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    )
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='stk_push_jobs')
+    # Deleted once the push is sent; no constraint, so deleting a cart costs no extra query
+    cart = models.ForeignKey(
+        'Cart', on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name='+'
+    )
+    reference = models.CharField(max_length=32, unique=True, default=new_job_reference)
+    phone_number = models.CharField(max_length=20)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=10, choices=STATUS, default='queued')
+    available_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    checkout_request_id = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+        ]
+
+    def __str__(self):
+        return f"STK push for order {self.order_id} ({self.status})"
+
+
 class Newsletter(models.Model):
     """Newsletter subscriptions"""
     email = models.EmailField(unique=True)
@@ -575,7 +858,8 @@ class RecentlyViewedProduct(models.Model):
     """Recently viewed products by user"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recently_viewed')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
-    viewed_at = models.DateTimeField(auto_now_add=True)
+    # Set by the view buffer to when the view happened, not when it was flushed
+    viewed_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         unique_together = ['user', 'product']
@@ -585,6 +869,66 @@ class RecentlyViewedProduct(models.Model):
         return f"{self.user.email} viewed {self.product.name}"
 
 
+class ProductRecommendation(models.Model):
+    """Precomputed neighbour of a product, written by ``rebuild_recommendations``"""
+    KINDS = (
+        ('bought', 'Frequently bought together'),
+        ('viewed', 'Customers also viewed'),
+    )
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommended_with')
+    kind = models.CharField(max_length=10, choices=KINDS)
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ['product', 'kind', 'rank']
+        ordering = ['product', 'kind', 'rank']
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.recommended_id} ({self.kind} #{self.rank})"
+
+
+class SearchEvent(models.Model):
+    """A single search, written in batches by ``search_analytics``"""
+    query = models.CharField(max_length=255)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    session_key = models.CharField(max_length=40, null=True, blank=True)
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+    searched_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.query
+
+
+class SearchQueryHourly(models.Model):
+    """Number of searches for a normalized query within one hour"""
+    query = models.CharField(max_length=255)
+    hour = models.DateTimeField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['query', 'hour']
+
+    def __str__(self):
+        return f"{self.query} @ {self.hour}: {self.count}"
+
+
+class SearchQueryDaily(models.Model):
+    """Number of searches for a normalized query within one day"""
+    query = models.CharField(max_length=255)
+    day = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['query', 'day']
+        verbose_name_plural = 'Search query dailies'
+
+    def __str__(self):
+        return f"{self.query} @ {self.day}: {self.count}"
+
+
 class SiteSetting(models.Model):
     """Site configuration settings"""
     key = models.CharField(max_length=100, unique=True)
@@ -0,0 +1,559 @@
+# mpesa.py
+"""
+The Daraja (M-Pesa) API client, ``MpesaService``, and its plumbing.
+
+Access tokens are valid for about an hour, so ``AccessTokenCache`` keeps
+the current one in the Django cache, which settings share between worker
+processes, so every request of every process finds it. A token
+is refreshed ``MPESA_TOKEN_REFRESH_MARGIN`` seconds before it expires: one
+caller fetches the new token while the others keep using the old one, which
+is still valid. Only when there is no usable token do callers wait, and then
+for the one fetch in flight rather than each making their own. A token the
+API rejects with 401 is dropped so the next caller fetches a fresh one.
+
+``DarajaTransport`` makes the HTTP calls. It keeps one pooled keep-alive
+session per base URL, so calls after the first skip the TCP and TLS
+handshakes, and uses a short connect timeout and a separate read timeout.
+Idempotent calls are retried with jittered exponential backoff on
+connection errors, timeouts and 429/5xx responses. Other calls, like the STK
+push, are retried only when the connection was never made, so a customer is
+never prompted twice. After ``MPESA_BREAKER_FAILURES`` failed calls in a
+row the circuit opens and calls fail at once with ``CircuitOpen`` for
+``MPESA_BREAKER_RESET`` seconds; then a single trial call decides whether
+it closes again. ``transport_metrics()`` reports counts and latency per
+endpoint.
+"""
+import base64
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Lifetime assumed when the token response doesn't give one
+DEFAULT_TOKEN_LIFETIME = 3599
+# A fetch in flight longer than this is presumed dead
+TOKEN_LOCK_TIMEOUT = 30
+TOKEN_WAIT_INTERVAL = 0.1
+
+# One lock per token across the service instances of this process
+_thread_locks = {}
+
+
+class AccessTokenCache:
+    """
+    Shared cache of one set of credentials' access token. ``fetch`` gets a
+    new token from the API and returns ``(token, expires_in)``.
+    """
+
+    def __init__(self, key, fetch):
+        self.key = key
+        self.lock_key = f'{key}:refreshing'
+        self.fetch = fetch
+        self._lock = _thread_locks.setdefault(key, threading.Lock())
+
+    @classmethod
+    def for_credentials(cls, base_url, consumer_key, fetch):
+        digest = hashlib.md5(f'{base_url}:{consumer_key}'.encode()).hexdigest()[:12]
+        return cls(f'mpesa_access_token:{digest}', fetch)
+
+    def get(self):
+        entry = cache.get(self.key)
+        now = time.time()
+        if entry and now < entry['refresh_at']:
+            return entry['token']
+        if entry and now < entry['expires_at']:
+            return self._refresh_ahead(entry)
+        return self._refresh_now()
+
+    def invalidate(self, token):
+        """Drop ``token`` after the API rejected it, unless it was already replaced"""
+        entry = cache.get(self.key)
+        if entry and entry['token'] == token:
+            cache.delete(self.key)
+
+    def _refresh_ahead(self, entry):
+        """Refresh a token close to expiry unless someone else is; never wait"""
+        if not self._lock.acquire(blocking=False):
+            return entry['token']
+        try:
+            if not cache.add(self.lock_key, 1, TOKEN_LOCK_TIMEOUT):
+                return entry['token']
+            try:
+                return self._store(*self.fetch())
+            except Exception as e:
+                logger.warning(f"Access token refresh failed, using the current token: {e}")
+                return entry['token']
+            finally:
+                cache.delete(self.lock_key)
+        finally:
+            self._lock.release()
+
+    def _refresh_now(self):
+        """Get a token when there is no usable one, waiting for a fetch in flight"""
+        with self._lock:
+            owned = self._wait_for_fetch()
+            try:
+                # The fetch we waited for, or one that finished as we took the lock
+                entry = cache.get(self.key)
+                if entry and time.time() < entry['expires_at']:
+                    return entry['token']
+                return self._store(*self.fetch())
+            finally:
+                if owned:
+                    cache.delete(self.lock_key)
+
+    def _wait_for_fetch(self):
+        """True once this process may fetch; False if another fetch ended or hung"""
+        deadline = time.monotonic() + TOKEN_LOCK_TIMEOUT
+        while not cache.add(self.lock_key, 1, TOKEN_LOCK_TIMEOUT):
+            entry = cache.get(self.key)
+            if entry and time.time() < entry['expires_at']:
+                return False
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(TOKEN_WAIT_INTERVAL)
+        return True
+
+    def _store(self, token, expires_in):
+        expires_in = int(expires_in or DEFAULT_TOKEN_LIFETIME)
+        margin = min(getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 300), expires_in // 2)
+        now = time.time()
+        cache.set(self.key, {
+            'token': token,
+            'refresh_at': now + expires_in - margin,
+            # Stop using a token a little before the API does
+            'expires_at': now + expires_in - min(30, margin),
+        }, expires_in)
+        logger.info(f"Cached M-Pesa access token for {expires_in}s")
+        return token
+
+
+class CircuitOpen(requests.exceptions.RequestException):
+    """Daraja failed repeatedly; calls are refused until the breaker resets"""
+
+
+class CircuitBreaker:
+    """Closed, open after ``failures`` failed calls in a row, half open after ``reset`` seconds"""
+
+    def __init__(self, failures, reset):
+        self.failures = failures
+        self.reset = reset
+        self.failed = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Whether a call may go out; in half open state only one trial call does"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failed = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+            if self.trial or self.failed >= self.failures:
+                if self.opened_at is None:
+                    logger.error(f"Daraja circuit opened after {self.failed} failed call(s)")
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class DarajaTransport:
+    """HTTP calls to one Daraja base URL; see the module docstring"""
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url, connect_timeout=None, read_timeout=None, retries=None,
+                 backoff=None, breaker_failures=None, breaker_reset=None, pool_size=None):
+        def setting(value, name, default):
+            return value if value is not None else getattr(settings, name, default)
+
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (
+            setting(connect_timeout, 'MPESA_CONNECT_TIMEOUT', 3.05),
+            setting(read_timeout, 'MPESA_READ_TIMEOUT', 20),
+        )
+        self.retries = setting(retries, 'MPESA_RETRIES', 2)
+        self.backoff = setting(backoff, 'MPESA_RETRY_BACKOFF', 0.5)
+        self.breaker = CircuitBreaker(
+            setting(breaker_failures, 'MPESA_BREAKER_FAILURES', 5),
+            setting(breaker_reset, 'MPESA_BREAKER_RESET', 30),
+        )
+        pool_size = setting(pool_size, 'MPESA_POOL_SIZE', 10)
+        self.session = requests.Session()
+        # Retries are ours, the adapter's would bypass the breaker and metrics
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.metrics = defaultdict(lambda: defaultdict(float))
+        self._metrics_lock = threading.Lock()
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, idempotent=True, **kwargs)
+
+    def post(self, path, idempotent=False, **kwargs):
+        return self.request('POST', path, idempotent=idempotent, **kwargs)
+
+    def request(self, method, path, idempotent=False, **kwargs):
+        """
+        Send ``method path`` and return the response, whatever its status.
+        Raises ``CircuitOpen`` without calling out while the breaker is open,
+        otherwise the ``requests`` exception of the last attempt.
+        """
+        endpoint = path.split('?')[0]
+        if not self.breaker.allow():
+            self._count(endpoint, 'rejected')
+            raise CircuitOpen(f"M-Pesa is unavailable, {endpoint} not called")
+
+        attempt = 0
+        while True:
+            attempt += 1
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self._count(endpoint, 'attempts', started)
+                self._count(endpoint, 'errors')
+                retry = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+                if retry and attempt <= self.retries:
+                    self._pause(endpoint, attempt, e)
+                    continue
+                self.breaker.record_failure()
+                raise
+
+            self._count(endpoint, 'attempts', started)
+            if response.status_code >= 500 or response.status_code == 429:
+                self._count(endpoint, 'server_errors')
+                if idempotent and attempt <= self.retries:
+                    self._pause(endpoint, attempt, f"HTTP {response.status_code}")
+                    continue
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return response
+
+    def _pause(self, endpoint, attempt, reason):
+        # Full jitter: concurrent callers don't retry in lockstep
+        delay = random.uniform(0, min(self.backoff * 2 ** (attempt - 1), 8))
+        logger.warning(f"Daraja {endpoint} attempt {attempt} failed ({reason}), retrying in {delay:.2f}s")
+        self._count(endpoint, 'retries')
+        time.sleep(delay)
+
+    def _count(self, endpoint, name, started=None):
+        with self._metrics_lock:
+            stats = self.metrics[endpoint]
+            stats[name] += 1
+            if started is not None:
+                stats['seconds'] += time.monotonic() - started
+
+    def snapshot(self):
+        with self._metrics_lock:
+            return {
+                endpoint: {name: round(value, 4) for name, value in stats.items()}
+                for endpoint, stats in self.metrics.items()
+            }
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(base_url):
+    """The process wide transport for ``base_url``"""
+    with _transports_lock:
+        if base_url not in _transports:
+            _transports[base_url] = DarajaTransport(base_url)
+        return _transports[base_url]
+
+
+def transport_metrics():
+    """``{base_url: {endpoint: counts}}`` for this process, with the breaker state"""
+    with _transports_lock:
+        transports = list(_transports.values())
+    return {
+        transport.base_url: {'breaker': transport.breaker.state, 'endpoints': transport.snapshot()}
+        for transport in transports
+    }
+
+
+class MpesaService:
+    def __init__(self):
+        self.consumer_key = getattr(settings, 'MPESA_CONSUMER_KEY', '')
+        self.consumer_secret = getattr(settings, 'MPESA_CONSUMER_SECRET', '')
+        self.business_shortcode = getattr(settings, 'MPESA_BUSINESS_SHORTCODE', '')
+        self.passkey = getattr(settings, 'MPESA_PASSKEY', '')
+        self.environment = getattr(settings, 'MPESA_ENVIRONMENT', 'sandbox')
+        
+        logger.info(f"M-Pesa Service initialized - Environment: {self.environment}, Shortcode: {self.business_shortcode}")
+        
+        if not all([self.consumer_key, self.consumer_secret, self.business_shortcode, self.passkey]):
+            logger.error("Missing M-Pesa configuration in settings")
+            logger.error(f"Consumer Key: {'✓' if self.consumer_key else '✗'}")
+            logger.error(f"Consumer Secret: {'✓' if self.consumer_secret else '✗'}")
+            logger.error(f"Business Shortcode: {'✓' if self.business_shortcode else '✗'}")
+            logger.error(f"Passkey: {'✓' if self.passkey else '✗'}")
+            raise ValueError("M-Pesa configuration is incomplete. Check your settings.")
+        
+        if self.environment == 'sandbox':
+            self.base_url = 'https://sandbox.safaricom.co.ke'
+        else:
+            self.base_url = 'https://api.safaricom.co.ke'
+        
+        logger.info(f"M-Pesa base URL: {self.base_url}")
+        self.transport = get_transport(self.base_url)
+        self.tokens = AccessTokenCache.for_credentials(
+            self.base_url, self.consumer_key, self.request_access_token
+        )
+    
+    def get_access_token(self):
+        """Current access token, from the shared cache unless it is due for refresh"""
+        return self.tokens.get()
+    
+    def request_access_token(self):
+        """Get a new M-Pesa access token; returns ``(token, expires_in)``"""
+        logger.info("Requesting M-Pesa access token")
+        
+        try:
+            path = "/oauth/v1/generate?grant_type=client_credentials"
+            logger.debug(f"Token URL: {self.base_url}{path}")
+            
+            # Create credentials string
+            credentials = f"{self.consumer_key}:{self.consumer_secret}"
+            encoded_credentials = base64.b64encode(credentials.encode()).decode()
+            
+            headers = {
+                'Authorization': f'Basic {encoded_credentials}',
+                'Content-Type': 'application/json'
+            }
+            
+            logger.debug(f"Token request headers (auth hidden): {{'Content-Type': 'application/json', 'Authorization': 'Basic ***'}}")
+            logger.info(f"Using consumer key: {self.consumer_key[:10]}..." if len(self.consumer_key) > 10 else f"Consumer key: {self.consumer_key}")
+            
+            response = self.transport.get(path, headers=headers)
+            
+            logger.info(f"Token response status: {response.status_code}")
+            logger.debug(f"Token response headers: {dict(response.headers)}")
+            
+            if response.status_code != 200:
+                logger.error(f"Token request failed with status {response.status_code}")
+                logger.error(f"Response body: {response.text}")
+                raise Exception(f"Token request failed: HTTP {response.status_code} - {response.text}")
+            
+            try:
+                token_data = response.json()
+                logger.debug(f"Token response data: {token_data}")
+            except json.JSONDecodeError as e:
+                logger.error(f"Invalid JSON in token response: {response.text}")
+                raise Exception(f"Invalid JSON response from token endpoint: {str(e)}")
+            
+            access_token = token_data.get('access_token')
+            
+            if not access_token:
+                logger.error(f"No access token in response: {token_data}")
+                raise Exception("No access token received from API")
+            
+            logger.info("Access token obtained successfully")
+            return access_token, token_data.get('expires_in')
+            
+        except CircuitOpen:
+            # Callers queue the work for later instead of failing it
+            raise
+        except requests.exceptions.Timeout:
+            logger.error("Token request timed out")
+            raise Exception("Token request timed out")
+        except requests.exceptions.ConnectionError as e:
+            logger.error(f"Connection error during token request: {str(e)}")
+            raise Exception(f"Connection error: {str(e)}")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Request exception during token request: {str(e)}")
+            if hasattr(e, 'response') and e.response is not None:
+                logger.error(f"Error response body: {e.response.text}")
+            raise Exception(f"Token request failed: {str(e)}")
+        except Exception as e:
+            logger.exception(f"Unexpected error getting access token: {str(e)}")
+            raise Exception(f"Failed to get access token: {str(e)}")
+    
+    def generate_password(self):
+        """Generate M-Pesa password"""
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password_string = f"{self.business_shortcode}{self.passkey}{timestamp}"
+        password = base64.b64encode(password_string.encode()).decode()
+        
+        logger.debug(f"Generated timestamp: {timestamp}")
+        logger.debug(f"Password string length: {len(password_string)}")
+        logger.debug(f"Generated password length: {len(password)}")
+        
+        return password, timestamp
+    
+    def stk_push(self, phone_number, amount, account_reference, transaction_desc):
+        """Initiate STK Push with comprehensive error handling"""
+        logger.info(f"Starting STK Push - Phone: {phone_number}, Amount: {amount}, Reference: {account_reference}")
+        
+        # Validate inputs
+        if not phone_number:
+            raise Exception("Phone number is required")
+        if not amount or amount <= 0:
+            raise Exception("Valid amount is required")
+        if not account_reference:
+            raise Exception("Account reference is required")
+        if not transaction_desc:
+            raise Exception("Transaction description is required")
+        
+        try:
+            # Get access token
+            access_token = self.get_access_token()
+            if not access_token:
+                raise Exception("Failed to get access token")
+            
+            # Generate password
+            password, timestamp = self.generate_password()
+            
+            # Prepare request
+            path = "/mpesa/stkpush/v1/processrequest"
+            logger.debug(f"STK Push URL: {self.base_url}{path}")
+            
+            headers = {
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json'
+            }
+            
+            # Ensure amount is integer
+            amount = int(float(amount))
+            
+            # Get callback URL
+            callback_url = getattr(settings, 'MPESA_CALLBACK_URL', '')
+            if not callback_url:
+                logger.warning("No callback URL configured")
+            
+            payload = {
+                'BusinessShortCode': self.business_shortcode,
+                'Password': password,
+                'Timestamp': timestamp,
+                'TransactionType': 'CustomerPayBillOnline',
+                'Amount': amount,
+                'PartyA': phone_number,
+                'PartyB': self.business_shortcode,
+                'PhoneNumber': phone_number,
+                'CallBackURL': callback_url,
+                'AccountReference': account_reference,
+                'TransactionDesc': transaction_desc
+            }
+            
+            # Log payload (hiding sensitive data)
+            safe_payload = payload.copy()
+            safe_payload['Password'] = '***'
+            logger.info(f"STK Push payload: {json.dumps(safe_payload, indent=2)}")
+            logger.debug(f"Request headers (token hidden): {{'Content-Type': 'application/json', 'Authorization': 'Bearer ***'}}")
+            
+            # Validate payload
+            required_fields = ['BusinessShortCode', 'Password', 'Timestamp', 'TransactionType', 
+                             'Amount', 'PartyA', 'PartyB', 'PhoneNumber', 'CallBackURL', 
+                             'AccountReference', 'TransactionDesc']
+            
+            for field in required_fields:
+                if not payload.get(field):
+                    logger.error(f"Missing required field: {field}")
+                    raise Exception(f"Missing required field: {field}")
+            
+            # Make request
+            logger.info("Sending STK Push request...")
+            response = self.transport.post(path, headers=headers, json=payload)
+            
+            # Token revoked or expired early: drop it and retry once with a new one
+            if response.status_code == 401:
+                logger.warning("STK Push rejected the access token, requesting a new one")
+                self.tokens.invalidate(access_token)
+                access_token = self.get_access_token()
+                headers['Authorization'] = f'Bearer {access_token}'
+                response = self.transport.post(path, headers=headers, json=payload)
+            
+            # Log response details
+            logger.info(f"STK Push response status: {response.status_code}")
+            logger.debug(f"Response headers: {dict(response.headers)}")
+            logger.info(f"Response body: {response.text}")
+            
+            # Handle non-200 responses
+            if response.status_code != 200:
+                error_msg = f"HTTP {response.status_code}"
+                try:
+                    error_data = response.json()
+                    if 'errorMessage' in error_data:
+                        error_msg += f" - {error_data['errorMessage']}"
+                    elif 'ResponseDescription' in error_data:
+                        error_msg += f" - {error_data['ResponseDescription']}"
+                    else:
+                        error_msg += f" - {response.text}"
+                except:
+                    error_msg += f" - {response.text}"
+                
+                logger.error(f"STK Push failed: {error_msg}")
+                raise Exception(f"STK Push API error: {error_msg}")
+            
+            # Parse response
+            try:
+                response_data = response.json()
+                logger.info(f"STK Push response parsed: {response_data}")
+            except json.JSONDecodeError as e:
+                logger.error(f"Invalid JSON in STK Push response: {response.text}")
+                raise Exception(f"Invalid JSON response from STK Push API: {str(e)}")
+            
+            # Check response code
+            response_code = response_data.get('ResponseCode')
+            if response_code != '0':
+                error_desc = response_data.get('ResponseDescription', 'Unknown error')
+                logger.error(f"STK Push failed - Code: {response_code}, Description: {error_desc}")
+                raise Exception(f"STK Push failed: {error_desc} (Code: {response_code})")
+            
+            logger.info("STK Push completed successfully")
+            return response_data
+            
+        except CircuitOpen:
+            # Callers queue the work for later instead of failing it
+            raise
+        except requests.exceptions.Timeout:
+            logger.error("STK Push request timed out")
+            raise Exception("STK Push request timed out")
+        except requests.exceptions.ConnectionError as e:
+            logger.error(f"Connection error during STK Push: {str(e)}")
+            raise Exception(f"Connection error: {str(e)}")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Request exception during STK Push: {str(e)}")
+            error_details = ""
+            if hasattr(e, 'response') and e.response is not None:
+                error_details = f" - Response: {e.response.text}"
+                logger.error(f"Error response body: {e.response.text}")
+            raise Exception(f"STK Push request failed: {str(e)}{error_details}")
+        except Exception as e:
+            logger.exception(f"Unexpected error during STK Push: {str(e)}")
+            raise Exception(f"STK Push failed: {str(e)}")
@@ -0,0 +1,255 @@
+# pagination.py
+"""
+Keyset (seek) pagination for catalog listings.
+
+Instead of ``OFFSET n`` every page continues from the sort key of the last
+row of the previous one (``WHERE (created_at, id) < (...)``), so a deep
+page costs the same as the first. Cursors are signed, opaque tokens that
+carry the sort key values and the ordering they belong to.
+"""
+import hashlib
+from collections.abc import Sequence
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.core.paginator import Paginator
+from django.db.models import F, Q
+from django.http import QueryDict
+
+CURSOR_SALT = 'ecommerce.pagination.cursor'
+# Estimated totals are plain COUNTs, cached per distinct query
+ESTIMATE_CACHE_TIMEOUT = 60 * 5
+
+
+def use_keyset(request):
+    """Keyset mode is on site wide via settings, or per request with ?cursor="""
+    return 'cursor' in request.GET or getattr(settings, 'CATALOG_PAGINATION', 'offset') == 'keyset'
+
+
+def paginate(request, queryset, per_page, count=None):
+    """
+    Return a keyset or a regular Django page, depending on the active mode.
+    A ``count`` the caller already knows saves the paginator its COUNT query.
+    """
+    if use_keyset(request):
+        paginator = KeysetPaginator(queryset, per_page, count=count)
+        return paginator.get_page(request.GET.get('cursor'), request)
+    return counted_paginator(queryset, per_page, count).get_page(request.GET.get('page'))
+
+
+def counted_paginator(queryset, per_page, count=None, **kwargs):
+    """Django paginator, with ``count`` preset when it is known"""
+    paginator = Paginator(queryset, per_page, **kwargs)
+    if count is not None:
+        # count is a cached_property, setting it skips the query
+        paginator.count = count
+    return paginator
+
+
+def page_total(page):
+    """Total number of results for either kind of page"""
+    if getattr(page, 'is_keyset', False):
+        return page.estimated_total
+    return page.paginator.count
+
+
+def estimated_count(queryset, timeout=ESTIMATE_CACHE_TIMEOUT):
+    """COUNT(*) of ``queryset``, reused for ``timeout`` seconds across requests"""
+    queryset = queryset.order_by()
+    try:
+        key = 'keyset_count:' + hashlib.md5(str(queryset.query).encode()).hexdigest()
+    except EmptyResultSet:
+        return 0
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+class KeysetPage(Sequence):
+    """A page of results that knows its neighbours by cursor, not by number"""
+    is_keyset = True
+    number = None
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None, request=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.request = request
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __repr__(self):
+        return f'<KeysetPage of {len(self)} items>'
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def estimated_total(self):
+        if self.paginator.count is not None:
+            return self.paginator.count
+        return estimated_count(self.paginator.queryset)
+
+    def _url(self, cursor):
+        params = self.request.GET.copy() if self.request else QueryDict(mutable=True)
+        params.pop('page', None)
+        params['cursor'] = cursor
+        return '?' + params.urlencode()
+
+    @property
+    def next_url(self):
+        return self._url(self.next_cursor) if self.has_next() else None
+
+    @property
+    def previous_url(self):
+        return self._url(self.previous_cursor) if self.has_previous() else None
+
+
+class KeysetPaginator:
+    """
+    Paginates ``queryset`` by its ordering. ``id`` is appended as a tie
+    breaker when the ordering is not already unique. The ordering must be
+    plain field or annotation names; rows with NULL in a sort key come
+    last whatever the direction, so every backend seeks the same way.
+    """
+
+    def __init__(self, queryset, per_page, count=None):
+        self.per_page = int(per_page)
+        self.count = count
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        for field in ordering:
+            if not isinstance(field, str) or field == '?' or '__' in field:
+                raise ValueError(f"Keyset pagination can't seek on the ordering {field!r}")
+        if not any(field.lstrip('-') in ('id', 'pk') for field in ordering):
+            ordering.append('id')
+        self.ordering = ordering
+        self.nullable = {
+            field.lstrip('-') for field in ordering if self._is_nullable(queryset, field.lstrip('-'))
+        }
+        self.queryset = queryset.order_by(*self._order_by(reverse=False))
+
+    @staticmethod
+    def _is_nullable(queryset, name):
+        if name == 'pk':
+            return False
+        try:
+            return queryset.model._meta.get_field(name).null
+        except FieldDoesNotExist:
+            # An annotation, it may be NULL
+            return True
+
+    def _order_by(self, reverse):
+        """The ordering as expressions, NULLs last (first when reversed)"""
+        order_by = []
+        for field in self.ordering:
+            name = field.lstrip('-')
+            descending = field.startswith('-') != reverse
+            if name not in self.nullable:
+                order_by.append(f'-{name}' if descending else name)
+            else:
+                nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+                order_by.append(F(name).desc(**nulls) if descending else F(name).asc(**nulls))
+        return order_by
+
+    def _encode(self, row, direction):
+        values = [self._value(row, field.lstrip('-')) for field in self.ordering]
+        return signing.dumps(
+            {'o': self.ordering, 'd': direction, 'v': values}, salt=CURSOR_SALT, compress=True
+        )
+
+    def _value(self, row, name):
+        value = getattr(row, name)
+        # Keep full precision; to_python() restores the type when decoding
+        if isinstance(value, (datetime, date, time)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
+
+    def _decode(self, cursor):
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            return None, None
+        if data.get('o') != self.ordering or data.get('d') not in ('next', 'prev'):
+            # Cursor from another sort order, start over
+            return None, None
+        values = []
+        for field, value in zip(self.ordering, data['v']):
+            name = field.lstrip('-')
+            try:
+                value = self.queryset.model._meta.get_field(name).to_python(value)
+            except FieldDoesNotExist:
+                pass
+            values.append(value)
+        return data['d'], values
+
+    def _seek(self, values, forward):
+        """
+        Rows strictly after (or before) ``values`` in the ordering:
+        (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z) ...
+        NULLs sort after every value, so they come "after" a value and
+        nothing but NULL equals a NULL.
+        """
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            descending = field.startswith('-')
+            lookup = 'lt' if descending == forward else 'gt'
+            if value is None:
+                if not forward:
+                    condition |= equal & Q(**{f'{name}__isnull': False})
+                equal &= Q(**{f'{name}__isnull': True})
+                continue
+            beyond = Q(**{f'{name}__{lookup}': value})
+            if forward and name in self.nullable:
+                beyond |= Q(**{f'{name}__isnull': True})
+            condition |= equal & beyond
+            equal &= Q(**{name: value})
+        return condition
+
+    def get_page(self, cursor=None, request=None):
+        direction, values = self._decode(cursor) if cursor else (None, None)
+
+        if direction == 'prev':
+            rows = list(
+                self.queryset.filter(self._seek(values, forward=False))
+                .order_by(*self._order_by(reverse=True))[:self.per_page + 1]
+            )
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            has_next = True
+        else:
+            queryset = self.queryset
+            if values is not None:
+                queryset = queryset.filter(self._seek(values, forward=True))
+            rows = list(queryset[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_previous = values is not None
+
+        return KeysetPage(
+            rows,
+            self,
+            next_cursor=self._encode(rows[-1], 'next') if has_next and rows else None,
+            previous_cursor=self._encode(rows[0], 'prev') if has_previous and rows else None,
+            request=request,
+        )
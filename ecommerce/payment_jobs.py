@@ -0,0 +1,264 @@
+# payment_jobs.py
+"""
+STK pushes sent in the background, so checkout doesn't wait on Daraja.
+
+Checkout takes the stock, holds it with ``inventory.reserve`` and queues a
+``StkPushJob`` in the order's transaction, then answers at once with the
+job's ``reference``. The customer's page polls ``check_payment_status``
+with that reference until the push was sent, then with the order's
+CheckoutRequestID until the callback arrives.
+
+Jobs are handed to a small thread pool in the web process when the order
+commits (``STK_PUSH_THREADS``, 0 to turn it off), and the
+``run_stk_push_worker`` command picks up whatever the pool didn't: jobs of
+a process that died, or all of them when the pool is off. The command
+never starts a pool of its own. A job is claimed with a conditional UPDATE,
+so both can run side by side without sending a push twice. A push refused by the open Daraja circuit breaker puts its job
+back in the queue for the breaker's reset period, and a timer hands the
+deferred jobs back to the pool once they are due.
+
+A push that fails cancels the order and releases its stock; the cart is
+kept so the customer can try again, and is deleted once a push was sent.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.urls import reverse
+from django.utils import timezone
+
+from . import inventory
+from .models import Cart, Order, Payment, StkPushJob
+from .mpesa import CircuitOpen, MpesaService
+
+logger = logging.getLogger(__name__)
+
+# A job running this long belonged to a worker that died mid-push
+STALE_AFTER = timedelta(minutes=2)
+
+# Deferred jobs handed back to the pool per timer run
+RETRY_BATCH = 100
+
+_executor = None
+# Off in the worker command, which runs the jobs itself
+_pool_enabled = True
+_retry_timer = None
+_retry_when = None
+_retry_lock = threading.Lock()
+
+
+def enqueue(order, phone_number, cart=None):
+    """Queue the STK push for ``order``; sent once the current transaction commits"""
+    job = StkPushJob.objects.create(
+        order=order, cart=cart, phone_number=phone_number, amount=order.total_amount
+    )
+    transaction.on_commit(lambda: submit(job.id))
+    return job
+
+
+def pool_threads():
+    """Size of this process' pool; 0 when it is off"""
+    return getattr(settings, 'STK_PUSH_THREADS', 4) if _pool_enabled else 0
+
+
+def disable_pool():
+    """Stop handing jobs to the pool, for processes that poll for jobs instead"""
+    global _pool_enabled
+    _pool_enabled = False
+
+
+def submit(job_id):
+    """Run the job on the in-process pool, if there is one"""
+    global _executor
+    threads = pool_threads()
+    if not threads:
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='stk-push')
+    _executor.submit(_run_in_thread, job_id)
+
+
+def _run_in_thread(job_id):
+    try:
+        run_job(job_id)
+    except Exception:
+        logger.exception(f"STK push job {job_id} crashed")
+    finally:
+        connection.close()
+
+
+def _retry_at(when):
+    """Submit the jobs due at ``when`` to the pool, unless an earlier retry is armed"""
+    global _retry_timer, _retry_when
+    if not pool_threads():
+        return
+    with _retry_lock:
+        if _retry_timer is not None:
+            if _retry_when <= when:
+                # It re-arms for the later jobs when it runs
+                return
+            _retry_timer.cancel()
+        delay = max((when - timezone.now()).total_seconds(), 0)
+        _retry_timer, _retry_when = threading.Timer(delay, _submit_deferred), when
+        _retry_timer.daemon = True
+        _retry_timer.start()
+
+
+def _submit_deferred():
+    global _retry_timer
+    try:
+        with _retry_lock:
+            _retry_timer = None
+        due = due_jobs(RETRY_BATCH)
+        for job_id in due:
+            submit(job_id)
+        if len(due) == RETRY_BATCH:
+            next_at = timezone.now()
+        else:
+            next_at = StkPushJob.objects.filter(
+                status='queued', available_at__gt=timezone.now()
+            ).order_by('available_at').values_list('available_at', flat=True).first()
+        if next_at:
+            _retry_at(next_at)
+    except Exception:
+        logger.exception("Resubmitting deferred STK push jobs failed")
+    finally:
+        connection.close()
+
+
+def claim(job_id):
+    """Take a queued job that is due; False when someone else has it"""
+    now = timezone.now()
+    return StkPushJob.objects.filter(
+        id=job_id, status='queued', available_at__lte=now
+    ).update(status='running', started_at=now, updated_at=now) == 1
+
+
+def run_job(job_id):
+    """Send one queued STK push. Returns True when this call processed the job."""
+    if not claim(job_id):
+        return False
+
+    job = StkPushJob.objects.select_related('order').get(id=job_id)
+    order = job.order
+    if order.status != 'pending':
+        fail(job, f"Order is {order.status}")
+        return True
+
+    try:
+        service = MpesaService()
+    except Exception as e:
+        logger.error(f"STK push for order {order.order_number} failed: {e}")
+        fail(job, str(e))
+        return True
+
+    try:
+        response = service.stk_push(
+            phone_number=job.phone_number,
+            amount=int(job.amount),
+            account_reference="Galio",
+            transaction_desc=f"Payment for {order.order_number}"
+        )
+    except CircuitOpen:
+        # Nothing was sent; leave it queued until the breaker lets a trial call through
+        defer(job, service.transport.breaker.reset)
+        return False
+    except Exception as e:
+        logger.error(f"STK push for order {order.order_number} failed: {e}")
+        fail(job, str(e))
+        return True
+
+    if response.get('ResponseCode') != '0':
+        fail(job, response.get('ResponseDescription', 'Unknown error'))
+        return True
+
+    sent(job, response)
+    return True
+
+
+def sent(job, response):
+    checkout_request_id = response.get('CheckoutRequestID')
+    with transaction.atomic():
+        Payment.objects.create(
+            order=job.order,
+            checkout_request_id=checkout_request_id,
+            status="PENDING",
+            raw_response=response
+        )
+        job.status = 'sent'
+        job.checkout_request_id = checkout_request_id
+        job.save(update_fields=['status', 'checkout_request_id', 'updated_at'])
+        if job.cart_id:
+            Cart.objects.filter(id=job.cart_id).delete()
+
+    cache.set(f"payment_status_{checkout_request_id}", {
+        'status': 'PENDING',
+        'order_number': job.order.order_number,
+        'message': 'Payment initiated. Waiting for user to enter PIN...'
+    }, timeout=600)
+    logger.info(f"STK Push sent for order {job.order.order_number}. CheckoutRequestID: {checkout_request_id}")
+
+
+def defer(job, delay):
+    """Put a claimed job back in the queue for ``delay`` seconds"""
+    now = timezone.now()
+    available_at = now + timedelta(seconds=delay)
+    StkPushJob.objects.filter(id=job.id, status='running').update(
+        status='queued', available_at=available_at, started_at=None, updated_at=now
+    )
+    _retry_at(available_at)
+
+
+def fail(job, error):
+    """Record the failure, cancel the order if still unpaid and give its stock back"""
+    now = timezone.now()
+    with transaction.atomic():
+        job.status = 'failed'
+        job.error = error
+        job.save(update_fields=['status', 'error', 'updated_at'])
+        if Order.objects.filter(id=job.order_id, status='pending').update(
+            status='cancelled', payment_status='failed', updated_at=now
+        ):
+            inventory.release_order(job.order)
+
+
+def fail_stale_jobs():
+    """
+    Fail jobs whose worker died mid-push. Whether the push went out is
+    unknown, so the order is left for the reservation expiry, and a late
+    success callback still takes the stock again.
+    """
+    return StkPushJob.objects.filter(
+        status='running', started_at__lt=timezone.now() - STALE_AFTER
+    ).update(status='failed', error='The worker stopped while sending the push', updated_at=timezone.now())
+
+
+def due_jobs(limit):
+    return list(StkPushJob.objects.filter(
+        status='queued', available_at__lte=timezone.now()
+    ).order_by('available_at', 'id').values_list('id', flat=True)[:limit])
+
+
+def find(reference):
+    """The job behind a ``check_payment_status`` reference, or None for a CheckoutRequestID"""
+    return StkPushJob.objects.filter(reference=reference).only(
+        'status', 'checkout_request_id', 'error'
+    ).first()
+
+
+def poll_status(job):
+    """``check_payment_status`` payload of a job that hasn't sent its push"""
+    if job.status == 'failed':
+        return {
+            'status': 'FAILED',
+            'message': f"Payment initialization failed: {job.error}",
+            'redirect_url': reverse('checkout')
+        }
+    return {
+        'status': 'PENDING',
+        'message': 'Sending the payment request to your phone...'
+    }
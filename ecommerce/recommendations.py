@@ -0,0 +1,193 @@
+# recommendations.py
+"""
+Item to item recommendations precomputed from orders and views.
+
+A basket is the products of one order ("bought together") or the products
+one user or session has viewed ("viewed together"). The baskets form a
+sparse basket x product incidence matrix X; X.T @ X counts how many baskets
+each pair of products shares. Counts are normalized to cosine similarity,
+so best sellers don't become everybody's neighbour, and the top
+``RECOMMENDATION_TOP_K`` neighbours of every product are stored in
+``ProductRecommendation``. A product page then reads its neighbours with
+one query on the ``(product, kind, rank)`` index.
+
+SciPy does the matrix work when it is installed; otherwise the same counts
+are accumulated pair by pair in Python, which is fine for small catalogs.
+``rebuild_recommendations`` runs the job.
+"""
+import heapq
+import logging
+import math
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+from django.utils import timezone
+
+from .models import OrderItem, Product, ProductRecommendation, ProductView, RecentlyViewedProduct
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+logger = logging.getLogger(__name__)
+
+# Baskets above this size (bulk orders, crawlers) say little about pairs
+MAX_BASKET_SIZE = 50
+WRITE_BATCH_SIZE = 1000
+
+
+def top_k():
+    return getattr(settings, 'RECOMMENDATION_TOP_K', 12)
+
+
+def order_baskets():
+    """``(order_id, product_id)`` of every order that wasn't cancelled or refunded"""
+    return OrderItem.objects.exclude(
+        order__status__in=['cancelled', 'refunded']
+    ).values_list('order_id', 'product_id').distinct()
+
+
+def view_baskets():
+    """``(viewer, product_id)`` of recent views; a viewer is a user or a session"""
+    days = getattr(settings, 'RECOMMENDATION_VIEW_DAYS', 90)
+    since = timezone.now() - timedelta(days=days)
+    for user_id, session_key, product_id in ProductView.objects.filter(
+        viewed_at__gte=since
+    ).values_list('user_id', 'session_key', 'product_id'):
+        if user_id:
+            yield ('user', user_id), product_id
+        elif session_key:
+            yield ('session', session_key), product_id
+    for user_id, product_id in RecentlyViewedProduct.objects.filter(
+        viewed_at__gte=since
+    ).values_list('user_id', 'product_id'):
+        yield ('user', user_id), product_id
+
+
+def group_baskets(pairs):
+    """Distinct products per basket, dropping baskets with one or too many products"""
+    baskets = defaultdict(set)
+    for basket, product_id in pairs:
+        baskets[basket].add(product_id)
+    return [items for items in baskets.values() if 1 < len(items) <= MAX_BASKET_SIZE]
+
+
+def neighbours(baskets, k):
+    """``{product_id: [(neighbour_id, similarity), ...]}``, best first"""
+    if not baskets:
+        return {}
+    if sparse is not None:
+        return _sparse_neighbours(baskets, k)
+    return _python_neighbours(baskets, k)
+
+
+def _sparse_neighbours(baskets, k):
+    product_ids = np.array(sorted({product_id for items in baskets for product_id in items}))
+    rows = np.repeat(np.arange(len(baskets)), [len(items) for items in baskets])
+    columns = np.searchsorted(product_ids, np.fromiter(
+        (product_id for items in baskets for product_id in items), dtype=product_ids.dtype, count=len(rows)
+    ))
+    incidence = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, columns)),
+        shape=(len(baskets), len(product_ids))
+    )
+
+    # Pair counts, then cosine: c_ij / sqrt(n_i * n_j)
+    counts = (incidence.T @ incidence).tocsr()
+    norms = 1 / np.sqrt(counts.diagonal())
+    counts.setdiag(0)
+    counts.eliminate_zeros()
+    scaled = sparse.diags(norms) @ counts @ sparse.diags(norms)
+    scaled = scaled.tocsr()
+
+    result = {}
+    for row in range(scaled.shape[0]):
+        start, end = scaled.indptr[row], scaled.indptr[row + 1]
+        if start == end:
+            continue
+        scores = scaled.data[start:end]
+        columns = scaled.indices[start:end]
+        # Highest score first, ties by product ID
+        order = np.lexsort((product_ids[columns], -scores))[:k]
+        result[int(product_ids[row])] = [
+            (int(product_ids[columns[i]]), float(scores[i])) for i in order
+        ]
+    return result
+
+
+def _python_neighbours(baskets, k):
+    occurrences = Counter()
+    pairs = defaultdict(Counter)
+    for items in baskets:
+        items = sorted(items)
+        occurrences.update(items)
+        for position, product_id in enumerate(items):
+            for other_id in items[position + 1:]:
+                pairs[product_id][other_id] += 1
+                pairs[other_id][product_id] += 1
+
+    result = {}
+    for product_id, shared in pairs.items():
+        scored = [
+            (other_id, count / math.sqrt(occurrences[product_id] * occurrences[other_id]))
+            for other_id, count in shared.items()
+        ]
+        result[product_id] = heapq.nsmallest(k, scored, key=lambda pair: (-pair[1], pair[0]))
+    return result
+
+
+def rebuild(k=None):
+    """Recompute every product's neighbours. Returns the number of rows written."""
+    k = k or top_k()
+    rows = []
+    for kind, pairs in (('bought', order_baskets()), ('viewed', view_baskets())):
+        for product_id, similar in neighbours(group_baskets(pairs), k).items():
+            rows += [
+                ProductRecommendation(
+                    product_id=product_id, recommended_id=other_id, kind=kind, rank=rank, score=score
+                )
+                for rank, (other_id, score) in enumerate(similar, start=1)
+            ]
+
+    with transaction.atomic():
+        ProductRecommendation.objects.all().delete()
+        # Skip products deleted while the job was running
+        existing = set(Product.objects.values_list('id', flat=True))
+        rows = [row for row in rows if row.product_id in existing and row.recommended_id in existing]
+        ProductRecommendation.objects.bulk_create(rows, batch_size=WRITE_BATCH_SIZE)
+    logger.info(f"Stored {len(rows)} product recommendation(s)")
+    return len(rows)
+
+
+def recommended_products(product, kind, limit):
+    """Active neighbours of ``product`` of the given kind, best first, in one query"""
+    return Product.objects.filter(
+        recommended_with__product=product, recommended_with__kind=kind, status='active'
+    ).select_related('category', 'brand').prefetch_related('images').order_by(
+        'recommended_with__rank'
+    )[:limit]
+
+
+def similar_products(product, limit):
+    """Same category products, the same brand first, then by popularity"""
+    queryset = Product.objects.filter(
+        category_id=product.category_id, status='active'
+    ).exclude(id=product.id).prefetch_related('images')
+    if product.brand_id:
+        queryset = queryset.annotate(same_brand=Case(
+            When(brand_id=product.brand_id, then=Value(1)), default=Value(0), output_field=IntegerField()
+        )).order_by('-same_brand', '-sales_count', '-view_count')
+    else:
+        queryset = queryset.order_by('-sales_count', '-view_count')
+    return queryset[:limit]
+
+
+def recommendations_for(product, kind, limit):
+    """Precomputed neighbours, or similar products until the job has data for ``product``"""
+    products = list(recommended_products(product, kind, limit))
+    return products or list(similar_products(product, limit))
@@ -0,0 +1,187 @@
+# search_analytics.py
+"""
+Search event store and trending searches.
+
+``record_search`` only appends to an in-process buffer. A background thread
+bulk inserts the buffer into ``SearchEvent`` every
+``SEARCH_ANALYTICS_FLUSH_INTERVAL`` seconds (or once
+``SEARCH_ANALYTICS_MAX_PENDING`` searches are waiting), and every
+``SEARCH_ANALYTICS_ROLLUP_INTERVAL`` seconds rolls the recent events up into
+the hourly and daily count tables. The rollup then recomputes the trending
+terms, a time decayed sum of the hourly counts, and caches them, so pages
+showing trending searches never aggregate or write anything.
+
+Rollups recompute whole hours and days from the rows below them, so running
+them again (or from several processes, or from ``rollup_search_analytics``
+under cron) is harmless.
+"""
+import atexit
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate, TruncHour
+from django.utils import timezone
+
+from .models import SearchEvent, SearchQueryDaily, SearchQueryHourly, User
+from .search_cache import normalize_search_query
+from .write_buffer import WriteBuffer
+
+logger = logging.getLogger(__name__)
+
+TRENDING_CACHE_KEY = 'trending_searches'
+TRENDING_LIMIT = 10
+# Hours re-aggregated by a rollup, enough to absorb late flushes
+ROLLUP_LOOKBACK_HOURS = 2
+QUERY_MAX_LENGTH = 255
+
+
+class SearchEventBuffer(WriteBuffer):
+    """Accumulates searches in memory and writes them in batches"""
+    thread_name = 'search-event-flusher'
+    description = 'search events'
+
+    def __init__(self, flush_interval=None, max_pending=None, rollup_interval=None):
+        super().__init__(
+            flush_interval or getattr(settings, 'SEARCH_ANALYTICS_FLUSH_INTERVAL', 10),
+            max_pending or getattr(settings, 'SEARCH_ANALYTICS_MAX_PENDING', 500),
+        )
+        self.rollup_interval = rollup_interval or getattr(settings, 'SEARCH_ANALYTICS_ROLLUP_INTERVAL', 60 * 5)
+        self._last_rollup = time.monotonic()
+        self.events = []
+
+    def record(self, query, user_id=None, session_key=None, ip_address=None):
+        """Buffer one search; never touches the database"""
+        with self._lock:
+            self.events.append(SearchEvent(
+                query=query, user_id=user_id, session_key=session_key,
+                ip_address=ip_address, searched_at=timezone.now(),
+            ))
+            full = len(self.events) >= self.max_pending
+        self._recorded(full)
+
+    def after_flush(self):
+        if time.monotonic() - self._last_rollup >= self.rollup_interval:
+            self._last_rollup = time.monotonic()
+            rollup()
+
+    def _restore(self, events):
+        """Put a batch that failed to write back in front of the newer searches"""
+        with self._lock:
+            if self._backlog_full(len(self.events) + len(events)):
+                logger.error(f"Dropping {len(events)} search events, the backlog is full")
+                return
+            self.events = events + self.events
+
+    def flush(self):
+        """Write all buffered searches. Returns the number written."""
+        with self._lock:
+            events, self.events = self.events, []
+        if not events:
+            return 0
+
+        try:
+            # Users deleted since they searched are left out, as SET_NULL would
+            user_ids = set(User.objects.filter(
+                id__in={event.user_id for event in events if event.user_id is not None}
+            ).values_list('id', flat=True))
+            for event in events:
+                if event.user_id not in user_ids:
+                    event.user_id = None
+            SearchEvent.objects.bulk_create(events)
+        except Exception:
+            # Retried with the next flush
+            self._restore(events)
+            raise
+        return len(events)
+
+
+event_buffer = SearchEventBuffer()
+atexit.register(event_buffer.flush_on_exit)
+
+
+def record_search(query, user_id=None, session_key=None, ip_address=None):
+    """Queue a search for the event store; blank queries are ignored"""
+    query = normalize_search_query(query)[:QUERY_MAX_LENGTH]
+    if query:
+        event_buffer.record(query, user_id=user_id, session_key=session_key, ip_address=ip_address)
+
+
+def _upsert(model, rows, period):
+    model.objects.bulk_create(
+        [model(query=row['query'], count=row['count'], **{period: row[period]}) for row in rows],
+        update_conflicts=True, unique_fields=['query', period], update_fields=['count'],
+    )
+
+
+def rollup(since=None):
+    """
+    Re-aggregate the events since ``since`` (default: the last couple of
+    hours) into hourly counts, and those into daily counts, then refresh
+    the cached trending terms
+    """
+    if since is None:
+        since = timezone.now() - timedelta(hours=ROLLUP_LOOKBACK_HOURS)
+    first_hour = since.replace(minute=0, second=0, microsecond=0)
+    first_day = timezone.localtime(first_hour).replace(hour=0)
+
+    with transaction.atomic():
+        hourly = SearchEvent.objects.filter(searched_at__gte=first_hour).annotate(
+            hour=TruncHour('searched_at')
+        ).values('query', 'hour').annotate(count=Count('id')).order_by()
+        _upsert(SearchQueryHourly, hourly, 'hour')
+
+        daily = SearchQueryHourly.objects.filter(hour__gte=first_day).annotate(
+            day=TruncDate('hour')
+        ).values('query', 'day').annotate(count=Sum('count')).order_by()
+        _upsert(SearchQueryDaily, daily, 'day')
+
+    return refresh_trending()
+
+
+def prune():
+    """Drop raw events and hourly counts past their retention"""
+    now = timezone.now()
+    event_days = getattr(settings, 'SEARCH_EVENT_RETENTION_DAYS', 30)
+    hourly_days = getattr(settings, 'SEARCH_HOURLY_RETENTION_DAYS', 14)
+    events, _ = SearchEvent.objects.filter(searched_at__lt=now - timedelta(days=event_days)).delete()
+    hours, _ = SearchQueryHourly.objects.filter(hour__lt=now - timedelta(days=hourly_days)).delete()
+    return events, hours
+
+
+def compute_trending(limit=TRENDING_LIMIT, now=None):
+    """
+    Queries ranked by hourly counts decayed exponentially with age, so a
+    burst this morning outranks a bigger one last week
+    """
+    now = now or timezone.now()
+    half_life = getattr(settings, 'TRENDING_HALF_LIFE_HOURS', 12)
+    window = getattr(settings, 'TRENDING_WINDOW_HOURS', 24 * 3)
+
+    scores = {}
+    for query, hour, count in SearchQueryHourly.objects.filter(
+        hour__gte=now - timedelta(hours=window)
+    ).values_list('query', 'hour', 'count'):
+        age = max((now - hour).total_seconds() / 3600, 0)
+        scores[query] = scores.get(query, 0) + count * 0.5 ** (age / half_life)
+    return sorted(scores, key=lambda query: (-scores[query], query))[:limit]
+
+
+def refresh_trending():
+    trending = compute_trending()
+    # Expires on its own if rollups stop, so stale terms don't stay up forever
+    cache.set(TRENDING_CACHE_KEY, trending, getattr(settings, 'TRENDING_CACHE_TIMEOUT', 60 * 15))
+    return trending
+
+
+def get_trending_searches():
+    """Trending terms as of the last rollup"""
+    trending = cache.get(TRENDING_CACHE_KEY)
+    if trending is None:
+        # Cold or expired cache: one read of the rollups, no database write
+        trending = refresh_trending()
+    return trending
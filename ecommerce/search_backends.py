@@ -0,0 +1,242 @@
+# search_backends.py
+"""
+Pluggable full text search backends.
+
+``SEARCH_BACKEND`` picks the implementation used by ``ProductSearchView``,
+``search_filters`` and ``search_autocomplete``:
+
+* ``memory``      in-process BM25 index (``search_index``), the default
+* ``sqlite_fts``  an FTS5 virtual table next to the product table
+* ``postgres``    a weighted ``tsvector`` side table with a GIN index
+
+The database backed indexes are kept in step by ``signals.py`` inside the
+writing transaction, and can be (re)built with ``rebuild_search_index``.
+Autocomplete is served from the in-memory prefix index by every backend,
+so a keystroke never reaches the database.
+"""
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from . import autocomplete, search_index
+from .models import Product
+from .search_index import TOKEN_RE, popularity_boost
+
+# Products re-indexed per statement, well under SQLite's bound variable limit
+UPDATE_BATCH_SIZE = 500
+
+
+def query_terms(query):
+    """Alphanumeric terms of ``query``, safe to splice into a match expression"""
+    return TOKEN_RE.findall(query.lower())
+
+
+def search_limit(limit):
+    return getattr(settings, 'SEARCH_MAX_RESULTS', 1000) if limit is None else limit
+
+
+class SearchBackend:
+    """Base class: ranks product IDs for a query and keeps its index current"""
+
+    def search(self, query, limit=None):
+        """IDs of the active products matching ``query``, best first"""
+        raise NotImplementedError
+
+    def suggest(self, query):
+        """Autocomplete entries for ``query``"""
+        return autocomplete.suggest(query)
+
+    def setup(self):
+        """Create whatever storage the backend needs"""
+
+    def update(self, product_ids):
+        """Re-index ``product_ids``; deleted or inactive products are dropped"""
+
+    def rebuild(self):
+        """Re-index the whole catalog"""
+
+
+class InMemoryBackend(SearchBackend):
+    """Per-process BM25 index, synced through the search change log"""
+
+    def search(self, query, limit=None):
+        return search_index.search(query, search_limit(limit))
+
+
+class DatabaseBackend(SearchBackend):
+    """Shared plumbing of the backends that keep their index in the database"""
+    table = None
+
+    def __init__(self):
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def ensure_setup(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    self.setup()
+                    self._ready = True
+
+    def update(self, product_ids):
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        self.ensure_setup()
+        with connection.cursor() as cursor:
+            for start in range(0, len(product_ids), UPDATE_BATCH_SIZE):
+                batch = product_ids[start:start + UPDATE_BATCH_SIZE]
+                self._delete(cursor, batch)
+                self._insert(cursor, Product.objects.filter(id__in=batch))
+
+    def rebuild(self):
+        self.ensure_setup()
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            self._insert(cursor, Product.objects.all())
+
+    def search(self, query, limit=None):
+        terms = query_terms(query)
+        if not terms:
+            return []
+        self.ensure_setup()
+        limit = search_limit(limit)
+        with connection.cursor() as cursor:
+            rows = self._match(cursor, terms, limit)
+
+        # Relevance first, nudged by the same popularity factor as the memory index
+        popularity = dict(
+            (product_id, popularity_boost(sales, views)) for product_id, sales, views
+            in Product.objects.filter(id__in=[row[0] for row in rows]).values_list(
+                'id', 'sales_count', 'view_count'
+            )
+        )
+        scores = {
+            product_id: score * popularity[product_id]
+            for product_id, score in rows if product_id in popularity
+        }
+        return sorted(scores, key=lambda product_id: (-scores[product_id], product_id))
+
+    def _delete(self, cursor, product_ids):
+        raise NotImplementedError
+
+    def _insert(self, cursor, products):
+        raise NotImplementedError
+
+    def _match(self, cursor, terms, limit):
+        """``[(product_id, score), ...]``, higher scores being better"""
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(DatabaseBackend):
+    """FTS5 virtual table keyed by product ID, ranked with column weighted bm25()"""
+    table = 'ecommerce_product_fts'
+    # name, sku, brand, category, short_description, description
+    weights = (3.0, 3.0, 2.0, 2.0, 1.0, 1.0)
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5('
+                'name, sku, brand, category, short_description, description, '
+                "tokenize='porter unicode61')"
+            )
+
+    def _delete(self, cursor, product_ids):
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        cursor.execute(f'DELETE FROM {self.table} WHERE rowid IN ({placeholders})', product_ids)
+
+    def _insert(self, cursor, products):
+        sql, params = products.filter(status='active').values_list(
+            'id', 'name', 'sku', 'brand__name', 'category__name', 'short_description', 'description'
+        ).order_by().query.sql_with_params()
+        cursor.execute(
+            f'INSERT INTO {self.table} '
+            '(rowid, name, sku, brand, category, short_description, description) ' + sql,
+            params
+        )
+
+    def _match(self, cursor, terms, limit):
+        # Every term as a prefix, any of them may match
+        expression = ' OR '.join(f'"{term}"*' for term in terms)
+        weights = ', '.join(str(weight) for weight in self.weights)
+        cursor.execute(
+            f'SELECT rowid, -bm25({self.table}, {weights}) FROM {self.table} '
+            f'WHERE {self.table} MATCH %s ORDER BY bm25({self.table}, {weights}) LIMIT %s',
+            [expression, limit]
+        )
+        return cursor.fetchall()
+
+
+class PostgresBackend(DatabaseBackend):
+    """``tsvector`` side table built with ``SearchVector`` and served by a GIN index"""
+    table = 'ecommerce_product_search'
+
+    @property
+    def config(self):
+        return getattr(settings, 'SEARCH_POSTGRES_CONFIG', 'english')
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'product_id integer PRIMARY KEY REFERENCES ecommerce_product (id) '
+                'ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+                'document tsvector NOT NULL)'
+            )
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table}_document_gin '
+                f'ON {self.table} USING gin (document)'
+            )
+
+    def _delete(self, cursor, product_ids):
+        cursor.execute(f'DELETE FROM {self.table} WHERE product_id = ANY(%s)', [product_ids])
+
+    def _insert(self, cursor, products):
+        from django.contrib.postgres.search import SearchVector
+
+        document = (
+            SearchVector('name', 'sku', weight='A', config=self.config)
+            + SearchVector('brand__name', 'category__name', weight='B', config=self.config)
+            + SearchVector('short_description', weight='C', config=self.config)
+            + SearchVector('description', weight='D', config=self.config)
+        )
+        sql, params = products.filter(status='active').annotate(
+            document=document
+        ).values_list('id', 'document').order_by().query.sql_with_params()
+        cursor.execute(f'INSERT INTO {self.table} (product_id, document) ' + sql, params)
+
+    def _match(self, cursor, terms, limit):
+        expression = ' | '.join(f'{term}:*' for term in terms)
+        cursor.execute(
+            f'SELECT product_id, ts_rank(document, query) '
+            f'FROM {self.table}, to_tsquery(%s::regconfig, %s) query '
+            f'WHERE document @@ query ORDER BY 2 DESC LIMIT %s',
+            [self.config, expression, limit]
+        )
+        return cursor.fetchall()
+
+
+BACKENDS = {
+    'memory': InMemoryBackend,
+    'sqlite_fts': SQLiteFTSBackend,
+    'postgres': PostgresBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend():
+    """The configured backend; ``SEARCH_BACKEND`` is a name above or a dotted path"""
+    name = getattr(settings, 'SEARCH_BACKEND', 'memory')
+    backend = _backends.get(name)
+    if backend is None:
+        with _backends_lock:
+            if name not in _backends:
+                backend_class = BACKENDS[name] if name in BACKENDS else import_string(name)
+                _backends[name] = backend_class()
+            backend = _backends[name]
+    return backend
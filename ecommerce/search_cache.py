@@ -0,0 +1,109 @@
+# search_cache.py
+"""
+Shared cache of search results.
+
+Entries are keyed by the normalized query plus the canonical filters and
+sort order, and hold what a result page is derived from: the ranked product
+IDs and the facet summary. The key embeds the catalog version (the search
+index change log counter), so any product, category or brand write retires
+every entry at once.
+
+Hot keys are protected from stampedes in two ways. An entry is refreshed
+by the one request that wins a lock once it is ``SEARCH_CACHE_TIMEOUT``
+old, while everybody else keeps getting the previous result. On a cold key
+the requests that lose the lock wait briefly for the winner instead of all
+running the same search.
+"""
+import hashlib
+import json
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import search_index
+from .facets import parse_decimal, parse_id
+
+
+CACHE_PREFIX = 'search_results'
+# Stale entries stay around this long for requests that lose the refresh lock
+STALE_GRACE = 60
+LOCK_TIMEOUT = 30
+WAIT_TIMEOUT = 2.0
+WAIT_INTERVAL = 0.05
+
+
+def normalize_search_query(query):
+    """
+    Normalize search query for better matching. Searches run on the
+    normalized query too, so every query sharing a cache key has the same
+    result.
+    """
+    # Special characters separate words, like they do in the search index
+    query = re.sub(r'[^\w\s]', ' ', query)
+    
+    # Convert to lowercase
+    query = query.lower().strip()
+    
+    # Remove extra whitespace
+    query = re.sub(r'\s+', ' ', query)
+    
+    return query
+
+
+def canonical_params(normalized_query, params, scope='page'):
+    """The parts of a search request that decide its result, in a fixed form"""
+    min_price = parse_decimal(params.get('min_price'))
+    max_price = parse_decimal(params.get('max_price'))
+    return {
+        'scope': scope,
+        'q': normalized_query,
+        'category': parse_id(params.get('category')),
+        'brand': parse_id(params.get('brand')),
+        'min_price': str(min_price.normalize()) if min_price is not None else None,
+        'max_price': str(max_price.normalize()) if max_price is not None else None,
+        'in_stock': bool(params.get('in_stock')),
+        'sort': params.get('sort') or 'relevance',
+    }
+
+
+def cache_key(canonical):
+    digest = hashlib.md5(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+    return f'{CACHE_PREFIX}:{search_index.get_version()}:{digest}'
+
+
+def _store(key, compute):
+    timeout = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 60 * 5)
+    try:
+        value = compute()
+        cache.set(key, (time.time() + timeout, value), timeout + STALE_GRACE)
+        return value
+    finally:
+        cache.delete(f'{key}:lock')
+
+
+def cached_search(canonical, compute):
+    """Return the cached result for ``canonical``, running ``compute`` at most once at a time"""
+    key = cache_key(canonical)
+    lock_key = f'{key}:lock'
+
+    entry = cache.get(key)
+    if entry is not None:
+        refresh_at, value = entry
+        if time.time() < refresh_at or not cache.add(lock_key, 1, LOCK_TIMEOUT):
+            # Fresh, or another request is already refreshing it
+            return value
+        return _store(key, compute)
+
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        return _store(key, compute)
+
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[1]
+    # The winner is taking too long, don't keep this request waiting
+    return compute()
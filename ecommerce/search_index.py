@@ -0,0 +1,357 @@
+# search_index.py
+"""
+In-process full text search over the active catalog.
+
+Product name, SKU, short description, description, category and brand are
+tokenized and lightly stemmed into an inverted index. Queries are scored
+with BM25 (field weighted term frequencies) and nudged by popularity
+(``sales_count``, ``view_count``), returning ranked product IDs without a
+database round trip. Query terms missing from the index fall back to
+trigram similarity against the words of product, brand and category names,
+which is what makes "samsng" or "lptop" work.
+
+Every process keeps its own index. Writes are appended to a shared change
+log in the cache (``signals.py`` records the product IDs a commit touched);
+on the next search each process re-reads just those products. The index is
+rebuilt from scratch when it falls too far behind, when log entries have
+expired, or every ``SEARCH_INDEX_MAX_AGE`` seconds so popularity counters
+updated in bulk are picked up. ``LocalIndex`` implements this for any index
+class; ``autocomplete`` follows the same log.
+"""
+import bisect
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, IntegerField, Value, When
+
+from .models import Product
+from .trigrams import TrigramIndex
+
+
+VERSION_CACHE_KEY = 'search_index_version'
+CHANGE_CACHE_PREFIX = 'search_index_change'
+CHANGE_LOG_TIMEOUT = 60 * 60
+# Change log entry for category and brand edits, next to product IDs
+CATALOG_CHANGED = 'catalog'
+# Beyond this many pending changes a rebuild is cheaper than catching up
+MAX_CATCH_UP = 200
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+FIELD_WEIGHTS = {
+    'name': 3.0,
+    'sku': 3.0,
+    'brand': 2.0,
+    'category': 2.0,
+    'short_description': 1.0,
+    'description': 1.0,
+}
+SALES_BOOST = 0.1
+VIEW_BOOST = 0.05
+
+# Query terms also match longer index terms they are a prefix of
+PREFIX_MIN_LENGTH = 3
+PREFIX_WEIGHT = 0.5
+PREFIX_EXPANSIONS = 20
+
+# Unknown query terms match similar words of these fields, scaled by similarity
+FUZZY_FIELDS = ('name', 'brand', 'category')
+FUZZY_MIN_LENGTH = 3
+FUZZY_WEIGHT = 0.5
+FUZZY_EXPANSIONS = 5
+
+STOPWORDS = frozenset(
+    'a an and are as at be by for from in is it of on or the to with'.split()
+)
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def stem(token):
+    """Light plural stemmer: phones -> phone, batteries -> battery"""
+    if len(token) <= 3 or token.isdigit():
+        return token
+    if token.endswith('ies') and not token.endswith(('eies', 'aies')):
+        return token[:-3] + 'y'
+    if token.endswith('es') and not token.endswith(('aes', 'ees', 'oes')):
+        return token[:-1]
+    if token.endswith('s') and not token.endswith(('us', 'ss')):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """Lowercased, stemmed terms of ``text`` with stopwords removed"""
+    if not text:
+        return []
+    return [stem(token) for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+def product_fields(product):
+    """Indexed text of ``product``, by field"""
+    sku = product.sku or ''
+    return {
+        'name': product.name,
+        # "AB-123" is searchable as "ab", "123" and "ab123"
+        'sku': f"{sku} {''.join(TOKEN_RE.findall(sku.lower()))}",
+        'brand': product.brand.name if product.brand_id else '',
+        'category': product.category.name,
+        'short_description': product.short_description,
+        'description': product.description,
+    }
+
+
+def popularity_boost(sales_count, view_count):
+    return 1 + SALES_BOOST * math.log1p(sales_count or 0) + VIEW_BOOST * math.log1p(view_count or 0)
+
+
+def indexed_products():
+    return Product.objects.filter(status='active').select_related('category', 'brand')
+
+
+class SearchIndex:
+    """Inverted index with BM25 scoring. Thread safe."""
+
+    def __init__(self, version=0):
+        self.version = version
+        self.built_at = time.monotonic()
+        self.postings = {}      # term -> {product_id: weighted term frequency}
+        self.doc_terms = {}     # product_id -> {term: weighted term frequency}
+        self.doc_lengths = {}   # product_id -> weighted length
+        self.boosts = {}        # product_id -> popularity multiplier
+        self.fuzzy = TrigramIndex()
+        self.doc_fuzzy_terms = {}  # product_id -> words added to ``fuzzy``
+        self.total_length = 0.0
+        self._vocabulary = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def build(cls, version, products=None):
+        index = cls(version)
+        for product in (indexed_products() if products is None else products):
+            index.add(product)
+        return index
+
+    def __len__(self):
+        return len(self.doc_terms)
+
+    def is_expired(self):
+        max_age = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 60 * 15)
+        return time.monotonic() - self.built_at > max_age
+
+    def add(self, product):
+        fields = product_fields(product)
+        terms = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(fields[field]):
+                terms[term] += weight
+        fuzzy_terms = {
+            term for field in FUZZY_FIELDS for term in tokenize(fields[field])
+            if not term.isdigit()
+        }
+
+        with self._lock:
+            self.remove(product.id)
+            for term, frequency in terms.items():
+                if term not in self.postings:
+                    self.postings[term] = {}
+                    self._vocabulary = None
+                self.postings[term][product.id] = frequency
+            length = sum(terms.values())
+            self.doc_terms[product.id] = dict(terms)
+            self.doc_lengths[product.id] = length
+            self.boosts[product.id] = popularity_boost(product.sales_count, product.view_count)
+            self.total_length += length
+            self.doc_fuzzy_terms[product.id] = fuzzy_terms
+            for term in fuzzy_terms:
+                self.fuzzy.add(term)
+
+    def remove(self, product_id):
+        with self._lock:
+            terms = self.doc_terms.pop(product_id, None)
+            if terms is None:
+                return
+            for term in terms:
+                postings = self.postings[term]
+                postings.pop(product_id, None)
+                if not postings:
+                    del self.postings[term]
+                    self._vocabulary = None
+            self.total_length -= self.doc_lengths.pop(product_id)
+            self.boosts.pop(product_id, None)
+            for term in self.doc_fuzzy_terms.pop(product_id, ()):
+                self.fuzzy.discard(term)
+
+    def refresh(self, keys, version):
+        """Re-read the products in ``keys`` from the database"""
+        product_ids = [key for key in keys if key != CATALOG_CHANGED]
+        products = {p.id: p for p in indexed_products().filter(id__in=product_ids)}
+        with self._lock:
+            for product_id in product_ids:
+                if product_id in products:
+                    self.add(products[product_id])
+                else:
+                    self.remove(product_id)
+            self.version = version
+
+    @property
+    def vocabulary(self):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        return self._vocabulary
+
+    def expand(self, term):
+        """Index terms matching query ``term``, with their weight"""
+        matches = {term: 1.0} if term in self.postings else {}
+        if len(term) >= PREFIX_MIN_LENGTH:
+            vocabulary = self.vocabulary
+            position = bisect.bisect_right(vocabulary, term)
+            for candidate in vocabulary[position:position + PREFIX_EXPANSIONS]:
+                if not candidate.startswith(term):
+                    break
+                matches.setdefault(candidate, PREFIX_WEIGHT)
+        if term not in self.postings and len(term) >= FUZZY_MIN_LENGTH and not term.isdigit():
+            threshold = getattr(settings, 'SEARCH_FUZZY_THRESHOLD', 0.3)
+            for candidate, similarity in self.fuzzy.similar(term, threshold, FUZZY_EXPANSIONS):
+                matches.setdefault(candidate, FUZZY_WEIGHT * similarity)
+        return matches
+
+    def score(self, query):
+        """BM25 score of every product matching ``query``"""
+        scores = {}
+        with self._lock:
+            count = len(self.doc_terms)
+            if not count:
+                return scores
+            average_length = self.total_length / count
+
+            for term in set(tokenize(query)):
+                for index_term, weight in self.expand(term).items():
+                    postings = self.postings[index_term]
+                    idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for product_id, frequency in postings.items():
+                        norm = K1 * (1 - B + B * self.doc_lengths[product_id] / average_length)
+                        bm25 = idf * frequency * (K1 + 1) / (frequency + norm)
+                        scores[product_id] = scores.get(product_id, 0.0) + weight * bm25
+
+            for product_id in scores:
+                scores[product_id] *= self.boosts[product_id]
+        return scores
+
+    def search(self, query, limit=None):
+        """Product IDs matching ``query``, best first"""
+        scores = self.score(query)
+        ranked = sorted(scores, key=lambda product_id: (-scores[product_id], product_id))
+        return ranked[:limit] if limit else ranked
+
+
+def _start_version():
+    # A fresh log starts at a random point, so after a cache flush no process
+    # mistakes its old index for a current one
+    cache.add(VERSION_CACHE_KEY, random.randrange(1 << 30), None)
+
+
+def get_version():
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        _start_version()
+        version = cache.get(VERSION_CACHE_KEY, 0)
+    return version
+
+
+def record_change(keys):
+    """
+    Append product IDs (and ``CATALOG_CHANGED`` for category or brand edits)
+    to the change log read by every process
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    try:
+        version = cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        _start_version()
+        version = cache.incr(VERSION_CACHE_KEY)
+    cache.set(f'{CHANGE_CACHE_PREFIX}:{version}', keys, CHANGE_LOG_TIMEOUT)
+
+
+def _pending_changes(since, version):
+    """Keys changed after ``since``, or None if the log has gaps"""
+    cache_keys = [f'{CHANGE_CACHE_PREFIX}:{v}' for v in range(since + 1, version + 1)]
+    changes = cache.get_many(cache_keys)
+    if len(changes) != len(cache_keys):
+        return None
+    return {key for keys in changes.values() for key in keys}
+
+
+class LocalIndex:
+    """
+    This process' instance of ``index_class``, kept in step with the change
+    log. The class provides ``build(version)``, ``refresh(keys, version)``,
+    ``version`` and ``is_expired()``.
+    """
+
+    def __init__(self, index_class):
+        self.index_class = index_class
+        self.index = None
+        self._lock = threading.Lock()
+
+    def _sync(self, index, version):
+        if index is not None and not index.is_expired() and index.version <= version <= index.version + MAX_CATCH_UP:
+            keys = _pending_changes(index.version, version)
+            if keys is not None:
+                index.refresh(keys, version)
+                return index
+        return self.index_class.build(version)
+
+    def get(self):
+        version = get_version()
+        index = self.index
+        if index is not None and index.version == version:
+            if not index.is_expired():
+                return index
+            # Only popularity data is stale: one thread rebuilds while the
+            # others keep serving the current index
+            if not self._lock.acquire(blocking=False):
+                return index
+        else:
+            self._lock.acquire()
+        try:
+            current = self.index
+            if current is None or current.version != version or current.is_expired():
+                self.index = self._sync(current, version)
+            return self.index
+        finally:
+            self._lock.release()
+
+
+_local_index = LocalIndex(SearchIndex)
+
+
+def get_index():
+    """This process' search index, brought up to date with the change log"""
+    return _local_index.get()
+
+
+def search(query, limit=None):
+    """Ranked IDs of the active products matching ``query``"""
+    if limit is None:
+        limit = getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+    return get_index().search(query, limit)
+
+
+def rank_annotation(product_ids):
+    """Expression giving the first of ``product_ids`` the highest value"""
+    total = len(product_ids)
+    return Case(
+        *[When(id=product_id, then=Value(total - position)) for position, product_id in enumerate(product_ids)],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
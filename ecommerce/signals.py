@@ -0,0 +1,170 @@
+# signals.py
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from . import homepage, locations, search_backends, search_index
+from .catalog_tree import bump_version as bump_catalog_tree_version
+from .listing_counts import bump_version as bump_listing_counts_version
+from .models import (
+    Product, ProductImage, ProductVariant, Banner, Brand, Category, Cart, CartItem, Review,
+    County, DeliveryArea,
+)
+
+
+def _after_commit(func):
+    """
+    Run a cache refresh once the write commits. The write stands either way,
+    so a failing refresh is logged instead of raised into the caller.
+    """
+    transaction.on_commit(func, robust=True)
+
+
+def _rebuild_rails_on_commit(names):
+    if names:
+        _after_commit(lambda: homepage.rebuild_rails(names))
+
+
+def _record_search_change(keys):
+    """
+    Database search backends re-index inside the writing transaction; the
+    in-process indexes follow the change log once it commits
+    """
+    search_backends.get_backend().update(
+        key for key in keys if key != search_index.CATALOG_CHANGED
+    )
+    _after_commit(lambda: search_index.record_change(keys))
+
+
+def _record_catalog_change(kwargs, products, detached=()):
+    """
+    Products carry their category and brand names in the search indexes,
+    which also list categories and brands themselves
+    """
+    keys = [search_index.CATALOG_CHANGED]
+    if kwargs['signal'] is not post_delete:
+        keys += products.values_list('id', flat=True)
+    else:
+        # Deleted products send their own signals, detached ones don't
+        keys += detached
+    _record_search_change(keys)
+
+
+def stock_changed(product_ids):
+    """
+    Stock moved by bulk UPDATEs (see ``inventory``), which send no signals.
+    Rails drop sold out products; search facets and suggestions show stock.
+    All of it runs after commit, keeping the checkout transaction short.
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+    _after_commit(lambda: search_index.record_change(product_ids))
+    _after_commit(lambda: search_backends.get_backend().update(product_ids))
+    _after_commit(lambda: _rebuild_stock_rails(product_ids))
+
+
+def _rebuild_stock_rails(product_ids):
+    names = set()
+    for product in Product.objects.filter(id__in=product_ids):
+        names.update(homepage.rails_for_product(product))
+    # Brand popularity doesn't depend on stock
+    names.discard(homepage.POPULAR_BRANDS.name)
+    if names:
+        homepage.rebuild_rails(sorted(names))
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    _rebuild_rails_on_commit(homepage.rails_for_product(instance))
+    _after_commit(bump_listing_counts_version)
+    _record_search_change([instance.pk])
+
+    # Category and brand product counts only move on create, delete or refile
+    deleted = kwargs['signal'] is post_delete
+    moved = getattr(instance, '_loaded_grouping', None) != instance.grouping
+    if deleted or kwargs.get('created') or moved:
+        _after_commit(bump_catalog_tree_version)
+    instance._loaded_grouping = instance.grouping
+
+    if not deleted and getattr(instance, '_loaded_price', None) != instance.price:
+        Cart.refresh_summaries(Cart.objects.filter(items__product=instance))
+    instance._loaded_price = instance.price
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def product_image_changed(sender, instance, **kwargs):
+    _rebuild_rails_on_commit(homepage.rails_containing_product(instance.product_id))
+    # Autocomplete suggestions show a thumbnail
+    _after_commit(lambda: search_index.record_change([instance.product_id]))
+
+
+@receiver([post_save, post_delete], sender=Banner)
+def banner_changed(sender, instance, **kwargs):
+    _rebuild_rails_on_commit([homepage.BANNERS.name])
+
+
+@receiver([post_save, post_delete], sender=Brand)
+def brand_changed(sender, instance, **kwargs):
+    _rebuild_rails_on_commit([homepage.POPULAR_BRANDS.name])
+    _after_commit(bump_catalog_tree_version)
+    _record_catalog_change(kwargs, instance.product, getattr(instance, '_detached_product_ids', ()))
+
+
+@receiver(pre_delete, sender=Brand)
+def brand_deleting(sender, instance, **kwargs):
+    # Products are detached with a bulk UPDATE (SET_NULL), which sends no signals
+    instance._detached_product_ids = list(instance.product.values_list('id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, instance, **kwargs):
+    _rebuild_rails_on_commit([homepage.TOP_CATEGORIES.name])
+    _after_commit(bump_catalog_tree_version)
+    # A moved subcategory changes what its old and new parents list
+    _after_commit(bump_listing_counts_version)
+    _record_catalog_change(kwargs, instance.products)
+
+
+@receiver([post_save, post_delete], sender=County)
+@receiver([post_save, post_delete], sender=DeliveryArea)
+def location_changed(sender, instance, **kwargs):
+    _after_commit(locations.invalidate)
+
+
+@receiver([post_save, post_delete], sender=CartItem)
+def cart_item_changed(sender, instance, **kwargs):
+    origin = kwargs.get('origin')
+    if isinstance(origin, Cart) or (isinstance(origin, QuerySet) and origin.model is Cart):
+        # Lines removed with their cart, there is no summary left to refresh
+        return
+    Cart.refresh_summaries(Cart.objects.filter(pk=instance.cart_id))
+
+
+@receiver(post_save, sender=ProductVariant)
+def product_variant_changed(sender, instance, **kwargs):
+    Cart.refresh_summaries(Cart.objects.filter(items__variant=instance))
+
+
+@receiver([post_save, post_delete], sender=Review)
+def review_changed(sender, instance, **kwargs):
+    before = getattr(instance, '_loaded_contribution', None)
+    after = None if kwargs['signal'] is post_delete else instance.contribution
+
+    if before and after and before[0] != after[0]:
+        # Review moved to another product
+        Product.apply_rating_delta(before[0], removed=before[1])
+        Product.apply_rating_delta(after[0], added=after[1])
+    elif before or after:
+        product_id = (before or after)[0]
+        Product.apply_rating_delta(
+            product_id,
+            removed=before[1] if before else None,
+            added=after[1] if after else None,
+        )
+    instance._loaded_contribution = after
+
+    if before != after:
+        # Homepage cards show the review count
+        _rebuild_rails_on_commit(homepage.rails_containing_product(instance.product_id))
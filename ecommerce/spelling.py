@@ -0,0 +1,229 @@
+# spelling.py
+"""
+Symmetric delete spelling correction over the catalog vocabulary.
+
+Every dictionary word is stored under each string reachable from its first
+``PREFIX_LENGTH`` characters by deleting up to ``MAX_DISTANCE`` characters.
+Correcting a word generates the same deletes of the input and looks them up,
+so the candidates come from a handful of dict probes instead of generating
+every insertion, substitution and transposition; they are then verified
+with a bounded Damerau-Levenshtein distance.
+
+Words come from product names and short descriptions plus brand and
+category names. A word's frequency is the number of products using it plus
+how often it was searched recently (``SearchQueryDaily``), so among equally
+close candidates the common, popular word wins. The index follows the search
+index change log like ``autocomplete``; ``rebuild_spelling_index`` forces
+every process to reload the catalog words and search popularity.
+"""
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Brand, Category, Product, SearchQueryDaily
+from .search_index import CATALOG_CHANGED, TOKEN_RE, LocalIndex
+
+MAX_DISTANCE = 2
+PREFIX_LENGTH = 7
+# Shorter words are left alone, there are too many close neighbours
+MIN_WORD_LENGTH = 3
+
+
+def words_of(text):
+    return [
+        word for word in TOKEN_RE.findall((text or '').lower())
+        if len(word) >= MIN_WORD_LENGTH and not word.isdigit()
+    ]
+
+
+def product_words(name, short_description):
+    return set(words_of(name)) | set(words_of(short_description))
+
+
+def deletes(word, max_distance):
+    """``word`` and every string made from it by deleting up to ``max_distance`` characters"""
+    found = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {
+            candidate[:i] + candidate[i + 1:]
+            for candidate in frontier if len(candidate) > 1
+            for i in range(len(candidate))
+        } - found
+        found |= frontier
+    return found
+
+
+def distance(a, b, max_distance):
+    """Optimal string alignment distance, or ``max_distance + 1`` once it is exceeded"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def max_distance_for(word):
+    return 1 if len(word) <= 4 else MAX_DISTANCE
+
+
+class SpellIndex:
+    """Word frequencies plus the symmetric delete lookup table. Thread safe."""
+
+    def __init__(self, version=0):
+        self.version = version
+        self.built_at = time.monotonic()
+        self.product_counts = Counter()   # word -> products using it
+        self.catalog_words = set()        # brand and category name words
+        self.popularity = Counter()       # word -> recent searches
+        self.doc_words = {}               # product_id -> words
+        self.deletes = {}                 # delete -> words
+        self._lock = threading.RLock()
+
+    @classmethod
+    def build(cls, version):
+        index = cls(version)
+        index.load_catalog()
+        for product_id, name, short_description in Product.objects.filter(
+            status='active'
+        ).values_list('id', 'name', 'short_description'):
+            index.add(product_id, product_words(name, short_description))
+        return index
+
+    def is_expired(self):
+        max_age = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 60 * 15)
+        return time.monotonic() - self.built_at > max_age
+
+    def __contains__(self, word):
+        return word in self.product_counts or word in self.catalog_words
+
+    def frequency(self, word):
+        return self.product_counts[word] + (word in self.catalog_words) + self.popularity[word]
+
+    def _index_word(self, word):
+        for delete in deletes(word[:PREFIX_LENGTH], MAX_DISTANCE):
+            self.deletes.setdefault(delete, set()).add(word)
+
+    def _unindex_word(self, word):
+        for delete in deletes(word[:PREFIX_LENGTH], MAX_DISTANCE):
+            words = self.deletes.get(delete)
+            if words is not None:
+                words.discard(word)
+                if not words:
+                    del self.deletes[delete]
+
+    def load_catalog(self):
+        names = list(Category.objects.filter(is_active=True).values_list('name', flat=True))
+        names += Brand.objects.filter(is_active=True).values_list('name', flat=True)
+        catalog_words = {word for name in names for word in words_of(name)}
+
+        days = getattr(settings, 'SPELLING_POPULARITY_DAYS', 30)
+        popularity = Counter()
+        for query, count in SearchQueryDaily.objects.filter(
+            day__gte=timezone.localdate() - timedelta(days=days)
+        ).values('query').annotate(total=Sum('count')).values_list('query', 'total'):
+            for word in words_of(query):
+                popularity[word] += count
+
+        with self._lock:
+            for word in self.catalog_words - catalog_words:
+                if word not in self.product_counts:
+                    self._unindex_word(word)
+            for word in catalog_words - self.catalog_words:
+                if word not in self.product_counts:
+                    self._index_word(word)
+            self.catalog_words = catalog_words
+            self.popularity = popularity
+
+    def add(self, product_id, words):
+        with self._lock:
+            self.remove(product_id)
+            self.doc_words[product_id] = words
+            for word in words:
+                if word not in self:
+                    self._index_word(word)
+                self.product_counts[word] += 1
+
+    def remove(self, product_id):
+        with self._lock:
+            for word in self.doc_words.pop(product_id, ()):
+                self.product_counts[word] -= 1
+                if not self.product_counts[word]:
+                    del self.product_counts[word]
+                    if word not in self.catalog_words:
+                        self._unindex_word(word)
+
+    def refresh(self, keys, version):
+        product_ids = [key for key in keys if key != CATALOG_CHANGED]
+        rows = {
+            product_id: product_words(name, short_description)
+            for product_id, name, short_description in Product.objects.filter(
+                id__in=product_ids, status='active'
+            ).values_list('id', 'name', 'short_description')
+        }
+        with self._lock:
+            if CATALOG_CHANGED in keys:
+                self.load_catalog()
+            for product_id in product_ids:
+                if product_id in rows:
+                    self.add(product_id, rows[product_id])
+                else:
+                    self.remove(product_id)
+            self.version = version
+
+    def lookup(self, word):
+        """The closest, most frequent dictionary word to ``word``, or None"""
+        if word in self:
+            return word
+        max_distance = max_distance_for(word)
+        best = None
+        with self._lock:
+            candidates = set()
+            for delete in deletes(word[:PREFIX_LENGTH], max_distance):
+                candidates.update(self.deletes.get(delete, ()))
+            for candidate in candidates:
+                if len(candidate) < MIN_WORD_LENGTH:
+                    continue
+                found = distance(word, candidate, max_distance)
+                if found <= max_distance:
+                    rank = (found, -self.frequency(candidate), candidate)
+                    if best is None or rank < best:
+                        best = rank
+        return best[2] if best else None
+
+    def correct(self, query):
+        """``query`` with its misspelled words replaced, or None when nothing changed"""
+        words = (query or '').lower().split()
+        corrected = []
+        for word in words:
+            replacement = None
+            if TOKEN_RE.fullmatch(word) and len(word) >= MIN_WORD_LENGTH and not word.isdigit():
+                replacement = self.lookup(word)
+            corrected.append(replacement or word)
+        return ' '.join(corrected) if corrected != words else None
+
+
+_local_index = LocalIndex(SpellIndex)
+
+
+def get_index():
+    return _local_index.get()
+
+
+def correct(query):
+    return get_index().correct(query)
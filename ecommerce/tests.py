@@ -1,3 +1,1340 @@
-from django.test import TestCase
+import json
+import math
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import (
+    autocomplete, facets, homepage, inventory, locations, payment_jobs, recommendations, search_analytics, search_backends,
+    search_index, spelling,
+)
+from .context_processors import cart_context
+from .facets import FacetIndex
+from .mpesa import AccessTokenCache, CircuitOpen, DarajaTransport, MpesaService
+from .models import (
+    Address, Brand, Cart, CartItem, Category, County, DeliveryArea, Order, OrderItem, Payment, Product,
+    ProductRecommendation, ProductVariant, ProductView, RecentlyViewedProduct, Review, SearchEvent,
+    SearchQueryDaily, SearchQueryHourly, StkPushJob, StockReservation, User,
+)
+from .pagination import KeysetPaginator
+from .view_counter import ProductViewBuffer
+
+
+class SearchQueryCountTests(TestCase):
+    """The search page runs the search once and derives everything else from it"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Phones', slug='phones')
+        cls.brand = Brand.objects.create(name='Samsung', slug='samsung')
+        for i in range(30):
+            Product.objects.create(
+                name=f'Phone {i}', slug=f'phone-{i}', sku=f'PH-{i}', description='Smartphone',
+                category=cls.category, brand=cls.brand if i % 2 else None,
+                price=Decimal(100 + i), stock_quantity=5,
+            )
+
+    def setUp(self):
+        # Starts a new change log, so the in-process indexes reload this data
+        cache.clear()
+
+    def test_search_page_queries(self):
+        self.client.get('/search/?q=smartphone')  # build the in-process indexes
+        url = f'/search/?q=phone&category={self.category.id}'
+
+        # category lookup, matching IDs, page rows, page images, related searches
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        self.assertEqual(response.context['total_products'], 30)
+        self.assertEqual(len(response.context['products']), 20)
+
+        # The matching IDs now come from the result cache
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/search/?q=Phone!&category={self.category.id}&page=2')
+        self.assertEqual(response.context['total_products'], 30)
+        self.assertEqual(len(response.context['products']), 10)
+
+    def test_facets_and_totals_share_the_result_set(self):
+        self.client.get('/search/?q=smartphone')
+        url = '/search/?q=phone&sort=price_low&page=2&max_price=120'
+
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+
+        self.assertEqual(response.context['total_products'], 21)
+        self.assertEqual(
+            [product.price for product in response.context['products']], [Decimal(120)]
+        )
+        self.assertEqual(
+            response.context['price_range'], {'min_price': Decimal(100), 'max_price': Decimal(120)}
+        )
+        self.assertEqual(response.context['brands'], [
+            {'id': self.brand.id, 'name': 'Samsung', 'product_count': 10},
+        ])
+
+    def test_product_write_invalidates_cached_results(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                name='Phone stand', slug='phone-stand', sku='ST-1', description='Stand',
+                category=self.category, price=Decimal(5), stock_quantity=5,
+            )
+        self.assertEqual(self.client.get('/search/?q=phone').context['total_products'], 31)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(slug='phone-stand').get().delete()
+        self.assertEqual(self.client.get('/search/?q=phone').context['total_products'], 30)
+
+    def test_queries_sharing_a_cache_entry_share_the_result(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                name='Cotton T-Shirt', slug='t-shirt', sku='TS-1', description='Shirt',
+                category=self.category, price=Decimal(5), stock_quantity=5,
+            )
+        # Punctuation separates words in the cache key as in the index, so
+        # this is not the entry "T-Shirts!" reads
+        self.client.get('/search/?q=tshirts')
+        self.assertEqual(self.client.get('/search/?q=T-Shirts!').context['total_products'], 1)
+        # ...but is the one "t shirts" reads
+        with self.assertNumQueries(3):
+            response = self.client.get('/search/?q=t+shirts')
+        self.assertEqual(response.context['total_products'], 1)
+
+
+class StockLine:
+    def __init__(self, product, quantity, variant=None):
+        self.product, self.product_id = product, product.id
+        self.variant, self.variant_id = variant, variant.id if variant else None
+        self.quantity = quantity
+
+
+class DecrementStockTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Phones', slug='phones')
+        cls.phone = Product.objects.create(
+            name='Phone', slug='phone', sku='PH-1', description='Phone',
+            category=category, price=Decimal(100), stock_quantity=3,
+        )
+        cls.case = Product.objects.create(
+            name='Case', slug='case', sku='CS-1', description='Case',
+            category=category, price=Decimal(10), stock_quantity=1,
+        )
+        cls.ebook = Product.objects.create(
+            name='Ebook', slug='ebook', sku='EB-1', description='Ebook',
+            category=category, price=Decimal(5), stock_quantity=0, track_inventory=False,
+        )
+        cls.variant = ProductVariant.objects.create(product=cls.phone, sku='PH-1-RED', stock_quantity=2)
+
+    def stock(self, instance):
+        instance.refresh_from_db(fields=['stock_quantity'])
+        return instance.stock_quantity
+
+    def test_takes_every_line(self):
+        inventory.decrement_stock([
+            StockLine(self.phone, 2), StockLine(self.phone, 1, self.variant), StockLine(self.ebook, 4),
+        ])
+        self.assertEqual(self.stock(self.phone), 1)
+        self.assertEqual(self.stock(self.variant), 1)
+        self.assertEqual(self.stock(self.ebook), 0)
+
+    def test_short_line_fails_the_whole_order(self):
+        with self.assertRaises(inventory.InsufficientStock) as raised:
+            inventory.decrement_stock([StockLine(self.phone, 1), StockLine(self.case, 2)])
+        self.assertEqual(raised.exception.shortfalls, [{
+            'name': 'Case', 'product_id': self.case.id, 'variant_id': None, 'requested': 2, 'available': 1,
+        }])
+        self.assertEqual(self.stock(self.phone), 3)
+        self.assertEqual(self.stock(self.case), 1)
+
+    def test_refreshes_rails_and_search_after_commit(self):
+        with mock.patch.object(homepage, 'rebuild_rails') as rebuild_rails, \
+                mock.patch.object(search_index, 'record_change') as record_change:
+            with self.captureOnCommitCallbacks(execute=True):
+                inventory.decrement_stock([StockLine(self.phone, 1)])
+                # The checkout transaction only moves stock
+                rebuild_rails.assert_not_called()
+                record_change.assert_not_called()
+        self.assertIn('new_arrivals', rebuild_rails.call_args.args[0])
+        record_change.assert_called_once_with([self.phone.id])
+
+    def test_restore(self):
+        lines = [StockLine(self.phone, 3), StockLine(self.phone, 2, self.variant)]
+        inventory.decrement_stock(lines)
+        inventory.restore_stock(lines)
+        self.assertEqual(self.stock(self.phone), 3)
+        self.assertEqual(self.stock(self.variant), 2)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    """Concurrent checkouts never oversell nor lose a decrement"""
+    buyers = 20
+    stock = 7
+
+    def setUp(self):
+        category = Category.objects.create(name='Consoles', slug='consoles')
+        self.product = Product.objects.create(
+            name='Console', slug='console', sku='CN-1', description='Console',
+            category=category, price=Decimal(500), stock_quantity=self.stock,
+        )
+
+    def checkout(self, results):
+        line = StockLine(self.product, 1)
+        try:
+            while True:
+                committed = []
+                try:
+                    with transaction.atomic():
+                        transaction.on_commit(lambda: committed.append(True))
+                        inventory.decrement_stock([line])
+                except inventory.InsufficientStock:
+                    results.append(False)
+                    return
+                except OperationalError:
+                    # SQLite reports lock contention instead of waiting;
+                    # nothing after the commit may raise
+                    if committed:
+                        raise
+                    continue
+                results.append(True)
+                return
+        finally:
+            connection.close()
+
+    def test_no_oversell(self):
+        results = []
+        start = threading.Barrier(self.buyers)
+
+        def buyer():
+            start.wait()
+            self.checkout(results)
+
+        threads = [threading.Thread(target=buyer) for _ in range(self.buyers)]
+        with mock.patch.object(homepage, 'rebuild_rails'), \
+                mock.patch.object(search_index, 'record_change') as record_change:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.product.refresh_from_db()
+        self.assertEqual(results.count(True), self.stock)
+        self.assertEqual(results.count(False), self.buyers - self.stock)
+        self.assertEqual(self.product.stock_quantity, 0)
+        # Every sale refreshed the search indexes once it committed
+        self.assertEqual(record_change.call_count, self.stock)
+
+
+class CheckoutQueryCountTests(TestCase):
+    """Placing an order costs the same number of queries whatever the cart size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='x')
+        county = County.objects.create(name='Nairobi', code='047')
+        area = DeliveryArea.objects.create(name='CBD', county=county, shipping_fee=Decimal(200))
+        cls.address = Address.objects.create(
+            user=cls.user, address_type='billing', first_name='Amina', last_name='Otieno',
+            phone='0712345678', county=county, delivery_area=area, detailed_address='Moi Avenue',
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        cls.products = [
+            Product.objects.create(
+                name=f'Phone {i}', slug=f'phone-{i}', sku=f'PH-{i}', description='Phone',
+                category=category, price=Decimal(100 + i), stock_quantity=10,
+            )
+            for i in range(6)
+        ]
+        cls.variant = ProductVariant.objects.create(
+            product=cls.products[0], sku='PH-0-RED', price=Decimal(150), stock_quantity=10,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def fill_cart(self, lines):
+        cart = Cart.objects.create(user=self.user)
+        for product, variant in lines:
+            CartItem.objects.create(cart=cart, product=product, variant=variant, quantity=2)
+
+    def place_order(self):
+        return self.client.post('/checkout/', {
+            'billing_address_selection': self.address.id, 'paymentmethod': 'cash',
+        })
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        self.fill_cart([(self.products[0], self.variant), (self.products[1], None)])
+        with self.assertNumQueries(21):
+            self.place_order()
+
+        self.fill_cart([(self.products[0], self.variant)] + [(product, None) for product in self.products])
+        with self.assertNumQueries(21):
+            response = self.place_order()
+
+        order = Order.objects.latest('id')
+        self.assertRedirects(response, f'/order-confirmation/{order.order_number}/', fetch_redirect_response=False)
+        self.assertEqual(order.items.count(), 7)
+        self.assertEqual(order.subtotal, Decimal(2 * (150 + sum(100 + i for i in range(6)))))
+        self.assertEqual(order.total_amount, order.subtotal + 200)
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock_quantity, 6)
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+
+
+class StubDaraja(BaseHTTPRequestHandler):
+    """Answers with the queued statuses, then 200; records every request"""
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        server.requests.append((self.command, self.path, self.client_address))
+        status = server.statuses.pop(0) if server.statuses else 200
+        body = b'{}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class DarajaTransportTests(SimpleTestCase):
+    """Retries, circuit breaking and connection reuse against a local stub"""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubDaraja)
+        self.server.statuses = []
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.transport = DarajaTransport(
+            f'http://127.0.0.1:{self.server.server_port}', retries=2, backoff=0,
+            breaker_failures=2, breaker_reset=60,
+        )
+        self.addCleanup(self.transport.session.close)
+
+    def test_reuses_the_connection(self):
+        for _ in range(3):
+            self.assertEqual(self.transport.get('/oauth/v1/generate?grant_type=client_credentials').status_code, 200)
+        self.assertEqual(len({client for _, _, client in self.server.requests}), 1)
+        self.assertEqual(self.transport.snapshot()['/oauth/v1/generate']['attempts'], 3)
+
+    def test_retries_idempotent_calls(self):
+        self.server.statuses = [503, 502]
+        self.assertEqual(self.transport.get('/oauth/v1/generate').status_code, 200)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.transport.breaker.state, 'closed')
+
+    def test_does_not_retry_stk_push_responses(self):
+        self.server.statuses = [503]
+        self.assertEqual(self.transport.post('/mpesa/stkpush/v1/processrequest').status_code, 503)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_breaker_opens_after_repeated_failures(self):
+        self.server.statuses = [500] * 2
+        for _ in range(2):
+            self.transport.post('/mpesa/stkpush/v1/processrequest')
+        with self.assertRaises(CircuitOpen):
+            self.transport.post('/mpesa/stkpush/v1/processrequest')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.transport.snapshot()['/mpesa/stkpush/v1/processrequest']['rejected'], 1)
+
+        # After the reset period one trial call closes it again
+        self.transport.breaker.opened_at -= 60
+        self.assertEqual(self.transport.post('/mpesa/stkpush/v1/processrequest').status_code, 200)
+        self.assertEqual(self.transport.breaker.state, 'closed')
+
+
+class AutocompleteTests(TestCase):
+    """Suggestions come from the in-process index, built in one sort and refreshed in place"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Smart Phones', slug='phones')
+        cls.brand = Brand.objects.create(name='Samsung', slug='samsung')
+        cls.galaxy = Product.objects.create(
+            name='Samsung Galaxy S21', slug='galaxy-s21', sku='SM-1', description='Phone',
+            category=cls.category, brand=cls.brand, price=Decimal(10), stock_quantity=5, view_count=1,
+        )
+        cls.buds = Product.objects.create(
+            name='Galaxy Buds', slug='galaxy-buds', sku='SM-2', description='Earphones',
+            category=cls.category, brand=cls.brand, price=Decimal(5), stock_quantity=0, view_count=100,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_build_sorts_every_name_key(self):
+        index = autocomplete.AutocompleteIndex.build(0)
+        entries = index.product_names.entries
+        self.assertEqual(entries, sorted(entries))
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(index.product_names.lookup('s2'), {self.galaxy.id})
+
+    def test_suggestions_without_queries(self):
+        autocomplete.get_index()
+        with self.assertNumQueries(0):
+            suggestions = self.client.get('/autocomplete/?q=gal').json()['suggestions']
+        self.assertEqual([s['title'] for s in suggestions], ['Galaxy Buds', 'Samsung Galaxy S21'])
+        self.assertFalse(suggestions[0]['in_stock'])
+        self.assertEqual(
+            [s['type'] for s in autocomplete.suggest('sams')], ['product', 'brand']
+        )
+        self.assertEqual(autocomplete.suggest('phon'), [{
+            'type': 'category', 'title': 'Smart Phones', 'count': 2,
+            'url': f'/search/?category={self.category.id}',
+        }])
+
+    def test_refresh_follows_writes(self):
+        autocomplete.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.buds.delete()
+            self.category.name = 'Mobiles'
+            self.category.save()
+        self.assertEqual(autocomplete.suggest('phon'), [])
+        self.assertEqual(autocomplete.suggest('mob')[0]['count'], 1)
+        self.assertEqual([s['title'] for s in autocomplete.suggest('galaxy')], ['Samsung Galaxy S21'])
+        entries = autocomplete.get_index().product_names.entries
+        self.assertEqual(entries, sorted(entries))
+
+
+@override_settings(SEARCH_BACKEND='sqlite_fts')
+class SQLiteFTSBackendTests(TestCase):
+    """The FTS5 index follows product, brand and category writes inside their transaction"""
+
+    @classmethod
+    def setUpTestData(cls):
+        # The FTS table is created inside the test transaction and rolled back with it
+        backend = search_backends.get_backend()
+        backend._ready = False
+        cls.addClassCleanup(setattr, backend, '_ready', False)
+        cls.category = Category.objects.create(name='Phones', slug='phones')
+        cls.brand = Brand.objects.create(name='Samsung', slug='samsung')
+        cls.galaxy = Product.objects.create(
+            name='Galaxy S21 smartphone', slug='galaxy', sku='SM-G991', description='Great',
+            category=cls.category, brand=cls.brand, price=Decimal(10), stock_quantity=5,
+        )
+        cls.case = Product.objects.create(
+            name='Phone case', slug='case', sku='CS-1', description='Cover for phones',
+            category=cls.category, price=Decimal(10), stock_quantity=5, sales_count=100,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.backend = search_backends.get_backend()
+        self.backend.rebuild()
+
+    def test_search(self):
+        self.assertEqual(self.backend.search('samsung'), [self.galaxy.id])
+        self.assertEqual(set(self.backend.search('phone')), {self.galaxy.id, self.case.id})
+        self.assertEqual(self.backend.search('gala'), [self.galaxy.id])
+        self.assertEqual(self.client.get('/search/?q=galaxy').context['total_products'], 1)
+
+    def test_follows_writes(self):
+        self.brand.name = 'Apple'
+        self.brand.save()
+        self.assertEqual(self.backend.search('apple'), [self.galaxy.id])
+        self.assertEqual(self.backend.search('samsung'), [])
+        self.brand.delete()
+        self.assertEqual(self.backend.search('apple'), [])
+        self.case.status = 'inactive'
+        self.case.save()
+        self.assertEqual(self.backend.search('case'), [])
+
+    def test_large_updates_are_batched(self):
+        product_ids = [self.galaxy.id, self.case.id] + list(range(10 ** 6, 10 ** 6 + 1200))
+        with CaptureQueriesContext(connection) as queries:
+            self.backend.update(product_ids)
+        deletes = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(set(self.backend.search('phone')), {self.galaxy.id, self.case.id})
+
+
+class ProductViewBufferTests(TestCase):
+    """Buffered views reach the database in one flush, and survive a failed one"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='viewer', email='viewer@example.com', password='x')
+        category = Category.objects.create(name='Phones', slug='phones')
+        cls.phone = Product.objects.create(
+            name='Phone', slug='phone', sku='PH-1', description='Phone',
+            category=category, price=Decimal(100), stock_quantity=3,
+        )
+
+    def setUp(self):
+        self.buffer = ProductViewBuffer(flush_interval=3600)
+        patcher = mock.patch.object(self.buffer, '_ensure_worker')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flush(self):
+        viewed_at = timezone.now() - timedelta(minutes=5)
+        with mock.patch('ecommerce.view_counter.timezone.now', return_value=viewed_at):
+            self.buffer.record(self.phone.id, user_id=self.user.id, session_key='a')
+        self.buffer.record(self.phone.id, session_key='b')
+
+        self.assertEqual(self.buffer.flush(), 2)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.view_count, 2)
+        self.assertEqual(ProductView.objects.filter(product=self.phone).count(), 2)
+        # The time of the view, not of the flush
+        self.assertEqual(RecentlyViewedProduct.objects.get(user=self.user).viewed_at, viewed_at)
+
+    def test_failed_flush_is_retried(self):
+        self.buffer.record(self.phone.id, session_key='a')
+        with mock.patch.object(self.buffer, '_write_view_counts', side_effect=OperationalError('locked')):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+        self.buffer.record(self.phone.id, session_key='b')
+        self.assertEqual(self.buffer.flush(), 2)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.view_count, 2)
+
+    def test_views_of_deleted_users_are_dropped(self):
+        gone = User.objects.create_user(username='gone', email='gone@example.com', password='x')
+        self.buffer.record(self.phone.id, user_id=gone.id, session_key='a')
+        self.buffer.record(self.phone.id, user_id=self.user.id, session_key='b')
+        gone.delete()
+
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(list(ProductView.objects.values_list('user_id', flat=True)), [self.user.id])
+        self.assertEqual(list(RecentlyViewedProduct.objects.values_list('user_id', flat=True)), [self.user.id])
+        self.assertEqual(self.buffer.pending, 0)
+
+
+class SearchAnalyticsTests(TestCase):
+    """Searches are buffered, written in batches and rolled up into trending terms"""
+
+    def setUp(self):
+        cache.clear()
+        self.buffer = search_analytics.SearchEventBuffer(flush_interval=3600)
+        for patcher in [
+            mock.patch.object(self.buffer, '_ensure_worker'),
+            mock.patch.object(search_analytics, 'event_buffer', self.buffer),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def search(self, query):
+        response = self.client.post(
+            '/analytics/search/', json.dumps({'query': query}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_rollup_and_trending(self):
+        for query in ['Laptop!', 'laptop', 'phone', '  ']:
+            self.search(query)
+        self.assertEqual(SearchEvent.objects.count(), 0)
+        self.assertEqual(self.buffer.flush(), 3)
+
+        earlier = timezone.now() - timedelta(hours=30)
+        SearchEvent.objects.bulk_create([SearchEvent(query='tv', searched_at=earlier) for _ in range(5)])
+        self.assertEqual(search_analytics.rollup(earlier), ['laptop', 'phone', 'tv'])
+        search_analytics.rollup()
+        self.assertEqual(SearchQueryDaily.objects.get(query='laptop').count, 2)
+        self.assertEqual(SearchQueryHourly.objects.get(query='laptop').count, 2)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(search_analytics.get_trending_searches(), ['laptop', 'phone', 'tv'])
+
+    def test_failed_flush_is_retried(self):
+        self.search('laptop')
+        with mock.patch.object(SearchEvent.objects, 'bulk_create', side_effect=OperationalError('locked')):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+        self.search('phone')
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(
+            list(SearchEvent.objects.order_by('id').values_list('query', flat=True)), ['laptop', 'phone']
+        )
+
+    def test_searches_of_deleted_users_are_kept_anonymous(self):
+        user = User.objects.create_user(username='gone', email='gone@example.com', password='x')
+        search_analytics.record_search('laptop', user_id=user.id)
+        user.delete()
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertIsNone(SearchEvent.objects.get().user_id)
+
+
+class RecommendationTests(TestCase):
+    """Neighbours are cosine similarities of shared baskets, read back in one query"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Phones', slug='phones')
+        cls.products = [
+            Product.objects.create(
+                name=f'Phone {i}', slug=f'phone-{i}', sku=f'PH-{i}', description='Phone',
+                category=category, price=Decimal(100), stock_quantity=5,
+            )
+            for i in range(5)
+        ]
+        for session, items in enumerate([[0, 1], [0, 1, 2], [0, 2], [3, 4], [0, 1]]):
+            for i in items:
+                ProductView.objects.create(product=cls.products[i], session_key=f'session-{session}')
+
+    def test_neighbours(self):
+        baskets = [[1, 2], [1, 2, 3], [1, 3], [4, 5], [1, 2]]
+        result = recommendations.neighbours(baskets, 2)
+        self.assertEqual([other for other, _ in result[1]], [2, 3])
+        self.assertAlmostEqual(result[1][0][1], 3 / math.sqrt(4 * 3))
+        self.assertEqual(result[4], [(5, 1.0)])
+
+    @skipUnless(recommendations.sparse, 'SciPy is not installed')
+    def test_sparse_and_python_paths_agree(self):
+        baskets = [[1, 2], [1, 2, 3], [1, 3], [4, 5], [1, 2]]
+        sparse_result = recommendations._sparse_neighbours(baskets, 2)
+        python_result = recommendations._python_neighbours(baskets, 2)
+        self.assertEqual(sparse_result.keys(), python_result.keys())
+        for product_id, similar in python_result.items():
+            self.assertEqual([other for other, _ in sparse_result[product_id]], [other for other, _ in similar])
+
+    def test_rebuild_counts_the_rows_it_stores(self):
+        # An order with a product deleted while the job ran
+        deleted_id = self.products[-1].id + 1
+        with mock.patch.object(
+            recommendations, 'order_baskets', return_value=[(1, self.products[0].id), (1, deleted_id)]
+        ):
+            stored = recommendations.rebuild()
+        self.assertEqual(stored, ProductRecommendation.objects.count())
+        self.assertFalse(ProductRecommendation.objects.filter(kind='bought').exists())
+
+        with self.assertNumQueries(2):
+            names = [p.name for p in recommendations.recommended_products(self.products[0], 'viewed', 8)]
+        self.assertEqual(names, ['Phone 1', 'Phone 2'])
+
+
+@override_settings(
+    MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret', MPESA_BUSINESS_SHORTCODE='174379',
+    MPESA_PASSKEY='passkey', STK_PUSH_THREADS=0,
+)
+class StkPushJobTests(TestCase):
+    """Checkout queues the STK push; a job is sent once, failed, or deferred while Daraja is down"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='payer', email='payer@example.com', password='x')
+        county = County.objects.create(name='Nairobi', code='047')
+        area = DeliveryArea.objects.create(name='CBD', county=county, shipping_fee=Decimal(200))
+        cls.address = Address.objects.create(
+            user=cls.user, address_type='billing', first_name='Amina', last_name='Otieno',
+            phone='0712345678', county=county, delivery_area=area, detailed_address='Moi Avenue',
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        cls.phone = Product.objects.create(
+            name='Phone', slug='phone', sku='PH-1', description='Phone',
+            category=category, price=Decimal(100), stock_quantity=5,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        for patcher in [
+            mock.patch.object(payment_jobs, '_retry_timer', None),
+            mock.patch.object(payment_jobs, '_pool_enabled', True),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def checkout(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.phone, quantity=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/checkout/', {
+                'billing_address_selection': self.address.id, 'paymentmethod': 'mpesa',
+            }, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return StkPushJob.objects.get(reference=response.json()['checkout_request_id'])
+
+    def payment_status(self, reference):
+        return self.client.get('/check-payment-status/', {'checkout_request_id': reference}).json()['status']
+
+    def stk_push(self, **kwargs):
+        return mock.patch.object(MpesaService, 'stk_push', **kwargs)
+
+    def test_sent(self):
+        job = self.checkout()
+        self.assertEqual(self.payment_status(job.reference), 'PENDING')
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock_quantity, 3)
+
+        with self.stk_push(return_value={'ResponseCode': '0', 'CheckoutRequestID': 'ws_1'}) as stk_push:
+            self.assertTrue(payment_jobs.run_job(job.id))
+            self.assertFalse(payment_jobs.run_job(job.id))
+        stk_push.assert_called_once()
+        self.assertTrue(Payment.objects.filter(order=job.order, checkout_request_id='ws_1').exists())
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+
+    def test_failed_push_cancels_the_order(self):
+        job = self.checkout()
+        with self.stk_push(side_effect=Exception('Rejected')):
+            call_command('run_stk_push_worker', '--once', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('failed', 'Rejected'))
+        self.assertEqual(Order.objects.get(id=job.order_id).status, 'cancelled')
+        self.assertEqual(self.payment_status(job.reference), 'FAILED')
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock_quantity, 5)
+        self.assertTrue(Cart.objects.filter(user=self.user).exists())
+
+    def test_incomplete_settings_fail_the_job(self):
+        job = self.checkout()
+        with self.settings(MPESA_PASSKEY=''):
+            self.assertTrue(payment_jobs.run_job(job.id))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(Order.objects.get(id=job.order_id).status, 'cancelled')
+
+    def test_open_circuit_requeues_the_job(self):
+        job = self.checkout()
+        with self.settings(STK_PUSH_THREADS=2), \
+                mock.patch.object(MpesaService, 'get_access_token', side_effect=CircuitOpen('Daraja is down')), \
+                mock.patch('threading.Timer') as timer:
+            self.assertFalse(payment_jobs.run_job(job.id))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'queued')
+        self.assertIsNone(job.started_at)
+        self.assertGreater(job.available_at, timezone.now())
+        self.assertEqual(Order.objects.get(id=job.order_id).status, 'pending')
+        self.assertEqual(self.payment_status(job.reference), 'PENDING')
+        # Handed back to the pool once the breaker resets
+        delay, callback = timer.call_args.args
+        self.assertAlmostEqual(delay, (job.available_at - timezone.now()).total_seconds(), delta=1)
+        with mock.patch.object(payment_jobs, 'submit') as submit:
+            StkPushJob.objects.filter(id=job.id).update(available_at=timezone.now())
+            callback()
+        submit.assert_called_once_with(job.id)
+
+        # Not due yet, so not claimed
+        StkPushJob.objects.filter(id=job.id).update(available_at=timezone.now() + timedelta(minutes=1))
+        self.assertFalse(payment_jobs.run_job(job.id))
+
+    def test_worker_does_not_use_the_pool(self):
+        job = self.checkout()
+        with self.settings(STK_PUSH_THREADS=4), \
+                mock.patch.object(MpesaService, 'get_access_token', side_effect=CircuitOpen('Daraja is down')), \
+                mock.patch('threading.Timer') as timer, \
+                mock.patch.object(payment_jobs, 'ThreadPoolExecutor') as executor:
+            call_command('run_stk_push_worker', '--once', stdout=StringIO())
+            payment_jobs.submit(job.id)
+        timer.assert_not_called()
+        executor.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'queued')
+
+
+class HomepageRailTests(TestCase):
+    """The homepage reads materialized rails that product writes rebuild"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Phones', slug='phones')
+        brand = Brand.objects.create(name='Apple', slug='apple')
+        for i in range(3):
+            Product.objects.create(
+                name=f'Phone {i}', slug=f'phone-{i}', sku=f'PH-{i}', description='Phone',
+                category=category, brand=brand, price=Decimal(10 + i), stock_quantity=5, is_hot_deal=i == 0,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_warm_rails_cost_no_query(self):
+        self.assertEqual(self.client.get('/').status_code, 200)
+        with self.assertNumQueries(0):
+            context = homepage.get_homepage_context()
+        self.assertEqual([card['name'] for card in context['hot_deal_products']], ['Phone 0'])
+        self.assertEqual([brand['name'] for brand in context['popular_brands']], ['Apple'])
+
+    def test_product_write_rebuilds_its_rails(self):
+        homepage.get_homepage_context()
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.get(slug='phone-1')
+            product.is_hot_deal = True
+            product.save()
+        self.assertEqual(
+            [card['name'] for card in homepage.get_homepage_context()['hot_deal_products']],
+            ['Phone 1', 'Phone 0'],
+        )
+
+
+class CartSummaryTests(TestCase):
+    """Cart totals live on the cart row, and the context processor reads them lazily"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='shopper', email='shopper@example.com', password='x')
+        category = Category.objects.create(name='Phones', slug='phones')
+        cls.phone = Product.objects.create(
+            name='Phone', slug='phone', sku='PH-1', description='Phone',
+            category=category, price=Decimal(10), stock_quantity=5,
+        )
+
+    def setUp(self):
+        self.cart = Cart.objects.create(user=self.user)
+        self.item = CartItem.objects.create(cart=self.cart, product=self.phone, quantity=3)
+
+    def summary(self):
+        self.cart.refresh_from_db()
+        return self.cart.item_count, self.cart.subtotal
+
+    def test_line_and_price_changes_update_the_summary(self):
+        self.assertEqual(self.summary(), (1, Decimal(30)))
+        self.phone.price = Decimal(5)
+        self.phone.save()
+        self.assertEqual(self.summary(), (1, Decimal(15)))
+        self.item.delete()
+        self.assertEqual(self.summary(), (0, Decimal(0)))
+
+    def test_context_processor_is_lazy(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with self.assertNumQueries(0):
+            context = cart_context(request)
+        with self.assertNumQueries(1):
+            self.assertEqual(str(context['cart_total']), '30.00')
+            self.assertEqual(context['cart_items_count'], 1)
+
+
+class RatingAggregateTests(TestCase):
+    """Approved reviews keep the product's average, count and histogram current"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Phones', slug='phones')
+        cls.phone = Product.objects.create(
+            name='Phone', slug='phone', sku='PH-1', description='Phone',
+            category=category, price=Decimal(10), stock_quantity=5,
+        )
+        cls.users = [
+            User.objects.create_user(username=f'reviewer{i}', email=f'reviewer{i}@example.com', password='x')
+            for i in range(3)
+        ]
+
+    def review(self, user, rating, approved=True):
+        return Review.objects.create(
+            product=self.phone, user=user, rating=rating, title='Review', content='Review', is_approved=approved,
+        )
+
+    def ratings(self):
+        self.phone.refresh_from_db()
+        return self.phone.rating_count, self.phone.rating_average
+
+    def test_follows_review_writes(self):
+        first = self.review(self.users[0], 5, approved=False)
+        self.assertEqual(self.ratings(), (0, 0))
+        first.is_approved = True
+        first.save()
+        second = self.review(self.users[1], 2)
+        self.assertEqual(self.ratings(), (2, Decimal('3.5')))
+        self.assertEqual((self.phone.rating_histogram[5], self.phone.rating_histogram[2]), (1, 1))
+
+        second = Review.objects.get(pk=second.pk)
+        second.rating = 4
+        second.save()
+        self.assertEqual(self.ratings(), (2, Decimal('4.5')))
+        first.delete()
+        self.assertEqual(self.ratings(), (1, 4))
+
+    def test_refresh_recomputes_from_reviews(self):
+        self.review(self.users[0], 1)
+        self.review(self.users[1], 4)
+        Review.objects.update(is_approved=False)
+        Product.refresh_ratings(Product.objects.all())
+        self.assertEqual(self.ratings(), (0, 0))
+        Review.objects.update(is_approved=True)
+        Product.refresh_ratings(Product.objects.all())
+        self.assertEqual(self.ratings(), (2, Decimal('2.5')))
+        self.assertEqual(self.client.get('/search/?sort=rating').status_code, 200)
+
+
+class CategoryPathTests(TestCase):
+    """Materialized paths follow moves and answer descendant lookups"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = Category.objects.create(name='A', slug='a')
+        cls.b = Category.objects.create(name='B', slug='b', parent=cls.a)
+        cls.c = Category.objects.create(name='C', slug='c', parent=cls.b)
+        cls.d = Category.objects.create(name='D', slug='d')
+
+    def test_paths_and_descendants(self):
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.path, f'/{self.a.pk}/{self.b.pk}/{self.c.pk}/')
+        self.assertEqual(self.c.depth, 2)
+        self.assertEqual(self.c.get_category_path, 'A > B > C')
+        self.assertEqual(set(self.a.get_descendants()), {self.b, self.c})
+
+    def test_move_updates_the_subtree(self):
+        self.b.parent = self.d
+        self.b.save()
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.path, f'/{self.d.pk}/{self.b.pk}/{self.c.pk}/')
+        self.assertEqual(set(self.d.get_descendants()), {self.b, self.c})
+        self.assertEqual(set(self.a.get_descendants()), set())
+
+        self.d.parent = self.c
+        with self.assertRaises(ValueError):
+            self.d.save()
+
+    def test_rebuild(self):
+        Category.objects.update(path='', depth=0)
+        self.assertEqual(Category.rebuild_paths(), 4)
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.path, f'/{self.a.pk}/{self.b.pk}/{self.c.pk}/')
+
+    def test_empty_path_is_not_the_root_of_everything(self):
+        Category.objects.filter(pk__in=[self.a.pk, self.b.pk]).update(path='')
+        self.a.refresh_from_db()
+        self.assertEqual(set(self.a.get_descendants(include_self=True)), {self.a, self.b, self.c})
+        with self.assertRaises(ValueError):
+            Category.path_range_lookup('')
+
+    def test_listings_include_descendants(self):
+        Product.objects.create(
+            name='Phone', slug='phone', sku='PH-1', description='Phone',
+            category=self.c, price=Decimal(10), stock_quantity=5,
+        )
+        self.assertEqual(self.client.get('/category/a/').context['total_products'], 1)
+        self.assertEqual(self.client.get(f'/search/?category={self.a.pk}').context['total_products'], 1)
+
+
+class KeysetPaginationTests(TestCase):
+    """Cursor pages walk the same rows as the ORDER BY, in both directions"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='A', slug='a')
+        compare_prices = [None, 5, 3, None, 5, 7, None, 1, 3, None, 2]
+        for i in range(25):
+            compare_price = compare_prices[i] if i < len(compare_prices) else None
+            Product.objects.create(
+                name=f'P{i:02}', slug=f'p{i}', sku=f'S-{i}', description='Product',
+                category=cls.category, price=Decimal(10 + i % 3), stock_quantity=5,
+                compare_price=None if compare_price is None else Decimal(compare_price),
+            )
+
+    def walk(self, paginator):
+        """Collect ids walking forward, then walking back from the last page"""
+        page = paginator.get_page(None)
+        forward = [p.id for p in page]
+        while page.has_next():
+            page = paginator.get_page(page.next_cursor)
+            forward += [p.id for p in page]
+        backward = [p.id for p in page]
+        while page.has_previous():
+            page = paginator.get_page(page.previous_cursor)
+            backward = [p.id for p in page] + backward
+        return forward, backward
+
+    def test_walks_match_the_ordering(self):
+        for ordering in (['-created_at'], ['price'], ['-price', 'name'], ['compare_price'], ['-compare_price']):
+            with self.subTest(ordering=ordering):
+                paginator = KeysetPaginator(Product.objects.order_by(*ordering), 7)
+                expected = [p.id for p in paginator.queryset]
+                self.assertEqual(len(expected), 25)
+                forward, backward = self.walk(paginator)
+                self.assertEqual(forward, expected)
+                self.assertEqual(backward, expected)
+
+    def test_null_values_sort_last(self):
+        for ordering in ('compare_price', '-compare_price'):
+            products = list(KeysetPaginator(Product.objects.order_by(ordering), 3).queryset)
+            nulls = [p.id for p in products if p.compare_price is None]
+            self.assertEqual([p.id for p in products[-len(nulls):]], nulls)
+
+    def test_rejects_orderings_it_cannot_seek(self):
+        with self.assertRaises(ValueError):
+            KeysetPaginator(Product.objects.order_by(F('price').desc()), 3)
+        with self.assertRaises(ValueError):
+            KeysetPaginator(Product.objects.order_by('category__name'), 3)
+
+    def test_listing_views_accept_a_cursor(self):
+        response = self.client.get('/products/?cursor=')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['page_obj'].is_keyset)
+        response = self.client.get('/products/' + response.context['page_obj'].next_url)
+        self.assertEqual(response.context['total_products'], 25)
+        self.assertEqual(self.client.get('/category/a/?cursor=&sort=price').status_code, 200)
+        self.assertEqual(self.client.get('/search/?q=p0&cursor=').status_code, 200)
+        self.assertEqual(self.client.get('/brand/missing/?cursor=').status_code, 404)
+
+
+class SidebarCountTests(TestCase):
+    """Listing pages read the featured and sale counts from the denormalized columns"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='A', slug='a')
+        cls.subcategory = Category.objects.create(name='B', slug='b', parent=cls.category)
+        cls.brand = Brand.objects.create(name='X', slug='x')
+        for i in range(5):
+            Product.objects.create(
+                name=f'P{i}', slug=f'p{i}', sku=f'S-{i}', description='Product',
+                category=cls.subcategory if i % 2 else cls.category, brand=cls.brand,
+                price=Decimal(10), stock_quantity=5, is_featured=i < 2,
+                compare_price=Decimal(20) if i == 0 else None,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counts(self):
+        response = self.client.get('/category/a/?sort=price')
+        self.assertEqual(response.context['total_products'], 5)
+        self.assertEqual(response.context['featured_count'], 2)
+        self.assertEqual(response.context['sale_count'], 1)
+        self.assertEqual(response.context['page_obj'].paginator.count, 5)
+        self.assertEqual(self.client.get('/brand/x/').context['total_products'], 5)
+        self.assertEqual(self.client.get('/search/?q=').context['total_products'], 5)
+
+    def test_second_request_runs_no_counts(self):
+        self.client.get('/category/a/?sort=price')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/category/a/?sort=-price')
+        counts = [q['sql'] for q in ctx.captured_queries if 'COUNT' in q['sql'] and 'status' in q['sql']]
+        self.assertEqual(counts, [])
+
+    def test_featured_change_invalidates(self):
+        self.client.get('/category/a/')
+        product = Product.objects.get(slug='p3')
+        product.is_featured = True
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertEqual(self.client.get('/category/a/').context['featured_count'], 3)
+
+
+class FuzzySearchTests(TestCase):
+    """Misspelled terms fall back to trigram matches against the indexed vocabulary"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Computers', slug='computers')
+        cls.brand = Brand.objects.create(name='Samsung', slug='samsung')
+        cls.laptop = Product.objects.create(
+            name='Galaxy Book laptop', slug='galaxy-book', sku='SM-1', description='Laptop',
+            category=cls.category, brand=cls.brand, price=Decimal(10), stock_quantity=5,
+        )
+        cls.camera = Product.objects.create(
+            name='Camera', slug='camera', sku='CS-1', description='Camera',
+            category=cls.category, price=Decimal(10), stock_quantity=5,
+        )
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(search_index._local_index, 'index', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_typos_match(self):
+        self.assertEqual(search_index.search('lptop'), [self.laptop.id])
+        self.assertEqual(search_index.search('samsng'), [self.laptop.id])
+        self.assertEqual(search_index.search('camra'), [self.camera.id])
+
+    @override_settings(SEARCH_FUZZY_THRESHOLD=0.9)
+    def test_threshold(self):
+        self.assertEqual(search_index.search('lptop'), [])
+
+    def test_delete_removes_the_term(self):
+        search_index.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.camera.delete()
+        self.assertEqual(search_index.search('camra'), [])
+        self.assertNotIn('camera', search_index.get_index().fuzzy)
+
+
+class FacetTests(TestCase):
+    """Facet counts and price ranges come from the bitmap index"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Phones', slug='phones')
+        cls.subcategory = Category.objects.create(name='Android', slug='android', parent=cls.category)
+        cls.brand = Brand.objects.create(name='Samsung', slug='samsung')
+        cls.galaxy = Product.objects.create(
+            name='Galaxy phone', slug='galaxy', sku='SM-1', description='Phone', category=cls.subcategory,
+            brand=cls.brand, price=Decimal('30000'), stock_quantity=5,
+        )
+        cls.basic = Product.objects.create(
+            name='Basic phone', slug='basic', sku='SM-2', description='Phone', category=cls.category,
+            price=Decimal('999'), stock_quantity=0,
+        )
+        Product.objects.create(
+            name='Old phone', slug='old', sku='SM-3', description='Phone', category=cls.category,
+            price=Decimal(5), stock_quantity=5, status='inactive',
+        )
+
+    def setUp(self):
+        cache.clear()
+        for local_index in (facets._local_index, search_index._local_index):
+            patcher = mock.patch.object(local_index, 'index', None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_filters_endpoint(self):
+        data = self.client.get('/filters/?q=phone').json()
+        self.assertEqual(data['total_products'], 2)
+        self.assertEqual(
+            {c['name']: c['product_count'] for c in data['categories']}, {'Phones': 1, 'Android': 1}
+        )
+        self.assertEqual(data['brands'], [{'id': self.brand.id, 'name': 'Samsung', 'product_count': 1}])
+        self.assertEqual(data['price_range'], {'min_price': '999.00', 'max_price': '30000.00'})
+        data = self.client.get(f'/filters/?q=phone&category={self.category.id}').json()
+        self.assertEqual(data['total_products'], 1)
+
+    def test_search_page_facets(self):
+        response = self.client.get(f'/search/?q=phone&category={self.category.id}&min_price=1000')
+        self.assertEqual([c['name'] for c in response.context['categories']], ['Android'])
+        self.assertEqual(response.context['price_range']['min_price'], Decimal('30000'))
+        response = self.client.get('/search/?in_stock=1&max_price=29999.99')
+        self.assertEqual(response.context['categories'], [])
+
+    def test_stock_change_refreshes(self):
+        facets.get_index()
+        self.basic.stock_quantity = 3
+        with self.captureOnCommitCallbacks(execute=True):
+            self.basic.save()
+        self.assertEqual(facets.get_index().filter(in_stock=True).bit_count(), 2)
+
+    def test_build_matches_incremental_adds(self):
+        for i in range(40):
+            Product.objects.create(
+                name=f'Item {i}', slug=f'item-{i}', sku=f'IT-{i}', description='Item', category=self.category,
+                brand=self.brand if i % 3 else None, price=Decimal(500 * i), stock_quantity=i % 2,
+                status='active' if i % 5 else 'draft',
+            )
+        built = FacetIndex.build(1)
+        incremental = FacetIndex(1)
+        incremental.load_catalog()
+        for row in FacetIndex.product_rows(Product.objects.all()):
+            incremental.add(*row)
+        for name in ('by_category', 'by_brand', 'by_status', 'by_price_bucket', 'in_stock', 'products'):
+            self.assertEqual(getattr(built, name), getattr(incremental, name), name)
+        in_range = built.filter(min_price=Decimal(1200), max_price=Decimal(6000))
+        self.assertTrue(in_range)
+        self.assertEqual(in_range, incremental.filter(min_price=Decimal(1200), max_price=Decimal(6000)))
+
+
+class SpellingTests(TestCase):
+    """Queries with no close match are corrected against the catalog vocabulary"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Laptops', slug='laptops')
+        cls.brand = Brand.objects.create(name='Samsung', slug='samsung')
+        Product.objects.create(
+            name='Samsung Galaxy Phone', slug='galaxy', sku='SM-1', description='Phone',
+            category=cls.category, brand=cls.brand, price=Decimal(10), stock_quantity=5,
+        )
+        Product.objects.create(
+            name='Gaming Laptop Computer', slug='laptop', sku='LP-1', description='Laptop',
+            category=cls.category, price=Decimal(10), stock_quantity=5,
+        )
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(spelling._local_index, 'index', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_correct(self):
+        self.assertEqual(spelling.correct('samsng glaxy'), 'samsung galaxy')
+        self.assertEqual(spelling.correct('lpatop'), 'laptop')
+        self.assertEqual(spelling.correct('computr'), 'computer')
+        self.assertIsNone(spelling.correct('laptop'))
+        self.assertIsNone(spelling.correct('zzzzzz'))
+
+    def test_follows_catalog_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            headphones = Product.objects.create(
+                name='Wireless Headphones', slug='headphones', sku='HP-1', description='Audio',
+                category=self.category, price=Decimal(10), stock_quantity=5,
+            )
+        self.assertEqual(spelling.correct('hedphones'), 'headphones')
+        with self.captureOnCommitCallbacks(execute=True):
+            headphones.delete()
+        self.assertIsNone(spelling.correct('hedphones'))
+
+    @override_settings(SEARCH_BACKEND='sqlite_fts')
+    def test_search_page_shows_the_correction(self):
+        # The FTS table is created inside the test transaction and rolled back with it
+        patcher = mock.patch.object(search_backends.get_backend(), '_ready', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        call_command('rebuild_search_index', stdout=StringIO())
+        call_command('rebuild_spelling_index', stdout=StringIO())
+        response = self.client.get('/search/?q=lpatop')
+        self.assertEqual(response.context['corrected_query'], 'laptop')
+        self.assertEqual(response.context['total_products'], 2)
+        self.assertContains(response, 'Showing results for')
+
+
+class StockReservationTests(TestCase):
+    """Stock held for an unpaid order comes back when the payment fails or the hold expires"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Phones', slug='phones')
+        cls.product = Product.objects.create(
+            name='Phone', slug='phone', sku='PH-1', description='Phone',
+            category=cls.category, price=Decimal(10), stock_quantity=5,
+        )
+        cls.user = User.objects.create(username='buyer', email='buyer@example.com')
+
+    def place_order(self, number, quantity):
+        order = Order.objects.create(
+            user=self.user, order_number=f'ORD-{number}', subtotal=Decimal(10), total_amount=Decimal(10),
+            shipping_address='Nairobi', billing_address='Nairobi',
+        )
+        OrderItem.objects.create(
+            order=order, product=self.product, quantity=quantity,
+            unit_price=Decimal(10), total_price=Decimal(10 * quantity),
+        )
+        items = list(order.items.select_related('product', 'variant__product'))
+        inventory.decrement_stock(items)
+        inventory.reserve(order, items)
+        Payment.objects.create(order=order, checkout_request_id=f'ws_CO_{number}', status='PENDING')
+        return order
+
+    def assertStock(self, expected):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, expected)
+
+    def test_convert_and_release(self):
+        paid, failed = self.place_order(1, 2), self.place_order(2, 1)
+        self.assertStock(2)
+        inventory.convert_reservations(paid)
+        inventory.release_reservations(failed.reservations.all())
+        self.assertStock(3)
+        inventory.release_reservations(failed.reservations.all())
+        self.assertStock(3)
+
+    def test_expired_reservations_are_released(self):
+        order = self.place_order(1, 1)
+        StockReservation.objects.filter(order=order).update(expires_at=timezone.now() - timedelta(minutes=1))
+        call_command('release_expired_reservations', stdout=StringIO())
+        self.assertStock(5)
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'cancelled')
+        self.assertEqual(Payment.objects.get(order=order).status, 'FAILED')
+        # A payment that succeeds after the release takes the stock again
+        inventory.convert_reservations(order)
+        self.assertStock(4)
+
+    def test_failed_callback_releases(self):
+        self.place_order(1, 2)
+        body = {'Body': {'stkCallback': {
+            'ResultCode': 1032, 'CheckoutRequestID': 'ws_CO_1', 'ResultDesc': 'Request cancelled by user',
+        }}}
+        self.client.post('/mpesa-callback/', json.dumps(body), content_type='application/json')
+        self.assertStock(5)
+
+
+class LocationsDocumentTests(TestCase):
+    """Counties and delivery areas are served as one versioned, immutable document"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.county = County.objects.create(name='Nairobi', code='047')
+        DeliveryArea.objects.create(name='CBD', county=cls.county, shipping_fee=Decimal(100), delivery_days=1)
+        DeliveryArea.objects.create(
+            name='Closed', county=cls.county, shipping_fee=Decimal(100), delivery_days=1, is_active=False,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_document_skips_inactive_areas(self):
+        document = locations.get_document()
+        self.assertEqual([a['name'] for a in document['counties'][0]['areas']], ['CBD'])
+
+    def test_versioned_url(self):
+        version = locations.get_document()['version']
+        response = self.client.get(f'/locations/{version}.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        response = self.client.get(f'/locations/{version}.json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            DeliveryArea.objects.create(name='West', county=self.county, shipping_fee=Decimal(200), delivery_days=2)
+        self.assertEqual(self.client.get(f'/locations/{version}.json').status_code, 302)
+        self.assertNotEqual(locations.get_document()['version'], version)
+
+    def test_checkout_runs_no_location_queries(self):
+        category = Category.objects.create(name='Phones', slug='phones')
+        product = Product.objects.create(
+            name='Phone', slug='phone', sku='PH-1', description='Phone',
+            category=category, price=Decimal(10), stock_quantity=5,
+        )
+        user = User.objects.create(username='buyer', email='buyer@example.com')
+        CartItem.objects.create(cart=Cart.objects.create(user=user), product=product, quantity=1)
+        self.client.force_login(user)
+        locations.get_document()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/checkout/')
+        self.assertEqual(response.status_code, 200)
+        location_queries = [
+            q['sql'] for q in ctx.captured_queries
+            if 'ecommerce_county"' in q['sql'] or 'ecommerce_deliveryarea"' in q['sql']
+        ]
+        self.assertEqual(location_queries, [])
+        self.assertContains(response, locations.get_document()['version'])
+        self.assertContains(response, 'Nairobi')
+
+
+@override_settings(MPESA_TOKEN_REFRESH_MARGIN=300)
+class AccessTokenCacheTests(SimpleTestCase):
+    """Access tokens are shared through the cache and refreshed before they expire"""
+
+    def setUp(self):
+        cache.clear()
+        self.fetch = mock.Mock(side_effect=[('first', 3600), ('second', 3600)])
+        self.tokens = AccessTokenCache('test_access_token', self.fetch)
+        patcher = mock.patch('ecommerce.mpesa.time.time', return_value=1000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_is_shared(self):
+        self.assertEqual(self.tokens.get(), 'first')
+        self.assertEqual(AccessTokenCache('test_access_token', self.fetch).get(), 'first')
+        self.fetch.assert_called_once()
+        self.assertEqual(cache.get('test_access_token')['token'], 'first')
+
+    def test_refreshes_ahead_of_expiry(self):
+        self.tokens.get()
+        self.time.return_value = 1000.0 + 3600 - 299
+        self.assertEqual(self.tokens.get(), 'second')
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_failed_refresh_keeps_the_current_token(self):
+        self.fetch.side_effect = [('first', 3600), OSError('unreachable')]
+        self.tokens.get()
+        self.time.return_value = 1000.0 + 3600 - 299
+        self.assertEqual(self.tokens.get(), 'first')
+
+    def test_invalidate_drops_the_token(self):
+        self.tokens.get()
+        self.tokens.invalidate('stale')
+        self.assertEqual(self.tokens.get(), 'first')
+        self.tokens.invalidate('first')
+        self.assertEqual(self.tokens.get(), 'second')
@@ -0,0 +1,67 @@
+# trigrams.py
+"""
+Character trigram index for typo tolerant term lookup.
+
+Words are padded the way PostgreSQL's pg_trgm pads them ("  word "), and
+similarity is shared trigrams over all distinct trigrams of both words,
+so "lptop" finds "laptop" and "camra" finds "camera" with a few dictionary
+probes instead of generated misspellings.
+"""
+from collections import Counter
+
+
+def trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a, b):
+    a, b = trigrams(a), trigrams(b)
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+class TrigramIndex:
+    """Maps trigrams to the words containing them. Words are reference counted."""
+
+    def __init__(self):
+        self.words = Counter()
+        self.postings = {}  # trigram -> set of words
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def add(self, word):
+        self.words[word] += 1
+        if self.words[word] == 1:
+            for trigram in trigrams(word):
+                self.postings.setdefault(trigram, set()).add(word)
+
+    def discard(self, word):
+        if word not in self.words:
+            return
+        self.words[word] -= 1
+        if self.words[word]:
+            return
+        del self.words[word]
+        for trigram in trigrams(word):
+            words = self.postings.get(trigram)
+            if words is not None:
+                words.discard(word)
+                if not words:
+                    del self.postings[trigram]
+
+    def similar(self, word, threshold, limit=None):
+        """``[(word, similarity), ...]`` at or above ``threshold``, best first"""
+        grams = trigrams(word)
+        shared = Counter()
+        for trigram in grams:
+            shared.update(self.postings.get(trigram, ()))
+
+        matches = []
+        for candidate, count in shared.items():
+            score = count / (len(grams) + len(trigrams(candidate)) - count)
+            if score >= threshold:
+                matches.append((candidate, score))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches[:limit] if limit else matches
@@ -23,6 +23,7 @@ urlpatterns = [
 
     # Checkout URLs
     path('checkout/', views.CheckoutView.as_view(), name='checkout'),
+    path('locations/<str:version>.json', views.delivery_locations, name='delivery_locations'),
     path('apply-coupon/', views.apply_coupon, name='apply_coupon'),
     path('remove-coupon/', views.remove_coupon, name='remove_coupon'),
     path('check-payment-status/', views.check_payment_status, name='check_payment_status'),
@@ -34,6 +35,7 @@ urlpatterns = [
     path('autocomplete/', views.search_autocomplete, name='autocomplete'),
     path('filters/', views.search_filters, name='filters'),
     path('analytics/', views.search_analytics, name='analytics'),
+    path('analytics/search/', views.search_analytics, name='search_analytics'),
 
     # Account Profile URLs
     path('account/profile/', views.account_profile, name='account_profile'),
@@ -0,0 +1,161 @@
+# view_counter.py
+"""
+Write-behind buffer for product view tracking.
+
+``track_product_view`` only appends to an in-process buffer. A background
+thread flushes it every ``VIEW_COUNTER_FLUSH_INTERVAL`` seconds, or as soon
+as ``VIEW_COUNTER_MAX_PENDING`` views are waiting, turning the batch into
+one ``view_count`` UPDATE plus bulk writes of the view records.
+"""
+import atexit
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, When, Value
+from django.utils import timezone
+
+from .models import Product, ProductView, RecentlyViewedProduct, User
+from .write_buffer import WriteBuffer
+
+logger = logging.getLogger(__name__)
+
+# Keeps the OR-ed lookups of existing rows to a sane statement size
+LOOKUP_BATCH_SIZE = 200
+
+
+class ProductViewBuffer(WriteBuffer):
+    """Accumulates product views in memory and flushes them in batches"""
+    thread_name = 'product-view-flusher'
+    description = 'product views'
+
+    def __init__(self, flush_interval=None, max_pending=None):
+        super().__init__(
+            flush_interval or getattr(settings, 'VIEW_COUNTER_FLUSH_INTERVAL', 10),
+            max_pending or getattr(settings, 'VIEW_COUNTER_MAX_PENDING', 500),
+        )
+        self._reset()
+
+    def _reset(self):
+        self.view_counts = Counter()
+        # (product_id, user_id, session_key) -> (ip_address, user_agent)
+        self.views = {}
+        # (user_id, product_id) -> viewed_at
+        self.recently_viewed = {}
+        self.pending = 0
+
+    def record(self, product_id, user_id=None, session_key=None, ip_address=None, user_agent=''):
+        """Buffer one product view; never touches the database"""
+        with self._lock:
+            self.view_counts[product_id] += 1
+            self.views[(product_id, user_id, session_key)] = (ip_address, user_agent)
+            if user_id:
+                self.recently_viewed[(user_id, product_id)] = timezone.now()
+            self.pending += 1
+            full = self.pending >= self.max_pending
+
+        self._recorded(full)
+
+    def _drain(self):
+        with self._lock:
+            batch = (self.view_counts, self.views, self.recently_viewed)
+            self._reset()
+        return batch
+
+    def _restore(self, view_counts, views, recently_viewed):
+        """Put a batch that failed to write back in front of the newer views"""
+        with self._lock:
+            if self._backlog_full(self.pending + sum(view_counts.values())):
+                logger.error(f"Dropping {sum(view_counts.values())} product views, the backlog is full")
+                return
+            self.view_counts.update(view_counts)
+            self.views = {**views, **self.views}
+            self.recently_viewed = {**recently_viewed, **self.recently_viewed}
+            self.pending += sum(view_counts.values())
+
+    def flush(self):
+        """Write all buffered views. Returns the number of views flushed."""
+        view_counts, views, recently_viewed = self._drain()
+        if not view_counts:
+            return 0
+
+        try:
+            with transaction.atomic():
+                self._write_view_counts(view_counts)
+                # Products and users deleted since the views are dropped from the batch
+                product_ids = set(Product.objects.filter(
+                    id__in=list(view_counts)
+                ).values_list('id', flat=True))
+                user_ids = set(User.objects.filter(
+                    id__in={user_id for _, user_id, _ in views if user_id is not None}
+                ).values_list('id', flat=True))
+                self._write_product_views(views, product_ids, user_ids)
+                self._write_recently_viewed(recently_viewed, product_ids, user_ids)
+        except Exception:
+            # Retried with the next flush
+            self._restore(view_counts, views, recently_viewed)
+            raise
+        return sum(view_counts.values())
+
+    def _write_view_counts(self, view_counts):
+        increment = Case(
+            *[When(id=product_id, then=Value(count)) for product_id, count in view_counts.items()],
+            default=Value(0)
+        )
+        Product.objects.filter(id__in=list(view_counts)).update(view_count=F('view_count') + increment)
+
+    def _write_product_views(self, views, product_ids, user_ids):
+        keys = list(views)
+        existing = {}
+        for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            lookup = Q()
+            for product_id, user_id, session_key in keys[start:start + LOOKUP_BATCH_SIZE]:
+                lookup |= Q(product_id=product_id, user_id=user_id, session_key=session_key)
+            for view in ProductView.objects.filter(lookup):
+                existing[(view.product_id, view.user_id, view.session_key)] = view
+
+        to_update, to_create = [], []
+        for key, (ip_address, user_agent) in views.items():
+            view = existing.get(key)
+            if view:
+                view.ip_address, view.user_agent = ip_address, user_agent
+                to_update.append(view)
+            elif key[0] in product_ids and (key[1] is None or key[1] in user_ids):
+                product_id, user_id, session_key = key
+                to_create.append(ProductView(
+                    product_id=product_id, user_id=user_id, session_key=session_key,
+                    ip_address=ip_address, user_agent=user_agent,
+                ))
+
+        ProductView.objects.bulk_update(to_update, ['ip_address', 'user_agent'])
+        ProductView.objects.bulk_create(to_create)
+
+    def _write_recently_viewed(self, recently_viewed, product_ids, user_ids):
+        if not recently_viewed:
+            return
+        existing = {
+            (item.user_id, item.product_id): item
+            for item in RecentlyViewedProduct.objects.filter(
+                user_id__in={user_id for user_id, _ in recently_viewed},
+                product_id__in={product_id for _, product_id in recently_viewed},
+            )
+        }
+
+        to_update, to_create = [], []
+        for (user_id, product_id), viewed_at in recently_viewed.items():
+            item = existing.get((user_id, product_id))
+            if item:
+                item.viewed_at = viewed_at
+                to_update.append(item)
+            elif product_id in product_ids and user_id in user_ids:
+                to_create.append(RecentlyViewedProduct(
+                    user_id=user_id, product_id=product_id, viewed_at=viewed_at
+                ))
+
+        RecentlyViewedProduct.objects.bulk_update(to_update, ['viewed_at'])
+        RecentlyViewedProduct.objects.bulk_create(to_create)
+
+
+view_buffer = ProductViewBuffer()
+atexit.register(view_buffer.flush_on_exit)
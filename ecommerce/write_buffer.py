@@ -0,0 +1,76 @@
+# write_buffer.py
+"""
+Base for write-behind buffers.
+
+A buffer collects records in memory under a lock and a daemon thread
+flushes them every ``flush_interval`` seconds, or as soon as
+``max_pending`` records are waiting. Subclasses keep the records and
+implement ``flush``, putting a batch that failed to write back in front
+of the newer records; ``after_flush`` runs periodic follow-up work on the
+same thread. Register ``flush_on_exit`` with ``atexit`` so a clean shutdown
+writes what is left.
+"""
+import logging
+import threading
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Failed batches kept for retry, in multiples of max_pending, while the database is down
+MAX_BACKLOG_BATCHES = 20
+
+
+class WriteBuffer:
+    """Lock, wakeup event and flusher thread shared by the buffers"""
+    thread_name = 'write-buffer'
+    description = 'buffered records'
+
+    def __init__(self, flush_interval, max_pending):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def flush(self):
+        """Write everything buffered; returns the number of records written"""
+        raise NotImplementedError
+
+    def after_flush(self):
+        pass
+
+    def _backlog_full(self, pending):
+        """Whether ``pending`` records, failed batches included, are more than we keep"""
+        return pending > self.max_pending * MAX_BACKLOG_BATCHES
+
+    def _recorded(self, full):
+        """Call after buffering a record, outside the lock"""
+        self._ensure_worker()
+        if full:
+            self._wakeup.set()
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                self.after_flush()
+            except Exception as e:
+                logger.error(f"Error flushing {self.description}: {e}")
+            finally:
+                connections.close_all()
+
+    def flush_on_exit(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Error flushing {self.description} on exit: {e}")
@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 from decouple import config
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -86,6 +87,34 @@ DATABASES = {
 }
 
 
+# Cache
+# Shared by every worker process: M-Pesa access tokens, the search change
+# log, cache version counters and cached documents must look the same in all
+# of them, and the token lock (``cache.add``) and the change log counter
+# (``cache.incr``) must be atomic across processes. Only Redis and Memcached
+# provide that, e.g. CACHE_BACKEND=django.core.cache.backends.memcached.PyMemcacheCache
+# and CACHE_LOCATION=127.0.0.1:11211. Tests use galio.test_settings.
+
+ATOMIC_CACHE_BACKENDS = (
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+)
+
+CACHES = {
+    'default': {
+        'BACKEND': config("CACHE_BACKEND", default="django.core.cache.backends.redis.RedisCache"),
+        'LOCATION': config("CACHE_LOCATION", default="redis://127.0.0.1:6379/1"),
+    }
+}
+
+if CACHES['default']['BACKEND'] not in ATOMIC_CACHE_BACKENDS:
+    raise ImproperlyConfigured(
+        f"CACHE_BACKEND must be one of {', '.join(ATOMIC_CACHE_BACKENDS)}: the M-Pesa token "
+        "lock and the search change log need atomic add and incr shared by every process"
+    )
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -126,6 +155,19 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')    # For collectstatic in pr
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Catalog pagination: 'offset' (numbered pages) or 'keyset' (cursor based,
+# constant cost per page). Any request can opt into keyset with ?cursor=
+CATALOG_PAGINATION = config("CATALOG_PAGINATION", default="offset")
+
+# Search: minimum trigram similarity (0-1) for a misspelled query word to
+# match a word of a product, brand or category name
+SEARCH_FUZZY_THRESHOLD = config("SEARCH_FUZZY_THRESHOLD", default=0.3, cast=float)
+
+# Search backend: 'memory' (in-process BM25 index), 'sqlite_fts' (FTS5 table)
+# or 'postgres' (tsvector + GIN). Run `manage.py rebuild_search_index` after
+# switching to one of the database backed ones.
+SEARCH_BACKEND = config("SEARCH_BACKEND", default="memory")
+
 # M-Pesa Configuration
 
 MPESA_CONSUMER_KEY = config("MPESA_CONSUMER_KEY")
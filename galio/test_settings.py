@@ -0,0 +1,7 @@
+"""Settings for the test suite: ``python manage.py test --settings=galio.test_settings``"""
+from .settings import *  # noqa: F401,F403
+
+# Each test process gets a private cache; LocMemCache is atomic within it
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}